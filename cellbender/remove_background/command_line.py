@@ -137,6 +137,154 @@ class CLI(AbstractCLI):
                                     "can help adjust the prior for empty droplet "
                                     "counts in the rare case where empty counts "
                                     "are extremely high (over 200).")
+        subparser.add_argument("--output_compression", type=str,
+                               default="zlib",
+                               choices=["zlib", "blosc", "blosc:lz4",
+                                        "blosc:zstd", "none"],
+                               dest="output_compression",
+                               help="Compression applied to the arrays in the "
+                                    "output .h5 files.  'zlib' can be read by "
+                                    "any HDF5 reader.  'blosc' is faster, but "
+                                    "outside of PyTables it requires the HDF5 "
+                                    "blosc filter plugin.")
+        subparser.add_argument("--output_compression_level", type=int,
+                               default=4, dest="output_compression_level",
+                               help="Compression level for the output .h5 "
+                                    "files, from 0 (none) to 9 (maximum).")
+        subparser.add_argument("--h5ad",
+                               dest="write_h5ad", action="store_true",
+                               help="Including the flag --h5ad will also write "
+                                    "the filtered output (cells only) as an "
+                                    "AnnData .h5ad file, with latent variables "
+                                    "in obs and obsm, and ambient expression "
+                                    "in var.")
+        subparser.add_argument("--cache_dir", type=str, default=None,
+                               dest="cache_dir",
+                               help="Directory in which to cache parsed input "
+                                    "files as .npy arrays.  Later runs on an "
+                                    "unchanged input file load from the cache, "
+                                    "which is much faster.  Caching is off by "
+                                    "default.")
+        subparser.add_argument("--cache_size_gb", type=float, default=20.,
+                               dest="cache_size_gb",
+                               help="Maximum size of the cache directory in "
+                                    "GB.  Least recently used entries are "
+                                    "deleted to stay under this limit.")
+        subparser.add_argument("--pack_barcodes",
+                               dest="use_packed_barcodes", action="store_true",
+                               help="Including the flag --pack_barcodes stores "
+                                    "barcodes in memory packed two bits per "
+                                    "base, which saves memory for raw inputs "
+                                    "with millions of barcodes.  Output files "
+                                    "are unchanged.")
+        subparser.add_argument("--memory_budget", type=float, default=None,
+                               dest="memory_budget",
+                               help="Memory available for inference, in GB.  "
+                                    "If specified, the minibatch size is the "
+                                    "largest whose predicted memory use fits, "
+                                    "given the number of genes and layer "
+                                    "sizes.  Otherwise it is at most 500.")
+        subparser.add_argument("--dense_threshold_gb", type=float, default=2.,
+                               dest="dense_threshold_gb",
+                               help="If the trimmed count matrix takes less "
+                                    "than this many GB as a dense float32 "
+                                    "matrix, it is kept as a dense tensor "
+                                    "for training, which makes loading "
+                                    "minibatches much faster.  With --cuda "
+                                    "this is GPU memory, in addition to the "
+                                    "memory used by training.  With "
+                                    "--memory_budget, the matrix is only "
+                                    "kept if it takes at most half of the "
+                                    "budget, and the minibatch size is "
+                                    "chosen to fit the rest.  0 disables "
+                                    "this.")
+        subparser.add_argument("--sparse_input",
+                               dest="sparse_input", action="store_true",
+                               help="Including the flag --sparse_input loads "
+                                    "minibatches as sparse tensors, which the "
+                                    "first layers of the encoders multiply "
+                                    "without densifying.  Only the "
+                                    "likelihood uses dense counts.  This can "
+                                    "be faster for very sparse data, "
+                                    "particularly on GPU.  It overrides "
+                                    "--dense_threshold_gb.")
+        subparser.add_argument("--decoder_rank", type=int, default=None,
+                               dest="decoder_rank",
+                               help="Rank of the output layer of the "
+                                    "decoder.  If specified, the layer from "
+                                    "the last hidden layer to the genes is "
+                                    "factorized through this many units, "
+                                    "e.g. 64, which greatly reduces the "
+                                    "parameters and computation of the "
+                                    "decoder for large gene sets.  By "
+                                    "default the output layer is full rank.")
+        subparser.add_argument("--encoder_genes", type=int, default=None,
+                               dest="encoder_genes",
+                               help="Number of genes input to the encoders.  "
+                                    "If specified, the encoders only see "
+                                    "the most informative genes, which makes "
+                                    "their first layers much smaller for "
+                                    "large gene sets.  The decoder and the "
+                                    "likelihood still use all genes.  By "
+                                    "default all genes are used.")
+        subparser.add_argument("--encoder_gene_selection", type=str,
+                               default="variance",
+                               choices=["variance", "ambient"],
+                               dest="encoder_gene_selection",
+                               help="How the genes input to the encoders "
+                                    "are chosen, with --encoder_genes.  "
+                                    "'variance' chooses the genes with the "
+                                    "highest variance of log normalized "
+                                    "counts, and 'ambient' the genes whose "
+                                    "expression differs most from the "
+                                    "ambient RNA profile.  'ambient' is not "
+                                    "available for the simple model.")
+        subparser.add_argument("--likelihood_genes", type=int, default=None,
+                               dest="likelihood_genes",
+                               help="Number of genes at which the likelihood "
+                                    "is evaluated for each minibatch.  If "
+                                    "specified, genes are sampled at random "
+                                    "(preferring genes with nonzero counts) "
+                                    "and weighted to give an unbiased "
+                                    "estimate of the likelihood of all "
+                                    "genes.  This speeds up training with "
+                                    "very many genes, at the cost of a "
+                                    "noisier loss.  By default all genes are "
+                                    "used.")
+        subparser.add_argument("--empty_drop_sampling", type=str,
+                               default="uniform", choices=["uniform", "umi"],
+                               dest="empty_drop_sampling",
+                               help="How empty droplets are drawn for each "
+                                    "minibatch.  'uniform' draws them "
+                                    "uniformly at random, and 'umi' in "
+                                    "proportion to their UMI counts, which "
+                                    "concentrates training on the empty "
+                                    "droplets most informative about the "
+                                    "ambient RNA profile.  The loss is not "
+                                    "reweighted to correct for 'umi' "
+                                    "sampling, so empty droplets with more "
+                                    "counts carry more weight in the fit "
+                                    "than they do with 'uniform'.")
+        subparser.add_argument("--rare_gene_threshold", type=int,
+                               default=None, dest="rare_gene_threshold",
+                               help="Genes with fewer total counts than this "
+                                    "are pooled into bins which the model "
+                                    "treats as single genes, so that the "
+                                    "model only needs to be as wide as the "
+                                    "number of informative genes.  Output "
+                                    "counts of each bin are shared between "
+                                    "its genes in proportion to their "
+                                    "observed counts.  By default no genes "
+                                    "are pooled.")
+        subparser.add_argument("--max_empty_droplets", type=int,
+                               default=None, dest="max_empty_droplets",
+                               help="Maximum number of empty droplets used "
+                                    "for training, e.g. 200000.  Beyond this, "
+                                    "a sample stratified by UMI count is "
+                                    "used, which bounds memory for deep raw "
+                                    "inputs while preserving the "
+                                    "distribution of empty droplet counts.  "
+                                    "By default all empty droplets are used.")
         subparser.add_argument("--test",
                                dest="test", action="store_true",
                                help="Including the flag --test will run tests only, "
@@ -195,6 +343,33 @@ class CLI(AbstractCLI):
         assert args.training_fraction < 1.0, "training_fraction must be < 1"
         assert args.training_fraction > 0.0, "training_fraction must be > 0"
 
+        assert 0 <= args.output_compression_level <= 9, \
+            "output_compression_level must be an integer from 0 to 9."
+
+        if args.max_empty_droplets is not None:
+            assert args.max_empty_droplets > 0, "max_empty_droplets must be > 0"
+
+        if args.memory_budget is not None:
+            assert args.memory_budget > 0, "memory_budget must be > 0"
+
+        assert args.dense_threshold_gb >= 0, "dense_threshold_gb must be >= 0"
+
+        if args.decoder_rank is not None:
+            assert args.decoder_rank > 0, "decoder_rank must be > 0"
+
+        if args.rare_gene_threshold is not None:
+            assert args.rare_gene_threshold > 0, "rare_gene_threshold must be > 0"
+
+        if args.likelihood_genes is not None:
+            assert args.likelihood_genes > 0, "likelihood_genes must be > 0"
+
+        if args.encoder_genes is not None:
+            assert args.encoder_genes > 0, "encoder_genes must be > 0"
+            assert not (("simple" in args.model)
+                        and (args.encoder_gene_selection == "ambient")), \
+                "encoder_gene_selection 'ambient' needs a model with " \
+                "ambient RNA, not the simple model."
+
         # If cuda is requested, make sure it is available.
         if args.use_cuda:
             assert torch.cuda.is_available(), "Trying to use CUDA, " \
@@ -286,7 +461,12 @@ def run_remove_background(args):
                                   fraction_empties=args.fraction_empties,
                                   model_name=args.model[i],
                                   gene_blacklist=args.blacklisted_genes,
-                                  low_count_threshold=args.low_count_threshold)
+                                  low_count_threshold=args.low_count_threshold,
+                                  cache_dir=args.cache_dir,
+                                  cache_size_gb=args.cache_size_gb,
+                                  use_packed_barcodes=args.use_packed_barcodes,
+                                  max_empty_droplets=args.max_empty_droplets,
+                                  rare_gene_threshold=args.rare_gene_threshold)
         except OSError:
             logging.error(f"OSError: Unable to open file {file}.")
             continue
@@ -297,7 +477,11 @@ def run_remove_background(args):
         # Write outputs to file.
         try:
             dataset_obj.save_to_output_file(args.output_files[i], inferred_model,
-                                            save_plots=True)
+                                            save_plots=True,
+                                            compression=args.output_compression,
+                                            complevel=
+                                            args.output_compression_level,
+                                            write_h5ad=args.write_h5ad)
 
             logging.info("Completed remove_background.\n")
 
@@ -0,0 +1,186 @@
+"""Compact storage of cell barcodes, packed two bits per base into uint64.
+
+A raw count matrix can have millions of barcodes, like 'AAACCTGAGAAACCAT-1',
+which take 18 bytes each as a numpy bytes array (more as unicode).  Packed,
+each takes 8 bytes: the nucleotide sequence is stored in the low 48 bits, two
+bits per base, and the index of its suffix (like the '-1' GEM well) in a small
+table of suffixes in the high 16 bits.  Barcodes are only decoded to strings
+when they are written out.
+
+"""
+
+import numpy as np
+
+from typing import Union
+import logging
+
+
+SEQUENCE_BITS = 48
+MAX_SEQUENCE_LENGTH = SEQUENCE_BITS // 2
+MAX_SUFFIX_BYTES = 8
+
+# Lookup tables between ASCII nucleotides and two-bit codes.
+_ENCODE = np.full(256, 255, dtype=np.uint8)
+for _code, _base in enumerate(b'ACGT'):
+    _ENCODE[_base] = _code
+_DECODE = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+
+class PackedBarcodes:
+    """Barcodes packed two bits per base into a numpy uint64 array.
+
+    Indexing with an array, mask, or slice gives PackedBarcodes, and indexing
+    with an integer gives the decoded barcode as bytes.  Converting to a
+    numpy array (e.g. np.asarray()) decodes all barcodes to a bytes array.
+
+    Args:
+        codes: Packed barcodes.
+        sequence_length: Number of bases in every barcode sequence.
+        suffixes: Decoded suffix of each suffix code, where the code is stored
+            in the high bits of codes, e.g. [b'', b'-1'].
+
+    """
+
+    def __init__(self,
+                 codes: np.ndarray,
+                 sequence_length: int,
+                 suffixes: np.ndarray):
+        self.codes = codes
+        self.sequence_length = sequence_length
+        self.suffixes = suffixes
+
+    @property
+    def size(self) -> int:
+        return self.codes.size
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.suffixes.nbytes
+
+    @property
+    def itemsize(self) -> int:
+        """Length in bytes of the longest decoded barcode."""
+        return self.sequence_length + max(len(s) for s in self.suffixes)
+
+    def __len__(self) -> int:
+        return self.codes.size
+
+    def __getitem__(self, item) -> Union['PackedBarcodes', bytes]:
+        codes = self.codes[item]
+        if np.ndim(codes) == 0:
+            return self._decode(np.array([codes]))[0]
+        return PackedBarcodes(codes, self.sequence_length, self.suffixes)
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        barcodes = self.decode()
+        return barcodes if dtype is None else barcodes.astype(dtype)
+
+    def __repr__(self) -> str:
+        return f'PackedBarcodes({self.size} barcodes)'
+
+    def decode(self, chunk_size: int = 1000000) -> np.ndarray:
+        """Decode all barcodes to a numpy bytes array.
+
+        Args:
+            chunk_size: Number of barcodes decoded at a time, which bounds
+                the memory used by intermediate arrays.
+
+        """
+
+        out = np.empty(self.size, dtype=f'S{self.itemsize}')
+        for i in range(0, self.size, chunk_size):
+            out[i:(i + chunk_size)] = self._decode(self.codes[i:(i + chunk_size)])
+        return out
+
+    def _decode(self, codes: np.ndarray) -> np.ndarray:
+        """Decode packed barcodes to a numpy bytes array."""
+
+        # Unpack the sequence, two bits per base, first base highest.
+        shifts = 2 * np.arange(self.sequence_length - 1, -1, -1, dtype=np.uint64)
+        bases = (codes[:, None] >> shifts[None, :]) & np.uint64(3)
+        chars = np.zeros((codes.size, self.itemsize), dtype=np.uint8)
+        chars[:, :self.sequence_length] = _DECODE[bases]
+
+        # Suffixes are written after the sequence, padded with zero bytes.
+        suffix_codes = (codes >> np.uint64(SEQUENCE_BITS)).astype(np.int64)
+        for code in np.unique(suffix_codes):
+            suffix = np.frombuffer(self.suffixes[code], dtype=np.uint8)
+            chars[suffix_codes == code,
+                  self.sequence_length:(self.sequence_length + suffix.size)] \
+                = suffix
+
+        return chars.view(f'S{self.itemsize}').ravel()
+
+
+def pack_barcodes(barcodes: np.ndarray) -> Union[PackedBarcodes, None]:
+    """Pack barcodes two bits per base, if they all have a packable form.
+
+    Barcodes must be a nucleotide sequence of the same length (at most 24
+    bases, only A, C, G, and T), optionally followed by a short suffix such
+    as '-1'.  There can be at most 2**16 distinct suffixes.
+
+    Args:
+        barcodes: numpy array of barcodes, as bytes or str.
+
+    Returns:
+        packed: PackedBarcodes, or None if the barcodes cannot be packed
+            (in which case they should be kept as they are).
+
+    """
+
+    if isinstance(barcodes, PackedBarcodes):
+        return barcodes
+
+    barcodes = np.asarray(barcodes)
+    if (barcodes.ndim != 1) or (barcodes.size == 0) \
+            or (barcodes.dtype.kind not in 'SU'):
+        return None
+    if barcodes.dtype.kind == 'U':
+        try:
+            barcodes = barcodes.astype('S')
+        except UnicodeEncodeError:
+            return None
+
+    # View as a matrix of characters.
+    width = barcodes.dtype.itemsize
+    chars = barcodes.view(np.uint8).reshape(barcodes.size, width)
+
+    # The sequence is everything up to the first non-nucleotide character,
+    # and must have the same length in all barcodes.
+    is_base = _ENCODE[chars] != 255
+    sequence_length = int(np.argmin(np.concatenate(
+        [is_base[:1], np.zeros((1, 1), dtype=bool)], axis=1)))
+    if (sequence_length == 0) or (sequence_length > MAX_SEQUENCE_LENGTH) \
+            or (width - sequence_length > MAX_SUFFIX_BYTES) \
+            or not is_base[:, :sequence_length].all() \
+            or ((width > sequence_length)
+                and is_base[:, sequence_length].any()):
+        return None
+
+    # Pack the sequence, first base in the highest bits.
+    codes = np.zeros(barcodes.size, dtype=np.uint64)
+    for i in range(sequence_length):
+        codes <<= np.uint64(2)
+        codes |= _ENCODE[chars[:, i]].astype(np.uint64)
+
+    # Suffixes, as integer keys, are mapped to a small table.
+    suffix_bytes = np.zeros((barcodes.size, MAX_SUFFIX_BYTES), dtype=np.uint8)
+    suffix_bytes[:, :(width - sequence_length)] = chars[:, sequence_length:]
+    unique_keys, suffix_codes = np.unique(suffix_bytes.view(np.uint64).ravel(),
+                                          return_inverse=True)
+    if unique_keys.size > 2**16:
+        return None
+    suffixes = np.array(unique_keys.view(f'S{MAX_SUFFIX_BYTES}').tolist(),
+                        dtype=object)
+    codes |= suffix_codes.astype(np.uint64) << np.uint64(SEQUENCE_BITS)
+
+    packed = PackedBarcodes(codes, sequence_length, suffixes)
+
+    logging.info(f"Packed {barcodes.size} barcodes from "
+                 f"{barcodes.nbytes / 1e6:.1f} MB to {packed.nbytes / 1e6:.1f} MB")
+
+    return packed
@@ -0,0 +1,232 @@
+"""Cache of parsed input count matrices, stored as memory-mappable .npy files.
+
+Parsing a large HDF5 or mtx input file can take much longer than loading the
+same arrays from .npy files.  Each cache entry is a directory, named by a key
+computed from the input file, which holds the arrays of the csr_matrix along
+with the barcodes and gene names.  Entries are loaded with memory mapping, so
+that only the parts of the matrix that are used are read from disk.
+
+Keys also depend on the version of the cache format and on the options used
+to parse the input, so that data parsed differently is never loaded.
+
+The cache directory is limited in size: after an entry is added, the least
+recently used entries are deleted until the total size is under the limit.
+
+"""
+
+import numpy as np
+import scipy.sparse as sp
+
+from typing import Dict, List, Optional, Union
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+
+CACHED_ARRAYS = ['data', 'indices', 'indptr', 'shape', 'barcodes', 'gene_names']
+
+# Increase this whenever the cached arrays change for the same input file
+# (e.g. their dtypes, or which features are kept), so old entries are unused.
+CACHE_FORMAT_VERSION = 1
+
+
+def get_cache_key(input_file: str,
+                  use_content_hash: bool = False,
+                  parse_options: Union[Dict, None] = None) -> str:
+    """Compute a key which identifies the current version of an input file.
+
+    Args:
+        input_file: Path to an input file, or an mtx directory.
+        use_content_hash: If True, the key is a hash of the contents of the
+            file(s).  Otherwise it is a hash of the absolute path, size, and
+            modification time of the file(s), which is much faster to compute.
+        parse_options: Options which change how the input file is parsed.
+            Must be serializable as JSON.
+
+    Returns:
+        key: Hexadecimal string.
+
+    """
+
+    # An mtx directory is identified by all the files in it.
+    input_file = os.path.abspath(input_file)
+    if os.path.isdir(input_file):
+        files = [os.path.join(input_file, f)
+                 for f in sorted(os.listdir(input_file))]
+        files = [f for f in files if os.path.isfile(f)]
+    else:
+        files = [input_file]
+
+    h = hashlib.sha1()
+    h.update(f'{CACHE_FORMAT_VERSION}\t'
+             f'{json.dumps(parse_options, sort_keys=True)}\n'.encode())
+    for file in files:
+        if use_content_hash:
+            with open(file, 'rb') as f:
+                for block in iter(lambda: f.read(2**24), b''):
+                    h.update(block)
+        else:
+            stat = os.stat(file)
+            h.update(f'{file}\t{stat.st_size}\t{stat.st_mtime_ns}\n'.encode())
+
+    return h.hexdigest()
+
+
+def load_from_cache(cache_dir: str,
+                    input_file: str,
+                    use_content_hash: bool = False,
+                    parse_options: Union[Dict, None] = None) -> Union[Dict, None]:
+    """Load parsed data for an input file from the cache, if it is there.
+
+    Args:
+        cache_dir: Cache directory.
+        input_file: Path to the input file, or an mtx directory.
+        use_content_hash: Passed to get_cache_key().
+        parse_options: Passed to get_cache_key().
+
+    Returns:
+        data: Dict with ['matrix', 'barcodes', 'gene_names'], as from
+            get_matrix_from_h5(), or None if the file is not in the cache.
+
+    Note:
+        The count matrix arrays are memory-mapped copy-on-write, so that they
+        can be modified in memory without changing the cache.
+
+    """
+
+    entry = os.path.join(cache_dir, get_cache_key(input_file, use_content_hash,
+                                                  parse_options))
+    if not all(os.path.exists(os.path.join(entry, name + '.npy'))
+               for name in CACHED_ARRAYS):
+        return None
+
+    try:
+        arrays = {name: np.load(os.path.join(entry, name + '.npy'),
+                                mmap_mode='c', allow_pickle=False)
+                  for name in CACHED_ARRAYS}
+    except (OSError, ValueError):
+        logging.warning(f"Could not read cache entry {entry}.  Ignoring it.")
+        return None
+
+    # Mark the entry as recently used.
+    os.utime(entry)
+
+    logging.info(f"Loaded cached data for {input_file} from {entry}")
+
+    matrix = sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                           shape=tuple(int(n) for n in arrays['shape']),
+                           copy=False)
+
+    # Barcodes and gene names are small, so are read into memory.
+    return {'matrix': matrix,
+            'barcodes': np.array(arrays['barcodes']),
+            'gene_names': np.array(arrays['gene_names'])}
+
+
+def save_to_cache(cache_dir: str,
+                  input_file: str,
+                  data: Dict,
+                  max_size_gb: float = 20.,
+                  use_content_hash: bool = False,
+                  parse_options: Union[Dict, None] = None) -> bool:
+    """Save parsed data for an input file to the cache.
+
+    The entry is written to a temporary directory which is then renamed, so
+    that other processes never see a partial entry.  Least recently used
+    entries are then evicted to keep the cache under max_size_gb.
+
+    Args:
+        cache_dir: Cache directory.  Created if it does not exist.
+        input_file: Path to the input file, or an mtx directory.
+        data: Dict with ['matrix', 'barcodes', 'gene_names'], as from
+            get_matrix_from_h5().
+        max_size_gb: Maximum total size of the cache in GB.
+        use_content_hash: Passed to get_cache_key().
+        parse_options: Passed to get_cache_key().
+
+    Returns:
+        True if the data was saved to the cache.
+
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = os.path.join(cache_dir, get_cache_key(input_file, use_content_hash,
+                                                  parse_options))
+
+    matrix = sp.csr_matrix(data['matrix'])
+    arrays = {'data': matrix.data,
+              'indices': matrix.indices,
+              'indptr': matrix.indptr,
+              'shape': np.array(matrix.shape),
+              'barcodes': np.asarray(data['barcodes']),
+              'gene_names': np.asarray(data['gene_names'])}
+
+    temp_dir = None
+    try:
+        temp_dir = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp_')
+        for name, array in arrays.items():
+            np.save(os.path.join(temp_dir, name + '.npy'), array,
+                    allow_pickle=False)
+        if os.path.exists(entry):
+            shutil.rmtree(entry)
+        os.rename(temp_dir, entry)
+
+    except (OSError, ValueError):
+        logging.warning(f"Could not write cache entry for {input_file} to "
+                        f"{cache_dir}.")
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        return False
+
+    logging.info(f"Cached parsed data for {input_file} in {entry}")
+
+    evict_from_cache(cache_dir, max_size_gb=max_size_gb, keep=[entry])
+
+    return True
+
+
+def evict_from_cache(cache_dir: str,
+                     max_size_gb: float,
+                     keep: Optional[List[str]] = None) -> List[str]:
+    """Delete least recently used cache entries until under max_size_gb.
+
+    Args:
+        cache_dir: Cache directory.
+        max_size_gb: Maximum total size of the cache in GB.
+        keep: Entries which are never evicted (e.g. the one just written).
+            None keeps no particular entries.
+
+    Returns:
+        evicted: Entries which were deleted.
+
+    """
+
+    if keep is None:
+        keep = []
+
+    # Size and last use time of each entry.
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if os.path.isdir(entry) and not name.startswith('.tmp_'):
+            size = sum(os.path.getsize(os.path.join(entry, f))
+                       for f in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, entry))
+
+    # Delete the oldest first.
+    total = sum(size for _, size, _ in entries)
+    evicted = []
+    for _, size, entry in sorted(entries):
+        if total <= max_size_gb * 1e9:
+            break
+        if entry in keep:
+            continue
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+        evicted.append(entry)
+        logging.info(f"Evicted {entry} from cache.")
+
+    return evicted
@@ -6,11 +6,10 @@ import numpy as np
 import scipy.sparse as sp
 import torch
 import torch.utils.data
-from typing import Tuple, List
+from typing import Tuple, List, Union
+import logging
 
 
-# TODO: if the dataset is small enough, can I transfer the whole thing to CUDA?
-
 class SparseDataset(torch.utils.data.Dataset):
     """torch.utils.data.Dataset wrapping a scipy.sparse.csr.csr_matrix
 
@@ -35,12 +34,79 @@ class SparseDataset(torch.utils.data.Dataset):
         return self.csrs[0].shape[0]
 
 
+class AliasSampler:
+    """Weighted sampling with replacement from a precomputed alias table.
+
+    Building the table (Vose's alias method) takes O(n) time, after which each
+    draw takes O(1) time: pick an index uniformly, then either keep it or
+    take its alias, with a precomputed probability.
+
+    Args:
+        weights: Non-negative weight of each index.  Need not sum to one.
+
+    """
+
+    def __init__(self, weights: np.ndarray):
+        self.set_weights(weights)
+
+    def set_weights(self, weights: np.ndarray):
+        """Rebuild the alias table for new weights."""
+
+        weights = np.asarray(weights, dtype=np.float64).ravel()
+        assert weights.size > 0, "Cannot sample from zero weights."
+        assert np.all(weights >= 0) and (weights.sum() > 0), \
+            "Weights must be non-negative, and not all zero."
+
+        n = weights.size
+        scaled = weights * (n / weights.sum())
+        self.prob = np.ones(n)
+        self.alias = np.arange(n)
+
+        # Pair each underfull index with an overfull one, which tops it up.
+        small = list(np.flatnonzero(scaled < 1.))
+        large = list(np.flatnonzero(scaled >= 1.))
+        while small and large:
+            s = small.pop()
+            l = large[-1]
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1. - scaled[s]
+            if scaled[l] < 1.:
+                small.append(large.pop())
+
+        # Whatever is left over has probability one, up to rounding.
+        self.prob[small] = 1.
+        self.prob[large] = 1.
+
+    def sample(self, size: int) -> np.ndarray:
+        """Draw size indices with replacement, in proportion to the weights."""
+
+        inds = np.random.randint(self.prob.size, size=size)
+        keep = np.random.random_sample(size) < self.prob[inds]
+        return np.where(keep, inds, self.alias[inds])
+
+
 class DataLoader:
     """Dataloader.
 
     This dataloader loads a specified fraction of cell barcodes + unknowns, and
     also mixes in a specified fraction of a random sampling of empty barcodes.
 
+    Empty barcodes are sampled uniformly, unless empty_weights are given, in
+    which case they are sampled in proportion to their weights (UMI counts)
+    using an AliasSampler.
+
+    Each minibatch is a tuple (x, mask).  Every x has the same number of rows,
+    so that a JIT-compiled ELBO can be reused: the last minibatch of an epoch
+    holds the remaining cells and is padded with copies of its own rows, which
+    are False in the boolean mask.
+
+    If dense is True, the datasets are converted once to dense float32
+    tensors on the device, and minibatches are selected from them by index,
+    rather than being densified from the sparse matrices for every minibatch.
+    Otherwise, if sparse is True, each x is a sparse CSR torch.Tensor, which
+    is never densified for the encoders.
+
     """
 
     def __init__(self,
@@ -49,19 +115,37 @@ class DataLoader:
                  batch_size: int = 128,
                  fraction_empties: float = 0.5,
                  shuffle: bool = True,
-                 use_cuda: bool = True):
+                 use_cuda: bool = True,
+                 empty_weights: Union[np.ndarray, None] = None,
+                 dense: bool = False,
+                 sparse: bool = False):
+        self.device = 'cpu'
+        self.use_cuda = use_cuda
+        if self.use_cuda:
+            self.device = 'cuda'
+        self.dense = dense
+        self.sparse = sparse and not dense
         self.dataset = dataset
         self.ind_list = np.arange(self.dataset.shape[0])
         self.empty_drop_dataset = empty_drop_dataset
         self.empty_ind_list = np.arange(self.empty_drop_dataset.shape[0])
+        self.empty_sampler = None
+        if (empty_weights is not None) and (self.empty_ind_list.size > 0):
+            assert len(empty_weights) == self.empty_ind_list.size, \
+                "Need one weight per empty droplet."
+            self.empty_sampler = AliasSampler(empty_weights)
         self.batch_size = batch_size
         self.fraction_empties = fraction_empties
         self.cell_batch_size = int(batch_size * (1. - fraction_empties))
+        self.full_batch_size = self.cell_batch_size
+        if self.empty_ind_list.size > 0:
+            self.full_batch_size += int(self.cell_batch_size *
+                                        (fraction_empties / (1 - fraction_empties)))
         self.shuffle = shuffle
-        self.device = 'cpu'
-        self.use_cuda = use_cuda
-        if self.use_cuda:
-            self.device = 'cuda'
+        if self.dense:
+            # Cells followed by empty droplets, as one resident tensor.
+            self.dense_data = densify(sp.vstack([dataset, empty_drop_dataset],
+                                                format='csr')).to(device=self.device)
         self._reset()
 
     def _reset(self):
@@ -76,9 +160,8 @@ class DataLoader:
         return self
 
     def __next__(self):
-        # if self.ptr == self.ind_list.size:
-        # This throws out the last bit because Jit + mask was not working:
-        if self.ptr + self.cell_batch_size > self.ind_list.size:
+        # Stop once every cell has been seen.
+        if (self.ptr >= self.ind_list.size) or (self.cell_batch_size == 0):
             self._reset()
             raise StopIteration()
 
@@ -95,23 +178,44 @@ class DataLoader:
                             (self.fraction_empties / (1 - self.fraction_empties)))
             if self.empty_ind_list.size > 0:
                 # This does not happen for 'simple' model.
-                empty_inds = np.random.choice(self.empty_ind_list,
-                                              size=n_empties,
-                                              replace=True)
-                # TODO: could consider using a probability-weighted choice above...
-
-                if empty_inds.size > 0:
-                    csr_list = [self.dataset[cell_inds, :],
-                                self.empty_drop_dataset[empty_inds, :]]
-            else:
-                csr_list = [self.dataset[cell_inds, :]]
+                if self.empty_sampler is None:
+                    empty_inds = np.random.choice(self.empty_ind_list,
+                                                  size=n_empties,
+                                                  replace=True)
+                else:
+                    empty_inds = self.empty_sampler.sample(n_empties)
 
-            # Get a dense tensor from the sparse matrix.
-            dense_tensor = sparse_collate(csr_list)
+            else:
+                empty_inds = np.array([], dtype=int)
+
+            # A short (final) minibatch is padded to the full size by
+            # repeating its rows, and the padding is masked.
+            n_rows = cell_inds.size + empty_inds.size
+            mask = torch.ones(self.full_batch_size, dtype=torch.bool)
+            mask[n_rows:] = False
+            padding = np.arange(self.full_batch_size - n_rows) % n_rows
+
+            # Get a dense tensor of the cells and empty droplets.
+            if self.dense:
+                # A single copy of the rows out of the resident tensor.
+                rows = np.concatenate([cell_inds, empty_inds + self.ind_list.size])
+                rows = np.concatenate([rows, rows[padding]])
+                dense_tensor = self.dense_data[torch.from_numpy(rows).to(device=self.device)]
+            elif self.sparse:
+                csr = sp.vstack([self.dataset[cell_inds, :],
+                                 self.empty_drop_dataset[empty_inds, :]],
+                                format='csr')
+                dense_tensor = sparse_csr_collate(
+                    csr[np.concatenate([np.arange(n_rows), padding]), :])
+            else:
+                dense_tensor = sparse_collate([self.dataset[cell_inds, :],
+                                               self.empty_drop_dataset[empty_inds, :]])
+                dense_tensor = torch.cat([dense_tensor,
+                                          dense_tensor[torch.from_numpy(padding)]])
 
             # Increment the pointer and return the minibatch.
             self.ptr = next_ptr
-            return dense_tensor.to(device=self.device)
+            return dense_tensor.to(device=self.device), mask.to(device=self.device)
 
 
 def prep_sparse_data_for_training(dataset: sp.csr.csr_matrix,
@@ -120,16 +224,19 @@ def prep_sparse_data_for_training(dataset: sp.csr.csr_matrix,
                                   fraction_empties: float = 0.5,
                                   batch_size: int = 128,
                                   shuffle: bool = True,
-                                  use_cuda: bool = True) -> Tuple[
+                                  use_cuda: bool = True,
+                                  empty_sampling: str = 'uniform',
+                                  dense_threshold_gb: float = 2.,
+                                  sparse_batches: bool = False) -> Tuple[
                                       torch.utils.data.DataLoader,
                                       torch.utils.data.DataLoader]:
     """Create torch.utils.data.DataLoaders for train and tests set.
 
-    The dataset is not loaded into memory as a dense matrix upfront.  Instead
-    of using a torch.utils.data.TensorDataset, a SparseDataset is used, which
-    only transforms a sparse matrix to a dense one when a minibatch is loaded.
-    This is slower, but necessary for datasets which are too large to be
-    loaded into memory as a dense matrix all at once.
+    The dataset is not loaded into memory as a dense matrix upfront, unless
+    it is smaller than dense_threshold_gb as a dense float32 matrix.  Instead,
+    the DataLoaders only transform the sparse matrix to a dense one when a
+    minibatch is loaded.  This is slower, but necessary for datasets which
+    are too large to be loaded into memory as a dense matrix all at once.
 
     Args:
         dataset: Matrix of gene counts, where rows are cell barcodes and
@@ -144,6 +251,17 @@ def prep_sparse_data_for_training(dataset: sp.csr.csr_matrix,
         shuffle: Passed as an argument to torch.utils.data.DataLoader.  If
             True, the data is reshuffled at every epoch.
         use_cuda: If True, the data loader will load tensors on GPU.
+        empty_sampling: How empty droplets are sampled for each minibatch.
+            'uniform' samples them uniformly, and 'umi' in proportion to their
+            (transformed) total counts.  'umi' sampling is not corrected for
+            in the ELBO, so it weights empty droplets by their counts.
+        dense_threshold_gb: If the datasets take less than this many GB as
+            dense float32 tensors, they are kept on the device (the GPU, with
+            use_cuda) as dense tensors, and minibatches are selected from
+            them by index.  Zero always densifies minibatches from the sparse
+            matrices.
+        sparse_batches: If True (and the data is not kept dense), minibatches
+            are sparse CSR torch.Tensors, which the encoders use directly.
 
     Returns:
         train_loader: torch.utils.data.DataLoader object for training set.
@@ -171,6 +289,18 @@ def prep_sparse_data_for_training(dataset: sp.csr.csr_matrix,
     test_indices_empty = [idx for idx in range(empty_drop_dataset.shape[0])
                           if not training_mask_empty[idx]]
 
+    assert empty_sampling in ['uniform', 'umi'], \
+        f"Unknown empty_sampling '{empty_sampling}'."
+
+    # Keep the data as resident dense tensors if they are small enough.
+    dense_gb = get_resident_gb(dataset, empty_drop_dataset,
+                               dense_threshold_gb=dense_threshold_gb,
+                               sparse_batches=sparse_batches)
+    dense = dense_gb > 0
+    if dense:
+        logging.info(f"Keeping the count matrix as a dense tensor "
+                     f"({dense_gb:.2f} GB) for training.")
+
     # Set up training dataloader.
     train_dataset = dataset[training_indices, ...]
     train_dataset_empty = empty_drop_dataset[training_indices_empty, ...]
@@ -179,7 +309,11 @@ def prep_sparse_data_for_training(dataset: sp.csr.csr_matrix,
                               batch_size=batch_size,
                               fraction_empties=fraction_empties,
                               shuffle=shuffle,
-                              use_cuda=use_cuda)
+                              use_cuda=use_cuda,
+                              empty_weights=get_empty_weights(train_dataset_empty,
+                                                              empty_sampling),
+                              dense=dense,
+                              sparse=sparse_batches)
 
     # Set up test dataloader.
     test_dataset = dataset[test_indices, ...]
@@ -189,11 +323,83 @@ def prep_sparse_data_for_training(dataset: sp.csr.csr_matrix,
                              batch_size=batch_size,
                              fraction_empties=fraction_empties,
                              shuffle=shuffle,
-                             use_cuda=use_cuda)
+                             use_cuda=use_cuda,
+                             empty_weights=get_empty_weights(test_dataset_empty,
+                                                             empty_sampling),
+                             dense=dense,
+                             sparse=sparse_batches)
 
     return train_loader, test_loader
 
 
+def get_resident_gb(dataset: sp.csr.csr_matrix,
+                    empty_drop_dataset: sp.csr.csr_matrix,
+                    dense_threshold_gb: float,
+                    sparse_batches: bool = False) -> float:
+    """Size in GB of the dense data the DataLoaders keep on the device.
+
+    Args:
+        dataset: Matrix of gene counts of cell barcodes.
+        empty_drop_dataset: Matrix of gene counts of empty droplets.
+        dense_threshold_gb: Data is kept dense if it takes less than this.
+        sparse_batches: If True, data is never kept dense.
+
+    Returns:
+        Size of both matrices as one dense float32 tensor, or zero if
+        minibatches are instead loaded from the sparse matrices.
+
+    """
+
+    dense_gb = 4 * dataset.shape[1] * (dataset.shape[0]
+                                       + empty_drop_dataset.shape[0]) / 1e9
+    if (dense_gb < dense_threshold_gb) and not sparse_batches:
+        return dense_gb
+    return 0.
+
+
+def get_empty_weights(empty_drop_dataset: sp.csr.csr_matrix,
+                      empty_sampling: str = 'uniform') -> Union[np.ndarray, None]:
+    """Weights for sampling empty droplets, or None for uniform sampling.
+
+    Note:
+        There is no importance weight in the ELBO to undo 'umi' sampling.
+        The cell indicator y is enumerated, and pyro only allows a scalar
+        poutine.scale for enumerated sites, so rows cannot be rescaled.
+
+    """
+
+    if (empty_sampling == 'uniform') or (empty_drop_dataset.shape[0] == 0):
+        return None
+
+    # Weight by total counts, with a floor so that every droplet can be drawn.
+    counts = np.asarray(empty_drop_dataset.sum(axis=1), dtype=np.float64).ravel()
+    return np.maximum(counts, 1.)
+
+
+def densify(matrix: sp.csr.csr_matrix, chunk_size: int = 10000) -> torch.Tensor:
+    """Convert a sparse matrix to a dense float32 torch.Tensor.
+
+    Rows are converted in chunks, so that no dense copy other than the output
+    (e.g. in the dtype of the count data) is made.
+
+    """
+
+    out = np.zeros(matrix.shape, dtype=np.float32)
+    for i in range(0, matrix.shape[0], chunk_size):
+        out[i:(i + chunk_size)] = matrix[i:(i + chunk_size)].toarray()
+    return torch.from_numpy(out)
+
+
+def sparse_csr_collate(matrix: sp.csr.csr_matrix) -> torch.Tensor:
+    """Load a minibatch of sparse data as a sparse CSR torch.Tensor."""
+
+    matrix = sp.csr_matrix(matrix)
+    return torch.sparse_csr_tensor(torch.from_numpy(matrix.indptr.astype(np.int64)),
+                                   torch.from_numpy(matrix.indices.astype(np.int64)),
+                                   torch.from_numpy(matrix.data.astype(np.float32)),
+                                   size=matrix.shape)
+
+
 def sparse_collate(batch: List[Tuple[sp.csr.csr_matrix]]) -> torch.Tensor:
     """Load a minibatch of sparse data as a dense torch.Tensor in memory.
 
@@ -6,19 +6,27 @@ import scipy.sparse as sp
 import scipy.io as io
 import cellbender.remove_background.model
 import cellbender.remove_background.data.transform as trans
+import cellbender.remove_background.data.cache as cache
+from cellbender.remove_background.data.barcodes import PackedBarcodes, \
+    pack_barcodes
 from sklearn.decomposition import PCA
 import torch
-from scipy.stats import mode
 
-from typing import Dict, List, Union, Tuple
+from typing import Dict, List, Union, Tuple, Iterator
+import gzip
 import logging
 import os
+import warnings
 
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt  # This needs to be after matplotlib.use('Agg')
 
 
+# Options of the input file parsers, which are part of the keys of cached data.
+PARSE_OPTIONS = {'feature_type': 'Gene Expression'}
+
+
 class Dataset:
     """Object for storing scRNA-seq count matrix data and basic manipulations.
 
@@ -32,6 +40,17 @@ class Dataset:
         gene_blacklist: List of integer indices of genes to exclude entirely.
         low_count_threshold: Droplets with UMI counts below this number are
             excluded entirely from the analysis.
+        cache_dir: Directory in which to cache the parsed input file, so that
+            later runs on the same file load faster.  None disables caching.
+        cache_size_gb: Maximum size of the cache directory in GB.  Least
+            recently used entries are evicted beyond this.
+        use_packed_barcodes: If True, barcodes are kept in memory packed two
+            bits per base (see data.barcodes), and decoded only for output.
+        max_empty_droplets: Maximum number of empty droplets kept for
+            training.  If there are more, a sample stratified by UMI count is
+            kept.  None keeps all of them.
+        rare_gene_threshold: Genes with fewer total counts than this are
+            pooled into bins for inference.  None pools no genes.
 
     Attributes:
         input_file: Name of data source file.
@@ -41,7 +60,15 @@ class Dataset:
         analyzed_gene_inds: numpy.ndarray of indices that denote which genes, as
             indexed in the original dataset, are (nonzero and) being used in the
             inference procedure.
+        gene_pool_inds: numpy.ndarray with, for each analyzed gene, the column
+            of the count matrices used for inference which holds its counts.
+            Rare genes share a column (a pooled bin).  None if genes are not
+            pooled, in which case each analyzed gene is its own column.
+        gene_pool_weights: numpy.ndarray with, for each analyzed gene, its
+            fraction of the total counts of its column.  None if genes are
+            not pooled.
         data: Loaded data as a dict, with ['matrix', 'barcodes', 'gene_names'].
+            Barcodes are a numpy array, or PackedBarcodes.
         is_trimmed: This gets set to True after running
             trim_dataset_for_analysis().
         model_name: Name of model being run.
@@ -60,11 +87,21 @@ class Dataset:
                  fraction_empties: float = 0.5,
                  model_name: str = None,
                  gene_blacklist: List[int] = [],
-                 low_count_threshold: int = 30):
+                 low_count_threshold: int = 30,
+                 cache_dir: Union[str, None] = None,
+                 cache_size_gb: float = 20.,
+                 use_packed_barcodes: bool = False,
+                 max_empty_droplets: Union[int, None] = None,
+                 rare_gene_threshold: Union[int, None] = None):
         super(Dataset, self).__init__()
         self.input_file = input_file
+        self.cache_dir = cache_dir
+        self.cache_size_gb = cache_size_gb
+        self.use_packed_barcodes = use_packed_barcodes
         self.analyzed_barcode_inds = np.array([])  # Barcodes trained each epoch
         self.analyzed_gene_inds = np.array([])
+        self.gene_pool_inds = None
+        self.gene_pool_weights = None
         self.empty_barcode_inds = np.array([])  # Barcodes randomized in training
         self.data = None
         self.model_name = model_name
@@ -94,7 +131,9 @@ class Dataset:
         # Trim the dataset.
         self._trim_dataset_for_analysis(num_transition_barcodes=num_transition_barcodes,
                                         low_UMI_count_cutoff=low_count_threshold,
-                                        gene_blacklist=gene_blacklist)
+                                        gene_blacklist=gene_blacklist,
+                                        max_empty_droplets=max_empty_droplets,
+                                        rare_gene_threshold=rare_gene_threshold)
 
         # Estimate priors.
         self._estimate_priors()
@@ -106,18 +145,42 @@ class Dataset:
         if self.input_file is None:
             return
 
-        logging.info(f"Loading data from file {self.input_file}")
+        # Use the cached, already parsed data if there is any.
+        if self.cache_dir is not None:
+            self.data = cache.load_from_cache(self.cache_dir, self.input_file,
+                                              parse_options=PARSE_OPTIONS)
 
-        # Load the dataset.
-        if os.path.isdir(self.input_file):
-            self.data = get_matrix_from_mtx(self.input_file)
-        else:
-            self.data = get_matrix_from_h5(self.input_file)
+        if self.data is None:
+
+            logging.info(f"Loading data from file {self.input_file}")
+
+            # Load the dataset.
+            if os.path.isdir(self.input_file):
+                self.data = get_matrix_from_mtx(self.input_file)
+            else:
+                self.data = get_matrix_from_h5(self.input_file)
+
+            # Cache the parsed data for next time.
+            if self.cache_dir is not None:
+                cache.save_to_cache(self.cache_dir, self.input_file, self.data,
+                                    max_size_gb=self.cache_size_gb,
+                                    parse_options=PARSE_OPTIONS)
+
+        # Pack barcodes, if possible.
+        if self.use_packed_barcodes:
+            packed = pack_barcodes(self.data['barcodes'])
+            if packed is not None:
+                self.data['barcodes'] = packed
+            else:
+                logging.info("Barcodes are not all nucleotide sequences of "
+                             "the same length, so are not packed.")
 
     def _trim_dataset_for_analysis(self,
                                    low_UMI_count_cutoff: int = 30,
                                    num_transition_barcodes: Union[int, None] = 7000,
-                                   gene_blacklist: List[int] = []):
+                                   gene_blacklist: List[int] = [],
+                                   max_empty_droplets: Union[int, None] = None,
+                                   rare_gene_threshold: Union[int, None] = None):
         """Trim the dataset for inference, choosing barcodes and genes to use.
 
         Sets the values of self.analyzed_barcode_inds, and
@@ -129,6 +192,14 @@ class Dataset:
             num_transition_barcodes: Number of uncertain droplets to include
                 during inference.
             gene_blacklist: List of gene indices to trim out and exclude.
+            max_empty_droplets: Maximum number of empty droplets to use during
+                inference.  If there are more, a sample stratified by UMI
+                count is used, so that the distribution of empty droplet
+                counts seen by the model is preserved.  None uses all of them.
+            rare_gene_threshold: Analyzed genes with fewer total counts than
+                this are pooled into bins, each with about this many total
+                counts, which the model treats as single genes.  Outputs are
+                redistributed to the genes in each bin.  None pools no genes.
 
         Note:
             self.priors['n_cells'] is only used to choose which barcodes to
@@ -144,17 +215,16 @@ class Dataset:
 
         logging.info("Trimming dataset for inference.")
 
-        # Get data matrix and barcode order that sorts barcodes by UMI count.
+        # Get data matrix and UMI counts per barcode.
         matrix = self.data['matrix']
         umi_counts = np.array(matrix.sum(axis=1)).squeeze()
-        umi_count_order = np.argsort(umi_counts)[::-1]
 
         # Initially set the default to be the whole dataset.
         self.analyzed_barcode_inds = np.arange(start=0, stop=matrix.shape[0])
         self.analyzed_gene_inds = np.arange(start=0, stop=matrix.shape[1])
 
         # Expected cells must not exceed nonzero count barcodes.
-        num_nonzero_barcodes = np.sum(umi_counts > 0).item()
+        num_nonzero_barcodes = np.count_nonzero(umi_counts)
         n_cells = min(self.priors['n_cells'], num_nonzero_barcodes)
 
         try:
@@ -162,19 +232,28 @@ class Dataset:
             # Choose which genes to use based on their having nonzero counts.
             # (All barcodes must be included so that inference can generalize.)
             gene_counts_per_barcode = np.array(matrix.sum(axis=0)).squeeze()
-            self.analyzed_gene_inds = np.where(gene_counts_per_barcode
-                                               > 0)[0].astype(dtype=int)
-
-            if len(gene_blacklist) > 0:
+            gene_mask = gene_counts_per_barcode > 0
 
-                # Ensure genes on the blacklist are excluded.
-                self.analyzed_gene_inds = np.array([g for g in
-                                                    self.analyzed_gene_inds
-                                                    if g not in gene_blacklist])
+            # Ensure genes on the blacklist are excluded.
+            gene_mask &= ~np.isin(np.arange(gene_mask.size), gene_blacklist)
+            self.analyzed_gene_inds = np.flatnonzero(gene_mask)
 
         except IndexError:
             logging.warning("Something went wrong trying to trim genes.")
 
+        # Pool rare genes into bins, so the model only has to be as wide as
+        # the number of informative genes.
+        self.gene_pool_inds = None
+        self.gene_pool_weights = None
+        if rare_gene_threshold is not None:
+            gene_counts = np.array(matrix.sum(axis=0)).squeeze()
+            self.gene_pool_inds, self.gene_pool_weights = \
+                get_gene_pools(gene_counts[self.analyzed_gene_inds],
+                               threshold=rare_gene_threshold)
+            logging.info(f"Pooling genes with fewer than {rare_gene_threshold} "
+                         f"counts: inference uses {self.get_num_model_genes()} "
+                         f"of {self.analyzed_gene_inds.size} genes.")
+
         # Estimate priors on cell size and 'empty' droplet size.
         self.priors['cell_counts'], self.priors['empty_counts'] = \
             get_d_priors_from_dataset(self)  # After gene trimming
@@ -182,17 +261,13 @@ class Dataset:
         # If running the simple model, just use the expected cells, no more.
         if self.model_name == "simple":
 
-            self.analyzed_barcode_inds = np.array(umi_count_order[:n_cells],
-                                                  dtype=int)
+            self.analyzed_barcode_inds = get_top_k_inds(umi_counts, n_cells)
 
         # If not using the simple model, include empty droplets.
         else:
 
             try:
 
-                # Get the cell barcodes.
-                cell_barcodes = umi_count_order[:n_cells]
-
                 # Set the low UMI count cutoff to be the greater of either
                 # the user input value, or an empirically-derived value.
                 empirical_low_UMI = int(self.priors['empty_counts'] * 0.8)
@@ -202,43 +277,47 @@ class Dataset:
                              f"{low_UMI_count_cutoff}")
 
                 # See how many barcodes there are to work with total.
+                above_umi_cutoff = umi_counts > low_UMI_count_cutoff
                 num_barcodes_above_umi_cutoff = \
-                    np.sum(umi_counts > low_UMI_count_cutoff).item()
+                    np.count_nonzero(above_umi_cutoff)
 
                 # Get a number of transition-region barcodes.
                 num = min(num_transition_barcodes,
-                          num_barcodes_above_umi_cutoff - cell_barcodes.size)
+                          num_barcodes_above_umi_cutoff - n_cells)
                 num = max(0, num)
-                transition_barcodes = umi_count_order[n_cells:
-                                                      (n_cells + num)]
+
+                # Only the top-ranked cell and transition barcodes are sorted.
+                top_barcodes = get_top_k_inds(umi_counts, n_cells + num)
+                cell_barcodes = top_barcodes[:n_cells]
+                transition_barcodes = top_barcodes[n_cells:]
 
                 # Use the cell barcodes and transition barcodes for analysis.
-                self.analyzed_barcode_inds = np.concatenate((
-                    cell_barcodes,
-                    transition_barcodes)).astype(dtype=int)
+                self.analyzed_barcode_inds = top_barcodes
 
                 # Identify probable empty droplet barcodes.
                 if num < num_transition_barcodes:
 
                     # This means we already used all the barcodes.
-                    empty_droplet_barcodes = np.array([])
+                    empty_droplet_barcodes = np.array([], dtype=int)
 
                 else:
 
-                    # Decide which empty barcodes to include.
-                    empty_droplet_sorted_barcode_inds = \
-                        np.arange(n_cells + num, num_barcodes_above_umi_cutoff,
-                                  dtype=int)  # The entire range
-                    # empty_droplet_sorted_barcode_inds = \
-                    #     np.arange(n_cells + num,
-                    #               min(num_barcodes_above_umi_cutoff
-                    #                   - cell_barcodes.size - num,
-                    #                   n_cells + num + num_empty_droplets),
-                    #               dtype=int)
-                    empty_droplet_barcodes = \
-                        umi_count_order[empty_droplet_sorted_barcode_inds]
-
-                self.empty_barcode_inds = empty_droplet_barcodes.astype(dtype=int)
+                    # All remaining barcodes above the cutoff, in index order.
+                    above_umi_cutoff[top_barcodes] = False
+                    empty_droplet_barcodes = np.flatnonzero(above_umi_cutoff)
+
+                    # Keep a bounded, representative sample of empty droplets.
+                    if (max_empty_droplets is not None) \
+                            and (empty_droplet_barcodes.size > max_empty_droplets):
+                        logging.info(f"Sampling {max_empty_droplets} of "
+                                     f"{empty_droplet_barcodes.size} empty "
+                                     f"droplets, stratified by UMI count.")
+                        empty_droplet_barcodes = empty_droplet_barcodes[
+                            get_stratified_sample_inds(
+                                umi_counts[empty_droplet_barcodes],
+                                max_empty_droplets)]
+
+                self.empty_barcode_inds = empty_droplet_barcodes
 
                 logging.info(f"Using {cell_barcodes.size} probable cell barcodes, "
                              f"plus an additional {transition_barcodes.size} barcodes, "
@@ -298,7 +377,7 @@ class Dataset:
             trimmed_matrix = trimmed_bc_matrix[:, self.analyzed_gene_inds].tocsr()
 
             # Apply transformation to the count data.
-            return self.transformation.transform(trimmed_matrix)
+            return self.transformation.transform(self._pool_genes(trimmed_matrix))
 
         else:
             logging.warning("Using full count matrix, without any trimming.  "
@@ -318,7 +397,7 @@ class Dataset:
             trimmed_matrix = trimmed_bc_matrix[:, self.analyzed_gene_inds].tocsr()
 
             # Apply transformation to the count data.
-            return self.transformation.transform(trimmed_matrix)
+            return self.transformation.transform(self._pool_genes(trimmed_matrix))
 
         else:
             logging.error("Trying to get empty count matrix without trimmed data.")
@@ -336,7 +415,7 @@ class Dataset:
             trimmed_matrix = trimmed_bc_matrix[:, self.analyzed_gene_inds].tocsr()
 
             # Apply transformation to the count data.
-            return self.transformation.transform(trimmed_matrix)
+            return self.transformation.transform(self._pool_genes(trimmed_matrix))
 
         else:
             logging.warning("Using full count matrix, without any trimming.  "
@@ -345,10 +424,118 @@ class Dataset:
             # Apply transformation to the count data.
             return self.transformation.transform(self.data['matrix'])
 
+    def get_count_matrix_chunks(self,
+                                barcode_inds: Union[np.ndarray, None] = None,
+                                chunk_size: int = 1000) \
+            -> Iterator[sp.csr.csr_matrix]:
+        """Iterate over chunks of barcodes of the count matrix.
+
+        Each chunk is trimmed to the analyzed genes (if trimming has occurred)
+        and transformed, so that only one chunk of the transformed count matrix
+        is ever held in memory.
+
+        Args:
+            barcode_inds: Indices of the barcodes (rows of the original count
+                matrix) to iterate over, in order.  If None, all barcodes are
+                used.
+            chunk_size: Number of barcodes in each chunk.
+
+        Yields:
+            Transformed count matrix for the next chunk of barcodes.
+
+        """
+
+        matrix = self.data['matrix']
+        if barcode_inds is None:
+            n_barcodes = matrix.shape[0]
+        else:
+            n_barcodes = barcode_inds.size
+
+        for start in range(0, n_barcodes, chunk_size):
+            end = min(n_barcodes, start + chunk_size)
+
+            # Slicing a contiguous range of rows of a csr_matrix is cheap.
+            if barcode_inds is None:
+                chunk = matrix[start:end, :]
+            else:
+                chunk = matrix[barcode_inds[start:end], :]
+
+            if self.is_trimmed:
+                chunk = self._pool_genes(chunk[:, self.analyzed_gene_inds])
+
+            # Apply transformation to the count data.
+            yield self.transformation.transform(chunk)
+
+    def get_num_model_genes(self) -> int:
+        """Number of genes (columns of the count matrices) used for inference."""
+
+        if self.gene_pool_inds is None:
+            return self.analyzed_gene_inds.size
+        return int(self.gene_pool_inds.max()) + 1
+
+    def _get_gene_pooling_matrix(self) -> sp.csr.csr_matrix:
+        """Matrix which sums analyzed genes into the columns used for inference."""
+
+        return sp.csr_matrix((np.ones(self.gene_pool_inds.size),
+                              (np.arange(self.gene_pool_inds.size),
+                               self.gene_pool_inds)),
+                             shape=(self.gene_pool_inds.size,
+                                    self.get_num_model_genes()))
+
+    def _pool_genes(self, matrix: sp.csr.csr_matrix) -> sp.csr.csr_matrix:
+        """Sum the columns (analyzed genes) of a count matrix into bins."""
+
+        if self.gene_pool_inds is None:
+            return matrix
+        return sp.csr_matrix(matrix @ self._get_gene_pooling_matrix(),
+                             dtype=matrix.dtype)
+
+    def unpool_genes(self,
+                     values: np.ndarray,
+                     barcode_inds: Union[np.ndarray, None] = None) -> np.ndarray:
+        """Redistribute values of pooled genes to the analyzed genes.
+
+        The value of a bin is shared between its genes in proportion to the
+        observed counts of each gene in each barcode.  For barcodes with no
+        observed counts in a bin, or if barcode_inds is None, it is shared in
+        proportion to the total counts of each gene in the dataset.
+
+        Args:
+            values: Dense array where rows are barcodes and columns are the
+                genes used for inference (as from get_num_model_genes()).
+            barcode_inds: Indices of the barcodes (rows of the original count
+                matrix) of each row of values.
+
+        Returns:
+            Dense array where rows are barcodes and columns are analyzed genes.
+
+        """
+
+        if self.gene_pool_inds is None:
+            return values
+
+        shares = np.broadcast_to(self.gene_pool_weights,
+                                 (values.shape[0], self.gene_pool_inds.size))
+
+        # Observed fraction of each bin's counts in each barcode, where known.
+        if barcode_inds is not None:
+            observed = self.data['matrix'][barcode_inds, :][:, self.analyzed_gene_inds]
+            observed_bins = (observed @ self._get_gene_pooling_matrix()).toarray()
+            observed_bins = observed_bins[:, self.gene_pool_inds]
+            observed = observed.toarray()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                shares = np.where(observed_bins > 0,
+                                  observed / observed_bins, shares)
+
+        return values[:, self.gene_pool_inds] * shares
+
     def save_to_output_file(self,
                             output_file: str,
                             inferred_model,
-                            save_plots: bool = False) -> bool:
+                            save_plots: bool = False,
+                            compression: Union[str, None] = 'zlib',
+                            complevel: int = 4,
+                            write_h5ad: bool = False) -> bool:
         """Write the results of an inference procedure to an output file.
 
         Output is an HDF5 file.  To be written:
@@ -366,6 +553,11 @@ class Dataset:
                 already had the inference procedure run.
             output_file: Name of output .h5 file
             save_plots: Setting this to True will save plots of outputs.
+            compression: Compression library for output arrays, e.g. 'zlib'
+                or 'blosc', or None for no compression.
+            complevel: Compression level, from 0 (none) to 9 (maximum).
+            write_h5ad: Setting this to True will also write the filtered
+                output (cells only) in AnnData format, as _filtered.h5ad.
 
         Returns:
             True if the output was written to file successfully.
@@ -393,7 +585,7 @@ class Dataset:
         else:
 
             # No need to generate a new count matrix for simple model.
-            inferred_count_matrix = self.data['matrix'].tocsc()
+            inferred_count_matrix = self.data['matrix']
             logging.info("Simple model: outputting un-altered count matrix.")
 
         # TODO: add back in blacklisted genes: their original counts
@@ -402,6 +594,12 @@ class Dataset:
         ambient_expression_trimmed = cellbender.remove_background.model.\
             get_ambient_expression()
 
+        # Share ambient expression of any pooled rare genes among those genes.
+        # (There is no ambient expression for the simple model.)
+        if ambient_expression_trimmed is not None:
+            ambient_expression_trimmed = \
+                self.unpool_genes(ambient_expression_trimmed[np.newaxis, :])[0]
+
         # Convert the indices from trimmed gene set to original gene indices.
         ambient_expression = np.zeros(self.data['matrix'].shape[1])
         ambient_expression[self.analyzed_gene_inds] = ambient_expression_trimmed
@@ -437,7 +635,9 @@ class Dataset:
                                              rho=rho,
                                              phi=phi,
                                              z=z, d=d, p=p,
-                                             loss=inferred_model.loss)
+                                             loss=inferred_model.loss,
+                                             compression=compression,
+                                             complevel=complevel)
 
         # Generate filename for filtered matrix output.
         file_dir, file_base = os.path.split(output_file)
@@ -452,21 +652,48 @@ class Dataset:
 
             cell_barcodes = self.data['barcodes'][cell_barcode_inds]
 
+            # Latents of cells only, shared by the filtered outputs.
+            z_cells = z[filtered_inds_of_analyzed_barcodes, :]
+            d_cells = d[filtered_inds_of_analyzed_barcodes]
+            p_cells = p[filtered_inds_of_analyzed_barcodes]
+
+            # The filtered matrix is written as a selection of rows of the
+            # full matrix, rather than as a copy.
             write_matrix_to_h5(output_file=filtered_output_file,
                                gene_names=self.data['gene_names'],
                                barcodes=cell_barcodes,
-                               inferred_count_matrix=
-                               inferred_count_matrix[cell_barcode_inds, :],
+                               inferred_count_matrix=inferred_count_matrix,
+                               row_inds=cell_barcode_inds,
                                cell_barcode_inds=None,
                                ambient_expression=ambient_expression,
                                rho=rho,
                                phi=phi,
-                               z=z[filtered_inds_of_analyzed_barcodes, :],
-                               d=d[filtered_inds_of_analyzed_barcodes],
-                               p=p[filtered_inds_of_analyzed_barcodes],
-                               loss=inferred_model.loss)
+                               z=z_cells, d=d_cells, p=p_cells,
+                               loss=inferred_model.loss,
+                               compression=compression,
+                               complevel=complevel)
+
+            # Write the same filtered output as an AnnData .h5ad file.
+            if write_h5ad:
+                write_matrix_to_h5ad(output_file=os.path.join(file_dir,
+                                                              file_name
+                                                              + "_filtered.h5ad"),
+                                     gene_names=self.data['gene_names'],
+                                     barcodes=cell_barcodes,
+                                     inferred_count_matrix=
+                                     inferred_count_matrix,
+                                     row_inds=cell_barcode_inds,
+                                     ambient_expression=ambient_expression,
+                                     rho=rho,
+                                     phi=phi,
+                                     z=z_cells, d=d_cells, p=p_cells,
+                                     loss=inferred_model.loss,
+                                     compression=compression,
+                                     complevel=complevel)
 
             # Save barcodes determined to contain cells as _cell_barcodes.csv
+            if isinstance(cell_barcodes, PackedBarcodes):
+                cell_barcodes = cell_barcodes.decode()
             try:
                 barcode_names = np.array([str(cell_barcodes[i], encoding='UTF-8')
                                          for i in range(cell_barcodes.size)])
@@ -546,10 +773,10 @@ def get_matrix_from_mtx(filedir: str) -> Dict[str,
                                                     np.ndarray]]:
     """Load a count matrix from an mtx directory from CellRanger's output.
 
-    The directory must contain three files:
+    The directory must contain three files, each of which may be gzipped:
         matrix.mtx
         barcodes.tsv
-        genes.tsv
+        genes.tsv (CellRanger v2) or features.tsv (CellRanger v3)
     This function returns a dictionary that includes the count matrix, the gene
     names (which correspond to columns of the count matrix), and the barcodes
     (which correspond to rows of the count matrix).
@@ -569,36 +796,190 @@ def get_matrix_from_mtx(filedir: str) -> Dict[str,
             array contains the string names of genes in the genome, which
             correspond to the columns in the out['matrix'].
 
+    Note:
+        As for CellRanger v3 .h5 files, only features of type 'Gene
+        Expression' are kept from a features.tsv file.
+
     """
 
     assert os.path.isdir(filedir), "The directory {filedir} is not accessible."
 
-    # Read in the count matrix using scipy.
-    count_matrix = io.mmread(os.path.join(filedir,
-                                          'matrix.mtx')).tocsr().transpose()
+    # Read in the count matrix, transposed to put barcodes in rows.
+    count_matrix = read_mtx(find_file_in_dir(filedir, ['matrix.mtx']),
+                            transpose=True)
 
-    # Read in gene names.
-    gene_names = np.genfromtxt(fname=os.path.join(filedir, "genes.tsv"),
-                               delimiter="\t", skip_header=0,
-                               dtype='<U50')[:, 1].squeeze()  # second column
+    # Read in gene names (second column) and feature types (v3).
+    gene_file = find_file_in_dir(filedir, ['features.tsv', 'genes.tsv'])
+    gene_columns = read_tsv(gene_file)
+    gene_names = gene_columns[1]
 
     # Read in barcode names.
-    barcodes = np.genfromtxt(fname=os.path.join(filedir, "barcodes.tsv"),
-                             delimiter="\t", skip_header=0, dtype='<U20')
+    barcodes = read_tsv(find_file_in_dir(filedir, ['barcodes.tsv']))[0]
 
     # Issue warnings if necessary, based on dimensions matching.
     if count_matrix.shape[1] != len(gene_names):
-        logging.warning(f"Number of gene names in {filedir}/genes.tsv does not "
+        logging.warning(f"Number of gene names in {gene_file} does not "
                         f"match the number expected from the count matrix.")
     if count_matrix.shape[0] != len(barcodes):
         logging.warning(f"Number of barcodes in {filedir}/barcodes.tsv does not "
                         f"match the number expected from the count matrix.")
 
-    return {'matrix': count_matrix,
+    # Keep only gene expression features (CellRanger v3).
+    if len(gene_columns) > 2:
+        is_gene_expression = (gene_columns[2] == PARSE_OPTIONS['feature_type'])
+        if not is_gene_expression.all():
+            logging.info(f"Keeping {is_gene_expression.sum()} of "
+                         f"{is_gene_expression.size} features, which are of "
+                         f"type 'Gene Expression'.")
+            count_matrix = count_matrix[:, is_gene_expression]
+            gene_names = gene_names[is_gene_expression]
+
+    return {'matrix': compact_count_matrix(count_matrix),
             'gene_names': gene_names,
             'barcodes': barcodes}
 
 
+def compact_count_matrix(matrix: Union[sp.csr.csr_matrix, sp.csc.csc_matrix]
+                         ) -> Union[sp.csr.csr_matrix, sp.csc.csc_matrix]:
+    """Store a count matrix using the smallest dtypes that hold its values.
+
+    Non-negative integer counts are stored as uint16 if they are all below
+    2**16, otherwise as uint32 if they are below 2**32.  Indices and indptr
+    are stored as int32 if the number of nonzero entries and the matrix
+    dimensions allow it.  Non-integer data is left as it is.
+
+    Args:
+        matrix: Sparse count matrix, in csr or csc format.
+
+    Returns:
+        matrix: The same matrix, in the same format, with compact dtypes.
+
+    Note:
+        Sums over the matrix (e.g. matrix.sum(axis=1)) are accumulated by
+        scipy in 64-bit integers, so do not overflow.  Dense minibatches are
+        converted to float32 in sparse_collate().
+
+    """
+
+    data = matrix.data
+
+    # Choose the smallest unsigned integer type that can hold the counts.
+    if (data.size > 0) and (data.dtype.kind in 'iuf'):
+        is_integer = (data.dtype.kind in 'iu') \
+            or np.array_equal(data, np.floor(data))
+        if is_integer and (data.min() >= 0):
+            max_count = data.max()
+            if max_count < 2**16:
+                data = data.astype(np.uint16, copy=False)
+            elif max_count < 2**32:
+                data = data.astype(np.uint32, copy=False)
+
+    # Use 32-bit indices where possible.
+    index_dtype = np.int32 if max(matrix.nnz, *matrix.shape) < 2**31 \
+        else np.int64
+
+    return type(matrix)((data,
+                         matrix.indices.astype(index_dtype, copy=False),
+                         matrix.indptr.astype(index_dtype, copy=False)),
+                        shape=matrix.shape, copy=False)
+
+
+def find_file_in_dir(filedir: str, names: List[str]) -> str:
+    """Find the first of several possible files, plain or gzipped, in filedir.
+
+    Args:
+        filedir: Directory to look in.
+        names: File names to look for, in order of preference.
+
+    Returns:
+        Path to the file.
+
+    """
+
+    for name in names:
+        for file_name in [name, name + '.gz']:
+            if os.path.exists(os.path.join(filedir, file_name)):
+                return os.path.join(filedir, file_name)
+
+    raise FileNotFoundError(f"None of {names} (or gzipped versions) found "
+                            f"in {filedir}")
+
+
+def open_maybe_gzipped(filename: str):
+    """Open a file for reading in binary mode, decompressing if it is .gz"""
+
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def read_tsv(filename: str) -> List[np.ndarray]:
+    """Read the columns of a (possibly gzipped) tab-separated text file.
+
+    Args:
+        filename: Path to the file.
+
+    Returns:
+        List of numpy arrays of strings, one per column.
+
+    """
+
+    with open_maybe_gzipped(filename) as f:
+        lines = f.read().decode('UTF-8').splitlines()
+    rows = [line.split('\t') for line in lines if line != '']
+
+    n_columns = min(len(row) for row in rows) if len(rows) > 0 else 1
+    return [np.array([row[i] for row in rows]) for i in range(n_columns)]
+
+
+def read_mtx(filename: str,
+             transpose: bool = False) -> sp.csr.csr_matrix:
+    """Read a (possibly gzipped) Matrix Market coordinate file as a csr_matrix.
+
+    The file is parsed by scipy.io.mmread(), and the csr_matrix is built from
+    the parsed triplets directly, rather than by converting a coo_matrix.
+
+    Args:
+        filename: Path to the .mtx or .mtx.gz file.
+        transpose: If True, return the transpose of the matrix in the file.
+            For CellRanger output, this puts barcodes in rows.
+
+    Returns:
+        The matrix, as a scipy.sparse.csr_matrix.
+
+    """
+
+    with open_maybe_gzipped(filename) as f:
+        matrix = io.mmread(f)
+    assert sp.issparse(matrix), \
+        f"{filename} is not a Matrix Market coordinate file."
+    matrix = sp.coo_matrix(matrix, copy=False)
+
+    rows, cols = matrix.row, matrix.col
+    n_rows, n_cols = matrix.shape
+    if transpose:
+        rows, cols = cols, rows
+        n_rows, n_cols = n_cols, n_rows
+
+    # CellRanger writes entries sorted by barcode, so with transpose=True the
+    # rows are usually already in order, and indptr can be counted directly.
+    if np.all(rows[1:] >= rows[:-1]):
+        index_dtype = np.int32 if max(matrix.nnz, n_rows, n_cols) < 2**31 \
+            else np.int64
+        indptr = np.zeros(n_rows + 1, dtype=index_dtype)
+        np.cumsum(np.bincount(rows, minlength=n_rows), out=indptr[1:])
+        matrix = sp.csr_matrix((matrix.data, cols.astype(index_dtype), indptr),
+                               shape=(n_rows, n_cols))
+    else:
+        matrix = sp.csr_matrix((matrix.data, (rows, cols)),
+                               shape=(n_rows, n_cols))
+
+    # Summing duplicates, as coo_matrix.tocsr() would.
+    matrix.sum_duplicates()
+
+    return matrix
+
+
 def get_matrix_from_h5(filename: str) -> Dict[str,
                                               Union[sp.csr.csr_matrix,
                                                     List[np.ndarray],
@@ -648,8 +1029,8 @@ def get_matrix_from_h5(filename: str) -> Dict[str,
                 indices = getattr(group, 'indices').read()
                 indptr = getattr(group, 'indptr').read()
                 shape = getattr(group, 'shape').read()
-                csc_list.append(sp.csc_matrix((data, indices, indptr),
-                                              shape=shape))
+                csc_list.append(compact_count_matrix(
+                    sp.csc_matrix((data, indices, indptr), shape=shape)))
                 
                 # Code for v2
                 try:
@@ -667,7 +1048,8 @@ def get_matrix_from_h5(filename: str) -> Dict[str,
                     feature_names = getattr(feature_group, 'name').read()
                     
                     # The only 'feature' we want is 'Gene Expression'
-                    is_gene_expression = (feature_types == b'Gene Expression')
+                    is_gene_expression = \
+                        (feature_types == PARSE_OPTIONS['feature_type'].encode())
                     gene_names.extend(feature_names[is_gene_expression])
                     
                     # Excise other 'features' from the count matrix
@@ -684,7 +1066,7 @@ def get_matrix_from_h5(filename: str) -> Dict[str,
 
     # Put the data from all genomes together (for v2 datasets).
     count_matrix = sp.vstack(csc_list, format='csc')
-    count_matrix = count_matrix.transpose().tocsr()
+    count_matrix = compact_count_matrix(count_matrix.transpose().tocsr())
 
     # Issue warnings if necessary, based on dimensions matching.
     if count_matrix.shape[1] != len(gene_names):
@@ -709,7 +1091,8 @@ def get_matrix_from_h5(filename: str) -> Dict[str,
 def write_matrix_to_h5(output_file: str,
                        gene_names: np.ndarray,
                        barcodes: np.ndarray,
-                       inferred_count_matrix: sp.csc.csc_matrix,
+                       inferred_count_matrix: sp.csr.csr_matrix,
+                       row_inds: Union[np.ndarray, None] = None,
                        cell_barcode_inds: Union[np.ndarray, None] = None,
                        ambient_expression: Union[np.ndarray, None] = None,
                        rho: Union[np.ndarray, None] = None,
@@ -717,15 +1100,20 @@ def write_matrix_to_h5(output_file: str,
                        z: Union[np.ndarray, None] = None,
                        d: Union[np.ndarray, None] = None,
                        p: Union[np.ndarray, None] = None,
-                       loss: Union[Dict, None] = None) -> bool:
+                       loss: Union[Dict, None] = None,
+                       compression: Union[str, None] = 'zlib',
+                       complevel: int = 4) -> bool:
     """Write count matrix data to output HDF5 file using CellRanger format.
 
     Args:
         output_file: Path to output .h5 file (e.g., 'output.h5').
         gene_names: Name of each gene (column of count matrix).
-        barcodes: Name of each barcode (row of count matrix).
+        barcodes: Name of each barcode (row of count matrix that is written).
         inferred_count_matrix: Count matrix to be written to file, in sparse
-            format.  Rows are barcodes, columns are genes.
+            csr_matrix format.  Rows are barcodes, columns are genes.
+        row_inds: Rows of inferred_count_matrix to write, in order.  None
+            writes all rows.  Rows are selected as they are written, so the
+            selected matrix is never held in memory.
         cell_barcode_inds: Indices into the original cell barcode array that
             were found to contain cells.
         ambient_expression: Vector of gene expression of the ambient RNA
@@ -736,27 +1124,46 @@ def write_matrix_to_h5(output_file: str,
         d: Latent encoding of cell size scale factor.
         p: Latent encoding of the probability that a barcode contains a cell.
         loss: Training and test error, as ELBO, for each epoch.
+        compression: Compression library used by PyTables, e.g. 'zlib' or
+            'blosc'.  None or 'none' writes uncompressed (but chunked) arrays.
+        complevel: Compression level, from 0 (none) to 9 (maximum).
 
     Note:
         To match the CellRanger .h5 files, the matrix is stored as its
-        transpose, with rows as genes and cell barcodes as columns.
+        transpose, with rows as genes and cell barcodes as columns.  A
+        csr_matrix of barcodes by genes has exactly the same data, indices,
+        and indptr as the csc_matrix of its transpose, so these are written
+        directly.  Other sparse formats are accepted, but are first converted
+        to csr_matrix.
+        Arrays are written as chunked, compressed CArrays.  Files written
+        with 'zlib' compression can be read by any HDF5 reader, while 'blosc'
+        requires the blosc filter plugin outside of PyTables.
 
     """
 
-    assert isinstance(inferred_count_matrix,
-                      sp.csc_matrix), "The count matrix must be csc_matrix " \
-                                      "format in order to write to HDF5."
+    assert sp.issparse(inferred_count_matrix), \
+        "The count matrix must be a scipy.sparse matrix in order to write " \
+        "to HDF5."
 
     assert gene_names.size == inferred_count_matrix.shape[1], \
         "The number of gene names must match the number of columns in the count" \
         "matrix."
 
-    assert barcodes.size == inferred_count_matrix.shape[0], \
+    n_rows = inferred_count_matrix.shape[0] if row_inds is None \
+        else len(row_inds)
+    assert barcodes.size == n_rows, \
         "The number of barcodes must match the number of rows in the count" \
         "matrix."
 
-    # This reverses the role of rows and columns, to match CellRanger format.
-    inferred_count_matrix = inferred_count_matrix.transpose().tocsc()
+    # CellRanger format is the csc_matrix of genes by barcodes, which is
+    # stored identically to the csr_matrix of barcodes by genes.
+    if not isinstance(inferred_count_matrix, sp.csr_matrix):
+        inferred_count_matrix = inferred_count_matrix.tocsr()
+    if not inferred_count_matrix.has_sorted_indices:
+        inferred_count_matrix.sort_indices()
+
+    # Set up compression of the output arrays.
+    filters = get_output_filters(compression=compression, complevel=complevel)
 
     # Write to output file.
     try:
@@ -768,35 +1175,43 @@ def write_matrix_to_h5(output_file: str,
                                    "Counts after background correction")
 
             # Create arrays within that group for barcodes and gene_names.
-            f.create_array(group, "gene_names", gene_names)
-            f.create_array(group, "genes", np.arange(gene_names.size))  # For compatibility, added post PR
-            f.create_array(group, "barcodes", barcodes)
+            create_chunked_array(f, group, filters, "gene_names", gene_names)
+            create_chunked_array(f, group, filters, "genes",
+                                 np.arange(gene_names.size))  # For compatibility, added post PR
+            create_barcode_array(f, group, filters, "barcodes", barcodes)
 
             # Create arrays to store the count data.
-            f.create_array(group, "data", inferred_count_matrix.data)
-            f.create_array(group, "indices", inferred_count_matrix.indices)
-            f.create_array(group, "indptr", inferred_count_matrix.indptr)
-            f.create_array(group, "shape", inferred_count_matrix.shape)
+            write_csr_rows(f, group, filters, inferred_count_matrix, row_inds)
+            f.create_array(group, "shape",
+                           (inferred_count_matrix.shape[1], n_rows),
+                           track_times=False)
 
             # Store background gene expression, barcode_inds, z, d, and p.
             if cell_barcode_inds is not None:
-                f.create_array(group, "barcode_indices_for_latents",
-                               cell_barcode_inds)
+                create_chunked_array(f, group, filters,
+                                     "barcode_indices_for_latents",
+                                     cell_barcode_inds)
             if ambient_expression is not None:
-                f.create_array(group, "ambient_expression", ambient_expression)
+                create_chunked_array(f, group, filters, "ambient_expression",
+                                     ambient_expression)
             if z is not None:
-                f.create_array(group, "latent_gene_encoding", z)
+                create_chunked_array(f, group, filters, "latent_gene_encoding",
+                                     z)
             if d is not None:
-                f.create_array(group, "latent_scale", d)
+                create_chunked_array(f, group, filters, "latent_scale", d)
             if p is not None:
-                f.create_array(group, "latent_cell_probability", p)
+                create_chunked_array(f, group, filters,
+                                     "latent_cell_probability", p)
             if rho is not None:
-                f.create_array(group, "contamination_fraction_params", rho)
+                create_chunked_array(f, group, filters,
+                                     "contamination_fraction_params", rho)
             if phi is not None:
-                f.create_array(group, "overdispersion_params", phi)
+                create_chunked_array(f, group, filters,
+                                     "overdispersion_params", phi)
             if loss is not None:
-                f.create_array(group, "training_elbo_per_epoch",
-                               np.array(loss['train']['elbo']))
+                create_chunked_array(f, group, filters,
+                                     "training_elbo_per_epoch",
+                                     np.array(loss['train']['elbo']))
 
         logging.info(f"Succeeded in writing output to file {output_file}")
 
@@ -810,6 +1225,558 @@ def write_matrix_to_h5(output_file: str,
         return False
 
 
+def write_matrix_to_h5ad(output_file: str,
+                         gene_names: np.ndarray,
+                         barcodes: np.ndarray,
+                         inferred_count_matrix: sp.csr.csr_matrix,
+                         row_inds: Union[np.ndarray, None] = None,
+                         ambient_expression: Union[np.ndarray, None] = None,
+                         rho: Union[np.ndarray, None] = None,
+                         phi: Union[np.ndarray, None] = None,
+                         z: Union[np.ndarray, None] = None,
+                         d: Union[np.ndarray, None] = None,
+                         p: Union[np.ndarray, None] = None,
+                         loss: Union[Dict, None] = None,
+                         compression: Union[str, None] = 'zlib',
+                         complevel: int = 4) -> bool:
+    """Write count matrix data to output file in AnnData .h5ad format.
+
+    The file can be read by anndata.read_h5ad() (and so by scanpy) without
+    any conversion, but anndata is not needed to write it.
+
+    Args:
+        output_file: Path to output .h5ad file (e.g., 'output.h5ad').
+        gene_names: Name of each gene (column of count matrix).
+        barcodes: Name of each barcode (row of count matrix that is written).
+        inferred_count_matrix: Count matrix to be written to file, in sparse
+            format.  Rows are barcodes, columns are genes.
+        row_inds: Rows of inferred_count_matrix to write, in order.  None
+            writes all rows.
+        ambient_expression: Vector of gene expression of the ambient RNA
+            background counts that contaminate cell counts.
+        rho: Hyperparameters for the contamination fraction distribution.
+        phi: Hyperparameters for the overdispersion distribution.
+        z: Latent encoding of gene expression.
+        d: Latent encoding of cell size scale factor.
+        p: Latent encoding of the probability that a barcode contains a cell.
+        loss: Training and test error, as ELBO, for each epoch.
+        compression: Compression library used by PyTables, e.g. 'zlib' or
+            'blosc'.  None or 'none' writes uncompressed (but chunked) arrays.
+        complevel: Compression level, from 0 (none) to 9 (maximum).
+
+    Note:
+        The count matrix is stored as X in CSR format, with barcodes as obs
+        and genes as var.  The latent gene encoding z is stored in
+        obsm['latent_gene_encoding'], d and p are columns of obs, ambient
+        expression is a column of var, and the remaining hyperparameters are
+        stored in uns.
+
+    """
+
+    inferred_count_matrix = sp.csr_matrix(inferred_count_matrix)
+    if not inferred_count_matrix.has_sorted_indices:
+        inferred_count_matrix.sort_indices()
+
+    assert gene_names.size == inferred_count_matrix.shape[1], \
+        "The number of gene names must match the number of columns in the count" \
+        "matrix."
+
+    n_rows = inferred_count_matrix.shape[0] if row_inds is None \
+        else len(row_inds)
+    assert barcodes.size == n_rows, \
+        "The number of barcodes must match the number of rows in the count" \
+        "matrix."
+
+    # Set up compression of the output arrays.
+    filters = get_output_filters(compression=compression, complevel=complevel)
+
+    # Columns of the obs and var dataframes.
+    obs = {}
+    if d is not None:
+        obs['latent_scale'] = d
+    if p is not None:
+        obs['latent_cell_probability'] = p
+    var = {}
+    if ambient_expression is not None:
+        var['ambient_expression'] = ambient_expression
+
+    # Unstructured annotation.
+    uns = {}
+    if rho is not None:
+        uns['contamination_fraction_params'] = rho
+    if phi is not None:
+        uns['overdispersion_params'] = phi
+    if loss is not None:
+        uns['training_elbo_per_epoch'] = np.array(loss['train']['elbo'])
+
+    # Write to output file.
+    try:
+        with warnings.catch_warnings():
+
+            # AnnData attribute names, like 'encoding-type', are not valid
+            # Python identifiers, which PyTables warns about.
+            warnings.simplefilter('ignore', tables.NaturalNameWarning)
+
+            with tables.open_file(output_file, "w") as f:
+
+                set_h5ad_encoding(f.root, 'anndata', '0.1.0')
+
+                # Count matrix.
+                group = f.create_group("/", "X")
+                set_h5ad_encoding(group, 'csr_matrix', '0.1.0')
+                group._v_attrs['shape'] = \
+                    np.array([n_rows, inferred_count_matrix.shape[1]])
+                write_csr_rows(f, group, filters, inferred_count_matrix,
+                               row_inds)
+
+                # Barcode and gene annotations.
+                write_h5ad_dataframe(f, "obs", filters, barcodes, obs)
+                write_h5ad_dataframe(f, "var", filters, gene_names, var)
+
+                # Latent encoding, hyperparameters, and empty placeholders.
+                for name, contents in [('obsm', {'latent_gene_encoding': z}),
+                                       ('uns', uns),
+                                       ('varm', {}), ('obsp', {}),
+                                       ('varp', {}), ('layers', {})]:
+                    group = f.create_group("/", name)
+                    set_h5ad_encoding(group, 'dict', '0.1.0')
+                    for key, value in contents.items():
+                        if value is not None:
+                            set_h5ad_encoding(create_chunked_array(f, group,
+                                                                   filters,
+                                                                   key, value),
+                                              'array', '0.2.0')
+
+        logging.info(f"Succeeded in writing output to file {output_file}")
+
+        return True
+
+    except Exception:
+        logging.warning(f"Encountered an error writing output to file "
+                        f"{output_file}.  "
+                        "Output may be incomplete.")
+
+        return False
+
+
+def write_csr_rows(f: tables.File,
+                   group: tables.Group,
+                   filters: Union[tables.Filters, None],
+                   matrix: sp.csr.csr_matrix,
+                   row_inds: Union[np.ndarray, None] = None,
+                   chunk_rows: int = 10000):
+    """Write rows of a csr_matrix as data, indices, and indptr arrays.
+
+    Rows are selected and appended to the file a chunk at a time, so that
+    a subset of rows can be written from a shared matrix without making a
+    copy of it.
+
+    Args:
+        f: Open PyTables file.
+        group: Group in which to create the arrays.
+        filters: PyTables filters specifying compression, or None.
+        matrix: Matrix with sorted indices.
+        row_inds: Rows of matrix to write, in order.  None writes all rows.
+        chunk_rows: Number of rows selected and appended at a time.
+
+    """
+
+    # The indptr of the selected rows can be computed without the data.
+    row_nnz = np.diff(matrix.indptr)
+    if row_inds is not None:
+        row_nnz = row_nnz[row_inds]
+    indptr = np.zeros(row_nnz.size + 1, dtype=matrix.indptr.dtype)
+    np.cumsum(row_nnz, out=indptr[1:])
+    nnz = int(indptr[-1])
+
+    # Extendable arrays for data and indices, chunked like the other arrays.
+    arrays = {}
+    for name, dtype in [('data', matrix.data.dtype),
+                        ('indices', matrix.indices.dtype)]:
+        chunk = int(max(1, min(max(nnz, 1), 2**18 // dtype.itemsize)))
+        arrays[name] = f.create_earray(group, name,
+                                       atom=tables.Atom.from_dtype(dtype),
+                                       shape=(0,), filters=filters,
+                                       expectedrows=nnz, chunkshape=(chunk,),
+                                       track_times=False)
+
+    # Append the rows a chunk at a time.
+    for i in range(0, row_nnz.size, chunk_rows):
+        if row_inds is None:
+            # Contiguous rows are a view of the matrix arrays.
+            start = matrix.indptr[i]
+            end = matrix.indptr[min(i + chunk_rows, row_nnz.size)]
+            arrays['data'].append(matrix.data[start:end])
+            arrays['indices'].append(matrix.indices[start:end])
+        else:
+            rows = matrix[row_inds[i:(i + chunk_rows)], :]
+            arrays['data'].append(rows.data)
+            arrays['indices'].append(rows.indices)
+
+    create_chunked_array(f, group, filters, "indptr", indptr)
+
+
+def write_h5ad_dataframe(f: tables.File,
+                         name: str,
+                         filters: Union[tables.Filters, None],
+                         index: np.ndarray,
+                         columns: Dict[str, np.ndarray]):
+    """Write a dataframe (obs or var) to an open .h5ad file.
+
+    Args:
+        f: Open PyTables file.
+        name: Name of the dataframe group, 'obs' or 'var'.
+        filters: PyTables filters specifying compression, or None.
+        index: Names of the rows, as strings or bytes.
+        columns: Numeric columns of the dataframe, by name.
+
+    """
+
+    group = f.create_group("/", name)
+    set_h5ad_encoding(group, 'dataframe', '0.2.0')
+    group._v_attrs['_index'] = '_index'
+    group._v_attrs['column-order'] = np.array(list(columns.keys()), dtype='S') \
+        if len(columns) > 0 else np.array([], dtype=np.float64)
+
+    # AnnData reads fixed-length UTF-8 byte strings as str.
+    if not isinstance(index, PackedBarcodes) and (index.dtype.kind != 'S'):
+        index = np.char.encode(index.astype(str), 'UTF-8')
+    set_h5ad_encoding(create_barcode_array(f, group, filters, '_index', index),
+                      'string-array', '0.2.0')
+
+    for key, value in columns.items():
+        set_h5ad_encoding(create_chunked_array(f, group, filters, key, value),
+                          'array', '0.2.0')
+
+
+def set_h5ad_encoding(node: Union[tables.Node, tables.Group],
+                      encoding_type: str,
+                      encoding_version: str):
+    """Set the attributes AnnData uses to identify how a node is encoded."""
+
+    node._v_attrs['encoding-type'] = encoding_type
+    node._v_attrs['encoding-version'] = encoding_version
+
+
+def get_output_filters(compression: Union[str, None] = 'zlib',
+                       complevel: int = 4) -> Union[tables.Filters, None]:
+    """Get PyTables filters for compression of output arrays.
+
+    Args:
+        compression: Compression library, one of tables.filters.all_complibs
+            (e.g. 'zlib', 'blosc', 'blosc:zstd').  None or 'none' means no
+            compression.
+        complevel: Compression level, from 0 (none) to 9 (maximum).
+
+    Returns:
+        filters: tables.Filters to use for output arrays, or None.
+
+    """
+
+    if (compression is None) or (compression == 'none') or (complevel == 0):
+        return None
+
+    assert compression in tables.filters.all_complibs, \
+        f"Compression {compression} is not one of the libraries supported " \
+        f"by PyTables: {tables.filters.all_complibs}"
+    assert 0 <= complevel <= 9, "complevel must be an integer from 0 to 9."
+
+    return tables.Filters(complevel=complevel, complib=compression, shuffle=True)
+
+
+def create_barcode_array(f: tables.File,
+                         group: tables.Group,
+                         filters: Union[tables.Filters, None],
+                         name: str,
+                         barcodes: Union[np.ndarray, PackedBarcodes],
+                         chunk_size: int = 1000000,
+                         chunk_bytes: int = 2**18) -> tables.Leaf:
+    """Write barcodes to an HDF5 file, decoding packed barcodes in chunks.
+
+    Packed barcodes are written to the same CArray, with the same chunks, as
+    create_chunked_array() writes for the decoded barcodes, so that the file
+    is identical whether or not barcodes were packed.
+
+    Args:
+        f: Open PyTables file.
+        group: Group in which to create the array.
+        filters: PyTables filters specifying compression, or None.
+        name: Name of the array.
+        barcodes: Barcodes, either as a numpy array or PackedBarcodes.
+        chunk_size: Approximate number of packed barcodes decoded and written
+            at a time.
+        chunk_bytes: Approximate size of each chunk in bytes, as in
+            create_chunked_array().
+
+    Returns:
+        The array node created in the file.
+
+    """
+
+    if not isinstance(barcodes, PackedBarcodes) or (barcodes.size == 0):
+        return create_chunked_array(f, group, filters, name, barcodes,
+                                    chunk_bytes=chunk_bytes)
+
+    # Decoded barcodes are written as fixed-length byte strings.
+    itemsize = barcodes.itemsize
+    n_rows = int(max(1, min(barcodes.size, chunk_bytes // itemsize)))
+    array = f.create_carray(group, name, atom=tables.StringAtom(itemsize),
+                            shape=(barcodes.size,), filters=filters,
+                            chunkshape=(n_rows,), track_times=False)
+
+    # Write whole chunks at a time.
+    chunk_size = max(1, chunk_size // n_rows) * n_rows
+    for i in range(0, barcodes.size, chunk_size):
+        array[i:(i + chunk_size)] = barcodes[i:(i + chunk_size)].decode()
+
+    return array
+
+
+def create_chunked_array(f: tables.File,
+                         group: tables.Group,
+                         filters: Union[tables.Filters, None],
+                         name: str,
+                         array: Union[np.ndarray, List, Tuple],
+                         chunk_bytes: int = 2**18) -> tables.Leaf:
+    """Write an array to an HDF5 file as a chunked (and compressed) CArray.
+
+    Chunks span whole rows, so that reading the data for a contiguous range
+    of barcodes (e.g. one column of a CellRanger-format matrix) touches as few
+    chunks as possible.
+
+    Args:
+        f: Open PyTables file.
+        group: Group in which to create the array.
+        filters: PyTables filters specifying compression, or None.
+        name: Name of the array.
+        array: Data to write.
+        chunk_bytes: Approximate size of each chunk in bytes.
+
+    Returns:
+        The array node created in the file.
+
+    """
+
+    array = np.asarray(array)
+
+    # Arrays are written without HDF5 timestamps, so that the same output
+    # gives the same bytes.
+
+    # A CArray cannot be empty or a scalar.
+    if (array.size == 0) or (array.ndim == 0):
+        return f.create_array(group, name, array, track_times=False)
+
+    # Choose a number of rows per chunk to give about chunk_bytes per chunk.
+    row_bytes = array.itemsize * int(np.prod(array.shape[1:]))
+    n_rows = int(max(1, min(array.shape[0], chunk_bytes // max(1, row_bytes))))
+
+    return f.create_carray(group, name, obj=array, filters=filters,
+                           chunkshape=(n_rows,) + array.shape[1:],
+                           track_times=False)
+
+
+def get_top_k_inds(values: np.ndarray, k: int) -> np.ndarray:
+    """Get the indices of the k largest values, in decreasing order of value.
+
+    Uses np.argpartition, so that only the top k values are sorted, which is
+    much faster than a full sort when k is small compared to values.size.
+
+    Args:
+        values: Values to rank, e.g. UMI counts per barcode.
+        k: Number of indices to return.
+
+    Returns:
+        inds: Integer indices of the k largest values, largest first.
+
+    """
+
+    k = int(min(max(k, 0), values.size))
+    if k == 0:
+        return np.array([], dtype=int)
+
+    # Values may be unsigned, so are partitioned in increasing order.
+    top = np.argpartition(values, values.size - k)[(values.size - k):] \
+        if k < values.size else np.arange(values.size)
+    return top[np.argsort(values[top], kind='stable')[::-1]].astype(dtype=int)
+
+
+def get_stratified_sample_inds(counts: np.ndarray,
+                               k: int,
+                               n_strata: int = 50,
+                               seed: int = 0) -> np.ndarray:
+    """Sample k indices, stratified by log counts, without replacement.
+
+    The range of log(counts + 1) is split into n_strata equal bins, and each
+    bin contributes a number of samples proportional to its size, so that
+    the distribution of counts in the sample matches that of all the counts.
+    If k allows it, every nonempty bin contributes at least one sample, so
+    that rare (e.g. very high) counts are represented.
+
+    Args:
+        counts: Counts, e.g. total UMI counts per empty droplet.
+        k: Number of indices to sample.
+        n_strata: Number of bins of log counts.
+        seed: Seed of the random number generator, for reproducibility.
+
+    Returns:
+        inds: Sampled indices into counts, in increasing order.
+
+    """
+
+    k = int(min(max(k, 0), counts.size))
+    if k == 0:
+        return np.array([], dtype=int)
+    if k == counts.size:
+        return np.arange(counts.size)
+
+    rng = np.random.RandomState(seed)
+
+    # Assign each value to a stratum of log counts.
+    log_counts = np.log1p(counts.astype(np.float64))
+    edges = np.linspace(log_counts.min(), log_counts.max(), n_strata + 1)
+    strata = np.digitize(log_counts, edges[1:-1]).astype(np.int16)
+
+    # One sample from each nonempty stratum, if there are enough samples.
+    sizes = np.bincount(strata, minlength=n_strata)
+    n_min = (sizes > 0).astype(int)
+    if k < n_min.sum():
+        n_min[:] = 0
+
+    # The rest in proportion to the size of each stratum.  The largest
+    # remainders (ties in random order) are rounded up, so that the total is
+    # exactly k.
+    quotas = (sizes - n_min) * (k - n_min.sum()) / (counts.size - n_min.sum())
+    n_samples = np.floor(quotas).astype(int)
+    remainder_order = np.lexsort((rng.random_sample(n_strata),
+                                  n_samples - quotas))
+    n_samples[remainder_order[:(k - n_min.sum() - n_samples.sum())]] += 1
+    n_samples += n_min
+
+    # Sample uniformly within each stratum.
+    order = np.argsort(strata, kind='stable')
+    bounds = np.concatenate([[0], np.cumsum(sizes)])
+    inds = [order[bounds[i] + rng.choice(sizes[i], n_samples[i], replace=False)]
+            for i in range(n_strata) if n_samples[i] > 0]
+
+    return np.sort(np.concatenate(inds))
+
+
+def get_barcode_totals(matrix: sp.csr_matrix,
+                       gene_inds: Union[np.ndarray, None] = None,
+                       transformation: Union[trans.DataTransform, None] = None,
+                       chunk_nnz: int = 2**24) -> Tuple[np.ndarray, np.ndarray]:
+    """Sum the counts in each barcode, over a subset of genes.
+
+    The matrix is read in chunks of rows, and genes are selected with a mask
+    on the column indices, so that no copy of the (possibly very large)
+    count matrix is made.
+
+    Args:
+        matrix: Count matrix, where rows are barcodes and columns are genes.
+        gene_inds: Genes to include.  All genes if None.
+        transformation: Transformation applied to each count before summing,
+            for transformed_counts.
+
+    Returns:
+        counts: Total counts per barcode, as int64.
+        transformed_counts: Total transformed counts per barcode, as float64.
+            The same array as counts if transformation is None.
+
+    """
+
+    matrix = sp.csr_matrix(matrix)
+    n_rows = matrix.shape[0]
+
+    # Duplicate entries must be summed before they are transformed.
+    if (transformation is not None) and not matrix.has_canonical_format:
+        matrix = matrix.copy()
+        matrix.sum_duplicates()
+
+    # Mask of included genes.
+    if gene_inds is None:
+        gene_mask = None
+    else:
+        gene_mask = np.zeros(matrix.shape[1], dtype=bool)
+        gene_mask[gene_inds] = True
+
+    counts = np.zeros(n_rows, dtype=np.int64)
+    transformed_counts = counts if transformation is None \
+        else np.zeros(n_rows, dtype=np.float64)
+
+    # Row boundaries of chunks of about chunk_nnz nonzero entries.
+    bounds = np.searchsorted(matrix.indptr,
+                             np.arange(0, matrix.nnz, max(1, chunk_nnz)),
+                             side='right') - 1
+    bounds = np.unique(np.concatenate([[0], bounds, [n_rows]]).clip(0, n_rows))
+
+    for start, end in zip(bounds[:-1], bounds[1:]):
+
+        # Nonzero entries in these rows, zeroed outside the included genes.
+        lo, hi = matrix.indptr[start], matrix.indptr[end]
+        data = matrix.data[lo:hi]
+        if gene_mask is not None:
+            data = np.where(gene_mask[matrix.indices[lo:hi]], data, 0)
+
+        # Sum each nonempty row (np.add.reduceat() mishandles empty rows).
+        row_starts = matrix.indptr[start:end] - lo
+        nonempty = np.diff(matrix.indptr[start:(end + 1)]) > 0
+        if not nonempty.any():
+            continue
+        rows = np.arange(start, end)[nonempty]
+        counts[rows] = np.add.reduceat(data, row_starts[nonempty],
+                                       dtype=np.int64)
+        if transformation is not None:
+            transformed_counts[rows] = np.add.reduceat(
+                transformation.transform(data.astype(np.float64)),
+                row_starts[nonempty])
+
+    return counts, transformed_counts
+
+
+def get_log_count_mode(counts: np.ndarray, decimals: int = 1) -> float:
+    """Mode of log(counts + 1), rounded to some decimals, from a histogram.
+
+    Equivalent to scipy.stats.mode(np.round(np.log1p(counts), decimals)),
+    but the rounded values are binned with np.bincount, which is much faster
+    and uses less memory than the sort done by scipy for millions of values.
+
+    Args:
+        counts: Counts, e.g. total UMI counts per barcode.
+        decimals: Number of decimals of the log counts kept.
+
+    Returns:
+        Most frequent rounded log count.  Ties go to the smallest value.
+
+    """
+
+    # np.round(x, decimals) is np.rint(x * 10**decimals) / 10**decimals.
+    scale = 10 ** decimals
+    bins = np.rint(np.log1p(counts) * scale).astype(np.int64)
+    offset = bins.min()
+    histogram = np.bincount(bins - offset)
+
+    return (np.argmax(histogram) + offset) / scale
+
+
+def get_order_statistics(values: np.ndarray,
+                         ranks: List[int]) -> np.ndarray:
+    """Values at the given ranks in increasing sorted order, without sorting.
+
+    Uses np.partition, which takes linear time, rather than a full sort.
+
+    Args:
+        values: Values, e.g. total UMI counts per barcode.
+        ranks: Positions in the sorted values.
+
+    Returns:
+        Values at those positions, np.sort(values)[ranks].
+
+    """
+
+    ranks = np.asarray(ranks, dtype=int)
+    return np.partition(values, np.unique(ranks))[ranks]
+
+
 def get_d_priors_from_dataset(dataset: Dataset) -> Tuple[float, float]:
     """Compute an estimate of reasonable priors on cell size and ambient size.
 
@@ -834,24 +1801,19 @@ def get_d_priors_from_dataset(dataset: Dataset) -> Tuple[float, float]:
     """
 
     # Count the total unique UMIs per barcode (summing after transforming).
-    transformed_counts = \
-        np.array(dataset.transformation.transform(dataset.data['matrix']
-                                                  [:, dataset.analyzed_gene_inds])
-                 .sum(axis=1)).squeeze()
-    counts = np.array(dataset.data['matrix']
-                      [:, dataset.analyzed_gene_inds].sum(axis=1)).squeeze()
+    counts, transformed_counts = \
+        get_barcode_totals(dataset.data['matrix'],
+                           gene_inds=dataset.analyzed_gene_inds,
+                           transformation=dataset.transformation)
 
     # If it's a model that does not model empty droplets, the dataset is cells.
     if dataset.model_name == 'simple':
 
         assert type(dataset.priors['n_cells']) is int, "No prior on number of cells."
 
-        # Sort order the cells by counts.
-        sort_order = np.argsort(counts)[::-1]
-
         # Estimate cell count by median, taking 'cells' to be the largest counts.
-        cell_counts = int(np.median(transformed_counts[sort_order]
-                                    [:dataset.priors['n_cells']]).item())
+        cell_inds = get_top_k_inds(counts, dataset.priors['n_cells'])
+        cell_counts = int(np.median(transformed_counts[cell_inds]).item())
 
         empty_counts = 0
 
@@ -864,15 +1826,19 @@ def get_d_priors_from_dataset(dataset: Dataset) -> Tuple[float, float]:
         # Estimate the number of UMI counts in empty droplets.
 
         # Mode of (rounded) log counts (for counts > cut) is a robust empty estimator.
-        empty_log_counts = mode(np.round(np.log1p(transformed_counts[counts > cut]),
-                                         decimals=1))[0]
+        empty_log_counts = get_log_count_mode(transformed_counts[counts > cut],
+                                              decimals=1)
         empty_counts = int(np.expm1(empty_log_counts).item())
 
         # Estimate the number of UMI counts in cells.
 
         # Median of log counts above 5 * empty counts is a robust cell estimator.
-        cell_log_counts = np.median(np.log1p(transformed_counts
-                                             [transformed_counts > 5 * empty_counts]))
+        # The log is monotonic, so it is taken of the middle values only.
+        cell_transformed_counts = \
+            transformed_counts[transformed_counts > 5 * empty_counts]
+        n = cell_transformed_counts.size
+        cell_log_counts = np.mean(np.log1p(get_order_statistics(
+            cell_transformed_counts, [(n - 1) // 2, n // 2])))
         cell_counts = int(np.expm1(cell_log_counts).item())
 
         logging.info(f"Prior on counts in empty droplets is {empty_counts}")
@@ -909,15 +1875,13 @@ def estimate_cell_count_from_dataset(dataset: Dataset) -> int:
         return dataset.data['matrix'].shape[0]
 
     # Count number of UMIs in each barcode.
-    counts = np.array(dataset.data['matrix'].sum(axis=1),
-                      dtype=int).squeeze()
+    counts, _ = get_barcode_totals(dataset.data['matrix'])
 
-    # Find the order that sorts barcodes by UMI count.
-    count_sort_order = np.argsort(counts)[::-1]  # Decreasing UMI counts
-
-    # Find the UMI count cutoff as 0.9 * counts(99th percentile barcode)
+    # Find the UMI count cutoff as 0.9 * counts(99th percentile barcode),
+    # where barcodes are ranked by decreasing UMI counts.
     ninety_ninth_percentile_ind = int(counts.size * 0.01)
-    umi_cutoff = 0.9 * counts[count_sort_order][ninety_ninth_percentile_ind]
+    umi_cutoff = 0.9 * get_order_statistics(
+        counts, [counts.size - 1 - ninety_ninth_percentile_ind])[0]
 
     # Count the number of barcodes with UMI counts above the cutoff.
     cell_count_est = int(np.sum(counts > umi_cutoff).item())
@@ -925,8 +1889,117 @@ def estimate_cell_count_from_dataset(dataset: Dataset) -> int:
     return cell_count_est
 
 
-def estimate_chi_from_dataset(dataset: Dataset) -> Tuple[torch.Tensor,
-                                                         torch.Tensor]:
+def get_gene_pools(gene_counts: np.ndarray,
+                   threshold: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Pool genes with few counts into bins, to be treated as single genes.
+
+    Genes with at least threshold total counts each keep their own column.
+    The rest, ordered by total counts, are grouped consecutively into bins of
+    at least threshold total counts (the last bin can only be smaller if it is
+    the only one), placed after the unpooled genes.
+
+    Args:
+        gene_counts: Total counts of each gene.
+        threshold: Genes with fewer total counts than this are pooled.
+
+    Returns:
+        pool_inds: Column of each gene after pooling.
+        weights: Fraction of the total counts of its column from each gene.
+
+    """
+
+    gene_counts = np.asarray(gene_counts, dtype=np.float64)
+    rare = gene_counts < threshold
+    pool_inds = np.zeros(gene_counts.size, dtype=np.int64)
+    n_unpooled = np.count_nonzero(~rare)
+    pool_inds[~rare] = np.arange(n_unpooled)
+
+    rare_inds = np.flatnonzero(rare)
+    if rare_inds.size > 0:
+
+        # A new bin starts each time the running total passes a multiple of
+        # the threshold, and a small final bin is merged into the one before.
+        rare_inds = rare_inds[np.argsort(gene_counts[rare_inds], kind='stable')]
+        running_total = np.cumsum(gene_counts[rare_inds])
+        bins = ((running_total - gene_counts[rare_inds])
+                // threshold).astype(np.int64)
+        n_bins = bins[-1] + 1
+        if (n_bins > 1) and \
+                (gene_counts[rare_inds][bins == n_bins - 1].sum() < threshold):
+            bins[bins == n_bins - 1] = n_bins - 2
+        pool_inds[rare_inds] = n_unpooled + bins
+
+    # Each gene's fraction of the counts of its column.
+    totals = np.bincount(pool_inds, weights=gene_counts)
+    weights = np.ones(gene_counts.size)
+    nonzero = totals[pool_inds] > 0
+    weights[nonzero] = gene_counts[nonzero] / totals[pool_inds][nonzero]
+
+    return pool_inds, weights
+
+
+def select_encoder_genes(count_matrix: sp.csr_matrix,
+                         n_genes: int,
+                         method: str = 'variance',
+                         chi_ambient: Union[torch.Tensor, np.ndarray, None] = None) \
+        -> np.ndarray:
+    """Choose the most informative genes to use as input to the encoders.
+
+    Args:
+        count_matrix: Trimmed count matrix, where rows are barcodes and
+            columns are the analyzed genes.
+        n_genes: Number of genes to choose.
+        method: 'variance' ranks genes by the variance across barcodes of
+            log(1 + normalized counts), and 'ambient' by their contribution
+            to the KL divergence of the average expression of these barcodes
+            from the ambient profile chi_ambient.
+        chi_ambient: Ambient gene expression profile, required for 'ambient'.
+
+    Returns:
+        gene_inds: Sorted indices of the chosen genes (columns of count_matrix).
+
+    """
+
+    assert method in ['variance', 'ambient'], \
+        f"Unknown encoder gene selection method '{method}'."
+
+    count_matrix = sp.csr_matrix(count_matrix, dtype=np.float64)
+    n_barcodes, n_total = count_matrix.shape
+    if n_genes >= n_total:
+        return np.arange(n_total)
+
+    if method == 'variance':
+
+        # Normalize each barcode to the median total count, then log transform
+        # the nonzero values (zeros stay zero).
+        totals = np.asarray(count_matrix.sum(axis=1)).ravel()
+        scale = np.median(totals) / np.maximum(totals, 1.)
+        normalized = sp.diags(scale) @ count_matrix
+        normalized.data = np.log1p(normalized.data)
+
+        # Variance of each gene from its first and second moments.
+        mean = np.asarray(normalized.mean(axis=0)).ravel()
+        mean_sq = np.asarray(normalized.multiply(normalized).mean(axis=0)).ravel()
+        score = mean_sq - mean ** 2
+
+    else:
+
+        assert chi_ambient is not None, \
+            "chi_ambient is needed to choose encoder genes by 'ambient'."
+        chi_ambient = np.asarray(chi_ambient, dtype=np.float64).ravel()
+
+        # Contribution of each gene to KL(chi_barcodes || chi_ambient).
+        ep = np.finfo(np.float32).eps.item()
+        chi = np.asarray(count_matrix.sum(axis=0)).ravel() + ep
+        chi = chi / chi.sum()
+        score = np.abs(chi * np.log(chi / (chi_ambient + ep)))
+
+    return np.sort(get_top_k_inds(score, n_genes))
+
+
+def estimate_chi_from_dataset(dataset: Dataset,
+                              chunk_size: int = 10000) -> Tuple[torch.Tensor,
+                                                                torch.Tensor]:
     """Compute an estimate of ambient RNA levels.
 
     Given a Dataset, compute an estimate of the ambient gene expression and
@@ -935,6 +2008,8 @@ def estimate_chi_from_dataset(dataset: Dataset) -> Tuple[torch.Tensor,
     Args:
         dataset: Dataset object containing a matrix of unique UMI counts,
             where rows are barcodes and columns are genes.
+        chunk_size: Number of barcodes transformed and summed at a time, so
+            that the transformed count matrix is never held in memory.
 
     Returns:
         chi_ambient_init: Estimated number of real cells.
@@ -954,26 +2029,32 @@ def estimate_chi_from_dataset(dataset: Dataset) -> Tuple[torch.Tensor,
 
     ep = np.finfo(np.float32).eps.item()  # Small value
 
-    # Trimmed and appropriately transformed count matrix.
-    count_matrix = dataset.get_count_matrix()
+    # Trimmed count matrix, transformed one chunk of barcodes at a time.
+    barcode_inds = dataset.analyzed_barcode_inds if dataset.is_trimmed else None
+    gene_expression = 0.
+    for chunk in dataset.get_count_matrix_chunks(barcode_inds,
+                                                 chunk_size=chunk_size):
 
-    # Empty droplets have log counts < log_crossover.
-    empty_barcodes = (np.log(np.array(count_matrix.sum(axis=1)).squeeze())
-                      < log_crossover)
+        # Empty droplets have log counts < log_crossover.
+        with np.errstate(divide='ignore'):
+            empty_barcodes = (np.log(np.asarray(chunk.sum(axis=1)).ravel())
+                              < log_crossover)
 
-    # Sum gene expression for the empty droplets.
-    gene_expression = np.array(count_matrix[empty_barcodes, :].sum(axis=0)).squeeze()
+        # Sum gene expression for the empty droplets.
+        gene_expression = gene_expression + np.asarray(
+            chunk[empty_barcodes, :].sum(axis=0, dtype=np.float64)).ravel()
 
     # As a vector on a simplex.
     gene_expression = gene_expression + ep
     chi_ambient_init = \
         torch.Tensor(gene_expression / np.sum(gene_expression))
 
-    # Full count matrix, appropriately transformed.
-    full_count_matrix = dataset.get_count_matrix_all_barcodes()
-
-    # Sum all gene expression.
-    gene_expression_total = np.array(full_count_matrix.sum(axis=0)).squeeze()
+    # Sum all gene expression over the full count matrix, appropriately
+    # transformed, without holding the transformed matrix in memory.
+    gene_expression_total = 0.
+    for chunk in dataset.get_count_matrix_chunks(chunk_size=chunk_size):
+        gene_expression_total = gene_expression_total + np.asarray(
+            chunk.sum(axis=0, dtype=np.float64)).ravel()
 
     # As a vector on a simplex.
     gene_expression_total = gene_expression_total + ep
@@ -2,6 +2,7 @@
 
 import numpy as np
 import scipy.sparse as sp
+import tables
 from typing import Tuple, List, Union
 
 
@@ -159,36 +160,16 @@ def simulate_ambient_dataset(n_cells: int = 150,
                                                   "must equal n_cells."
 
     # Initialize arrays and lists.
-    chi = np.zeros((clusters+1, n_genes))
     csr_list = []
     z = []
     d = []
 
-    if chi_input is not None:
-
-        # Go with the chi that was input.
-        chi[1:, :] = chi_input
-
-    else:
-    
-        # Get chi for cell expression.
-        for i in range(1, clusters+1):
-            chi[i, :] = generate_chi(alpha=0.01, n_genes=n_genes)
-    
-    # Get chi for ambient expression.  This becomes chi[0, :].
-    if ambient_different:
-
-        # Ambient expression is unrelated to cells, and is itself random.
-        chi[0, :] = generate_chi(alpha=0.001, n_genes=n_genes)  # Sparse
-
-    else:
-
-        # Ambient gene expression comes from the sum of cell expression.
-        for i in range(1, clusters+1):
-
-            chi[0, :] += cells_in_clusters[i-1] * chi[i, :]  # Weighted sum
-
-    chi[0, :] = chi[0, :] / np.sum(chi[0, :])  # Normalize
+    # Get chi for cell expression and ambient expression (chi[0, :]).
+    chi = generate_ambient_chi(clusters=clusters,
+                               n_genes=n_genes,
+                               cells_in_clusters=cells_in_clusters,
+                               ambient_different=ambient_different,
+                               chi_input=chi_input)
     
     # Sample gene expression for ambient.
     csr, d_n = sample_expression_from(chi[0, :],
@@ -229,6 +210,259 @@ def simulate_ambient_dataset(n_cells: int = 150,
     return csr_barcode_gene_synthetic, z, chi, d
 
 
+def simulate_ambient_dataset_to_h5(output_file: str,
+                                   n_cells: int = 150,
+                                   n_empty: int = 300,
+                                   clusters: int = 3,
+                                   n_genes: int = 10000,
+                                   d_cell: int = 5000,
+                                   d_empty: int = 100,
+                                   cells_in_clusters: Union[List[int], None] = None,
+                                   ambient_different: bool = False,
+                                   chi_input: Union[np.ndarray, None] = None,
+                                   block_size: int = 10000) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """Simulate a dataset with ambient background RNA counts, streaming it to
+    a CellRanger v3 format HDF5 file.
+
+    The dataset is simulated exactly as in simulate_ambient_dataset(), but
+    barcodes are generated in blocks of block_size, and each block is appended
+    to the file before the next is simulated.  Only one block of counts is
+    ever held in memory, so the output can be much larger than RAM.  The file
+    can be read back in using dataset.get_matrix_from_h5().
+
+    Args:
+        output_file: Path to output .h5 file (e.g., 'simulated_raw.h5').
+        n_cells: Number of cells.
+        n_empty: Number of empty droplets with only ambient RNA.
+        clusters: Number of distinct cell types to simulate.
+        n_genes: Number of genes.
+        d_cell: Cell size scale factor.
+        d_empty: Empty droplet size scale factor.
+        cells_in_clusters: Number of cells of each cell type.  If specified,
+            the number of ints in this list must be equal to clusters.
+        ambient_different: If False, the gene expression profile of ambient
+            RNA is drawn from the sum of cellular gene expression.  If True,
+            the ambient RNA expression is completely different from cellular
+            gene expression.
+        chi_input: Gene expression arrays in a matrix, with rows as clusters and
+            columns as genes.  Expression should add to one for each row.
+            Setting chi=None will generate new chi randomly according to a
+            Dirichlet distribution.
+        block_size: Number of barcodes simulated and written at a time.
+
+    Returns:
+        z: The simulated cell type identities.  A numpy array of integers,
+            one for each barcode. The number 0 is used to denote barcodes
+            without a cell present.
+        chi: The simulated gene expression, one corresponding to each z.
+            Access the vector of gene expression for a given z using chi[z, :].
+
+    Note:
+        CellRanger stores the transpose of the barcode by gene count matrix,
+        as a csc_matrix with genes as rows and barcodes as columns.  A block
+        of barcodes in csr format already has exactly this layout, so blocks
+        are appended to extendable arrays, with a running indptr.
+
+    """
+
+    assert d_cell > 0, "Location parameter, d_cell, of LogNormal " \
+                       "distribution must be greater than zero."
+    assert d_empty > 0, "Location parameter, d_cell, of LogNormal " \
+                        "distribution must be greater than zero."
+    assert clusters > 0, "clusters must be a positive integer."
+    assert n_cells > 0, "n_cells must be a positive integer."
+    assert n_empty > 0, "n_empty must be a positive integer."
+    assert n_genes > 0, "n_genes must be a positive integer."
+    assert block_size > 0, "block_size must be a positive integer."
+
+    # Figure out how many cells are in each cell cluster.
+    if cells_in_clusters is None:
+        # No user input: make equal numbers of each cell type
+        cells_in_clusters = (np.ones(clusters, dtype=int)
+                             * int(n_cells/clusters))
+    else:
+        assert len(cells_in_clusters) == clusters, "len(cells_in_clusters) " \
+                                                   "must equal clusters."
+        assert sum(cells_in_clusters) == n_cells, "sum(cells_in_clusters) " \
+                                                  "must equal n_cells."
+
+    # Get chi for cell expression and ambient expression (chi[0, :]).
+    chi = generate_ambient_chi(clusters=clusters,
+                               n_genes=n_genes,
+                               cells_in_clusters=cells_in_clusters,
+                               ambient_different=ambient_different,
+                               chi_input=chi_input)
+
+    # Get chi for each barcode type once ambient expression is added.
+    chi_tilde = np.zeros_like(chi)
+    chi_tilde[0, :] = chi[0, :]
+    for i in range(1, clusters+1):
+        chi_tilde[i, :] = chi[i, :] * d_cell + chi[0, :] * d_empty
+        chi_tilde[i, :] = chi_tilde[i, :] / np.sum(chi_tilde[i, :])  # Normalize
+    d_mu = np.array([np.log(d_empty).item()]
+                    + [np.log(d_cell).item() for _ in range(clusters)])
+
+    # Decide on the identity of every barcode up front, in a random order.
+    z = np.concatenate([np.zeros(n_empty, dtype=int)]
+                       + [i * np.ones(int(cells_in_clusters[i-1]), dtype=int)
+                          for i in range(1, clusters+1)])
+    z = z[np.random.permutation(z.size)]
+
+    filters = tables.Filters(complevel=4, complib='zlib', shuffle=True)
+
+    with tables.open_file(output_file, "w",
+                          title="Simulated raw UMI counts") as f:
+
+        # Create the group where data will be stored.
+        group = f.create_group("/", "matrix", "Simulated count matrix")
+
+        # Create extendable arrays for the barcodes and the count data.
+        barcodes = f.create_earray(group, "barcodes",
+                                   atom=tables.StringAtom(itemsize=18),
+                                   shape=(0,), filters=filters,
+                                   expectedrows=z.size)
+        data = f.create_earray(group, "data", atom=tables.Int32Atom(),
+                               shape=(0,), filters=filters)
+        indices = f.create_earray(group, "indices", atom=tables.Int64Atom(),
+                                  shape=(0,), filters=filters)
+        indptr = f.create_earray(group, "indptr", atom=tables.Int64Atom(),
+                                 shape=(0,), filters=filters,
+                                 expectedrows=z.size + 1)
+        indptr.append(np.zeros(1, dtype=np.int64))
+        nnz = 0
+
+        # Simulate and write one block of barcodes at a time.
+        for start in range(0, z.size, block_size):
+
+            z_block = z[start:min(z.size, start + block_size)]
+
+            # Sample gene expression for each barcode type in this block.
+            csr_list = []
+            rows = []
+            for i in np.unique(z_block):
+                rows_i = np.where(z_block == i)[0]
+                csr, _ = sample_expression_from(chi_tilde[i, :],
+                                                n=rows_i.size,
+                                                d_mu=d_mu[i])
+                csr_list.append(csr)
+                rows.append(rows_i)
+
+            # Put the barcodes of this block back in their permuted order.
+            block = sp.vstack(csr_list, format='csr')
+            block = block[np.argsort(np.concatenate(rows)), :]
+            block.sort_indices()
+
+            # Append the block, offsetting its indptr by the running total.
+            barcodes.append(generate_barcodes(np.arange(start,
+                                                        start + z_block.size)))
+            data.append(block.data.astype(np.int32))
+            indices.append(block.indices.astype(np.int64))
+            indptr.append(block.indptr[1:].astype(np.int64) + nnz)
+            nnz += block.nnz
+
+        f.create_array(group, "shape", np.array([n_genes, z.size],
+                                                dtype=np.int32))
+
+        # Create the features group that CellRanger v3 uses for gene names.
+        feature_group = f.create_group(group, "features",
+                                       "Simulated gene features")
+        f.create_array(feature_group, "name",
+                       np.array([f'gene_{i}'.encode()
+                                 for i in range(n_genes)]))
+        f.create_array(feature_group, "id",
+                       np.array([f'SIMG{i:011d}'.encode()
+                                 for i in range(n_genes)]))
+        f.create_array(feature_group, "feature_type",
+                       np.array([b'Gene Expression'] * n_genes))
+        f.create_array(feature_group, "genome",
+                       np.array([b'simulated'] * n_genes))
+
+    return z, chi
+
+
+def generate_barcodes(inds: np.ndarray) -> np.ndarray:
+    """Generate unique CellRanger-style barcode names from integer indices.
+
+    Args:
+        inds: Integer barcode indices, each less than 4**16.
+
+    Returns:
+        barcodes: numpy array of byte-strings, a 16-mer of nucleotides
+            followed by the suffix '-1', e.g. b'AAAAAAAAAAAAAACG-1'.
+
+    """
+
+    # Each index is written in base 4, as 16 nucleotides.
+    shifts = 2 * np.arange(15, -1, -1, dtype=np.uint64)
+    digits = (inds.astype(np.uint64)[:, None] >> shifts) & np.uint64(3)
+    nucleotides = np.frombuffer(b'ACGT', dtype=np.uint8)[digits.astype(int)]
+
+    # Add the suffix and view each row of characters as one string.
+    suffix = np.frombuffer(b'-1', dtype=np.uint8)
+    chars = np.hstack((nucleotides,
+                       np.broadcast_to(suffix, (inds.size, suffix.size))))
+
+    return np.ascontiguousarray(chars).view('S18').squeeze(axis=1)
+
+
+def generate_ambient_chi(clusters: int = 3,
+                         n_genes: int = 10000,
+                         cells_in_clusters: Union[List[int], np.ndarray,
+                                                  None] = None,
+                         ambient_different: bool = False,
+                         chi_input: Union[np.ndarray, None] = None) -> np.ndarray:
+    """Generate gene expression for cell types and for ambient RNA.
+
+    Args:
+        clusters: Number of distinct cell types to simulate.
+        n_genes: Number of genes.
+        cells_in_clusters: Number of cells of each cell type.
+        ambient_different: If False, the gene expression profile of ambient
+            RNA is drawn from the sum of cellular gene expression.  If True,
+            the ambient RNA expression is completely different from cellular
+            gene expression.
+        chi_input: Gene expression arrays in a matrix, with rows as clusters and
+            columns as genes.  Setting chi=None will generate new chi randomly
+            according to a Dirichlet distribution.
+
+    Returns:
+        chi: The gene expression of ambient RNA, chi[0, :], and of each cell
+            type, chi[i, :].
+
+    """
+
+    chi = np.zeros((clusters+1, n_genes))
+
+    if chi_input is not None:
+
+        # Go with the chi that was input.
+        chi[1:, :] = chi_input
+
+    else:
+
+        # Get chi for cell expression.
+        for i in range(1, clusters+1):
+            chi[i, :] = generate_chi(alpha=0.01, n_genes=n_genes)
+
+    # Get chi for ambient expression.  This becomes chi[0, :].
+    if ambient_different:
+
+        # Ambient expression is unrelated to cells, and is itself random.
+        chi[0, :] = generate_chi(alpha=0.001, n_genes=n_genes)  # Sparse
+
+    else:
+
+        # Ambient gene expression comes from the sum of cell expression.
+        for i in range(1, clusters+1):
+
+            chi[0, :] += cells_in_clusters[i-1] * chi[i, :]  # Weighted sum
+
+    chi[0, :] = chi[0, :] / np.sum(chi[0, :])  # Normalize
+
+    return chi
+
+
 def generate_chi(alpha: float = 1., n_genes: int = 10000) -> np.ndarray:
     """Sample a gene expression vector, chi, from a Dirichlet prior.
 
@@ -8,6 +8,7 @@ from torch.distributions import constraints
 import pyro
 import pyro.distributions as dist
 import pyro.nn
+from pyro import poutine
 from pyro.infer import config_enumerate
 from cellbender.remove_background.distributions.NegativeBinomial \
     import NegativeBinomial
@@ -41,6 +42,9 @@ class VariationalInferenceModel(nn.Module):
             average baselines during the inference procedure.
         lambda_reg: Scale factor for L1 regularization to be applied to the
             decoder weight matrices.
+        likelihood_genes: Number of genes sampled for each minibatch at which
+            the likelihood is evaluated, or None to evaluate it at all genes.
+            The sampled likelihood is an unbiased estimate of the full one.
         use_cuda: Will use GPU if True.
 
     Attributes:
@@ -61,6 +65,7 @@ class VariationalInferenceModel(nn.Module):
                  use_decaying_avg_baseline: bool = False,
                  use_IAF: bool = False,
                  lambda_reg: float = 0.,
+                 likelihood_genes: Union[int, None] = None,
                  use_cuda: bool = False):
         super(VariationalInferenceModel, self).__init__()
 
@@ -74,7 +79,10 @@ class VariationalInferenceModel(nn.Module):
 
         self.use_decaying_avg_baseline = use_decaying_avg_baseline
         self.use_IAF = use_IAF
-        self.n_genes = dataset_obj.analyzed_gene_inds.size
+        self.n_genes = dataset_obj.get_num_model_genes()
+        self.likelihood_genes = likelihood_genes
+        if (likelihood_genes is not None) and (likelihood_genes >= self.n_genes):
+            self.likelihood_genes = None
         self.z_dim = decoder.input_dim
         self.encoder = encoder
         self.decoder = decoder
@@ -175,6 +183,35 @@ class VariationalInferenceModel(nn.Module):
         self.rho_beta_prior = (rho_beta_prior
                                * torch.ones(torch.Size([])).to(self.device))
 
+    def _sample_likelihood_genes(self, x: torch.Tensor) \
+            -> Tuple[torch.Tensor, torch.Tensor]:
+        """Sample genes at which to evaluate the likelihood of a minibatch.
+
+        Genes are drawn with replacement, with probability half proportional
+        to their number of nonzero counts in the minibatch and half uniform,
+        so that nonzero counts, which carry most of the likelihood, are
+        preferred.  Weighting the log likelihood of each sampled gene by the
+        inverse of its expected number of draws gives an unbiased estimate of
+        the log likelihood of all genes.
+
+        Args:
+            x: Dense minibatch of count data, where rows are barcodes.
+
+        Returns:
+            gene_inds: Indices of the self.likelihood_genes sampled genes.
+            gene_weights: Importance weight of each sampled gene.
+
+        """
+
+        nonzero = (x > 0).sum(dim=0).float()
+        prob = (0.5 * nonzero / nonzero.sum().clamp(min=1.)
+                + 0.5 / self.n_genes)
+        gene_inds = torch.multinomial(prob, self.likelihood_genes,
+                                      replacement=True)
+        gene_weights = 1. / (self.likelihood_genes * prob[gene_inds])
+
+        return gene_inds, gene_weights
+
     def _calculate_mu(self,
                       chi: torch.Tensor,
                       d_cell: torch.Tensor,
@@ -266,8 +303,18 @@ class VariationalInferenceModel(nn.Module):
 
         return mu
 
-    def model(self, x, observe=True) -> torch.Tensor:
-        """Data likelihood model."""
+    def model(self, x, mask=None, observe=True) -> torch.Tensor:
+        """Data likelihood model.
+
+        Args:
+            x: Minibatch of count data, where rows are barcodes.  Dense, or
+                sparse CSR (which is densified only for the likelihood).
+            mask: Boolean tensor which is False for rows of x that are only
+                padding, and are excluded from the likelihood.  None to
+                include all rows.
+            observe: False for data generation only.
+
+        """
 
         # Register the decoder with pyro.
         pyro.module("decoder", self.decoder)
@@ -290,9 +337,11 @@ class VariationalInferenceModel(nn.Module):
         # Add L1 regularization term to the loss based on decoder weights.
         # self._regularize(x.size(0))
 
-        # Happens in parallel for each data point (cell barcode) independently:
+        # Happens in parallel for each data point (cell barcode) independently,
+        # excluding any padding rows:
         with pyro.plate("data", x.size(0),
-                        use_cuda=self.use_cuda, device=self.device):
+                        use_cuda=self.use_cuda, device=self.device), \
+                poutine.mask(mask=True if mask is None else mask):
 
             # Sample z from prior.
             z = pyro.sample("z",
@@ -342,19 +391,46 @@ class VariationalInferenceModel(nn.Module):
                 # y = torch.rand(1)  # dummy tensor for Jit static typing
                 y = None
 
+            # The likelihood needs dense counts.
+            if observe:
+                if x.layout == torch.sparse_csr:
+                    x = x.to_dense()
+                x = x.reshape(-1, self.n_genes)
+
+            # Restrict the likelihood to a sample of genes, if called for.
+            # chi has already been normalized over all genes by the decoder.
+            chi_bar = self.avg_gene_expression
+            if observe and (self.likelihood_genes is not None):
+                gene_inds, gene_weights = self._sample_likelihood_genes(x)
+                x = x[:, gene_inds]
+                chi = chi[..., gene_inds]
+                if chi_ambient is not None:
+                    chi_ambient = chi_ambient[gene_inds]
+                if chi_bar is not None:
+                    chi_bar = chi_bar[gene_inds]
+
             # Calculate the mean gene expression counts (for each barcode).
             mu = self._calculate_mu(chi, d_cell,
                                     chi_ambient=chi_ambient,
                                     d_empty=d_empty,
                                     y=y,
                                     rho=rho,
-                                    chi_bar=self.avg_gene_expression)
+                                    chi_bar=chi_bar)
 
             # Sample actual gene expression, and compare with observed data.
             r = 1. / phi
             logit = torch.log(mu * phi)
 
-            if observe:
+            if observe and (self.likelihood_genes is not None):
+
+                # Importance-weighted estimate of the log likelihood of all
+                # genes, from the sampled genes.
+                log_prob = NegativeBinomial(total_count=r,
+                                            logits=logit).log_prob(x)
+                pyro.factor("obs", (log_prob * gene_weights).sum(dim=-1))
+                c = x
+
+            elif observe:
                 # Poisson:
                 # pyro.sample("obs", dist.Poisson(mu).independent(1),
                 #             obs=x.reshape(-1, self.n_genes))
@@ -362,7 +438,7 @@ class VariationalInferenceModel(nn.Module):
                 # Negative binomial:
                 c = pyro.sample("obs", NegativeBinomial(total_count=r,
                                                         logits=logit).to_event(1),
-                                obs=x.reshape(-1, self.n_genes))
+                                obs=x)
             else:
                 # For data generation only
                 c = pyro.sample("obs", NegativeBinomial(total_count=r,
@@ -371,8 +447,8 @@ class VariationalInferenceModel(nn.Module):
         return c
 
     @config_enumerate(default='parallel')
-    def guide(self, x, observe=True):
-        """Variational posterior."""
+    def guide(self, x, mask=None, observe=True):
+        """Variational posterior.  Arguments are as for model()."""
 
         # Register the encoder(s) with pyro.
         for name, module in self.encoder.items():
@@ -436,9 +512,11 @@ class VariationalInferenceModel(nn.Module):
         phi_rate = phi_loc / phi_scale.pow(2)
         pyro.sample("phi", dist.Gamma(phi_conc, phi_rate))
 
-        # Happens in parallel for each data point (cell barcode) independently:
+        # Happens in parallel for each data point (cell barcode) independently,
+        # excluding any padding rows:
         with pyro.plate("data", x.size(0),
-                        use_cuda=self.use_cuda, device=self.device):
+                        use_cuda=self.use_cuda, device=self.device), \
+                poutine.mask(mask=True if mask is None else mask):
 
             # Encode the latent variables from the input gene expression counts.
             if self.include_empties:
@@ -530,6 +608,12 @@ class VariationalInferenceModel(nn.Module):
             n += (self.decoder.outlinear.in_features
                   * self.decoder.outlinear.out_features)
 
+            # Add the weights of the low-rank factor of the output layer.
+            if self.decoder.rank_linear is not None:
+                penalty += self.decoder.rank_linear.weight.abs().sum()
+                n += (self.decoder.rank_linear.in_features
+                      * self.decoder.rank_linear.out_features)
+
             # Normalize the penalty by the number of weights and the minibatch
             # size, to keep it independent of minibatch size.
             penalty = penalty / n * self.lambda_reg * n_batch
@@ -634,20 +718,27 @@ class VariationalInferenceModel(nn.Module):
 
 def get_encodings(model: VariationalInferenceModel,
                   dataset_obj,
-                  cells_only: bool = True) -> Tuple[np.ndarray,
-                                                    np.ndarray,
-                                                    np.ndarray]:
+                  cells_only: bool = True,
+                  chunk_size: int = 500) -> Tuple[np.ndarray,
+                                                  np.ndarray,
+                                                  np.ndarray]:
     """Get inferred quantities from a trained model.
 
     Run a dataset through the model's trained encoder and return the inferred
     quantities.
 
+    The encoder is run without autograd, one chunk of barcodes at a time.  Each
+    sparse chunk is written into the same dense float32 buffer, and the
+    encodings are written directly into preallocated float32 outputs, so the
+    memory used does not grow with the number of barcodes beyond the outputs.
+
     Args:
         model: A trained cellbender.model.VariationalInferenceModel, which will be
             used to generate the encodings from data.
         dataset_obj: The dataset to be encoded.
         cells_only: If True, only returns the encodings of barcodes that are
             determined to contain cells.
+        chunk_size: Number of barcodes sent through the encoder at a time.
 
     Returns:
         z: Latent variable embedding of gene expression in a low-dimensional
@@ -663,48 +754,60 @@ def get_encodings(model: VariationalInferenceModel,
 
     logging.info("Encoding data according to model.")
 
-    # Get the count matrix with genes trimmed.
+    # Choose the barcodes to encode (genes are trimmed chunk by chunk).
     if cells_only:
-        dataset = dataset_obj.get_count_matrix()
+        barcode_inds = dataset_obj.analyzed_barcode_inds
+        n_barcodes = barcode_inds.size
     else:
-        dataset = dataset_obj.get_count_matrix_all_barcodes()
+        barcode_inds = None  # All barcodes
+        n_barcodes = dataset_obj.data['matrix'].shape[0]
 
     # Initialize numpy arrays as placeholders.
-    z = np.zeros((dataset.shape[0], model.z_dim))
-    d = np.zeros((dataset.shape[0]))
-    p = np.zeros((dataset.shape[0]))
+    z = np.zeros((n_barcodes, model.z_dim), dtype=np.float32)
+    d = np.zeros(n_barcodes, dtype=np.float32)
+    p = np.zeros(n_barcodes, dtype=np.float32)
 
     # Get chi ambient, if it was part of the model.
     chi_ambient = get_ambient_expression()
     if chi_ambient is not None:
         chi_ambient = torch.Tensor(chi_ambient).to(device=model.device)
 
+    # Get d_cell_scale from fit model.
+    d_sig = pyro.get_param_store().get_param('d_cell_scale').detach().cpu().item()
+
+    # Dense buffer re-used for each chunk of data.
+    buffer = np.zeros((chunk_size, model.n_genes), dtype=np.float32)
+
+    # Autograd is not needed (torch.inference_mode is not in older torch).
+    inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
     # Send dataset through the learned encoder in chunks.
-    s = 200
-    for i in np.arange(0, dataset.shape[0], s):
-
-        # Put chunk of data into a torch.Tensor.
-        x = torch.Tensor(np.array(
-            dataset[i:min(dataset.shape[0], i + s), :].todense(),
-            dtype=int).squeeze()).to(device=model.device)
-
-        # Send data chunk through encoder.
-        enc = model.encoder.forward(x, chi_ambient)
-
-        # Get d_cell_scale from fit model.
-        d_sig = \
-            pyro.get_param_store().get_param('d_cell_scale').detach().cpu().numpy()
-
-        # Put the resulting encodings into the appropriate numpy arrays.
-        z[i:min(dataset.shape[0], i + s), :] = \
-            enc['z']['loc'].detach().cpu().numpy()
-        d[i:min(dataset.shape[0], i + s)] = \
-            np.exp(enc['d_loc'].detach().cpu().numpy() + d_sig.item()**2 / 2)
-        try:  # p is not always available: it depends which model was used.
-            p[i:min(dataset.shape[0], i + s)] = \
-                enc['p_y'].detach().sigmoid().cpu().numpy()
-        except KeyError:
-            p = None  # Simple model gets None for p.
+    with inference_mode():
+        i = 0
+        for chunk in dataset_obj.get_count_matrix_chunks(barcode_inds,
+                                                         chunk_size=chunk_size):
+
+            # Fill the dense buffer with this chunk of sparse data.
+            n = chunk.shape[0]
+            x = buffer[:n]
+            x.fill(0.)
+            x[np.repeat(np.arange(n), np.diff(chunk.indptr)),
+              chunk.indices] = chunk.data
+
+            # Send data chunk through encoder.
+            enc = model.encoder.forward(torch.from_numpy(x)
+                                        .to(device=model.device), chi_ambient)
+
+            # Put the resulting encodings into the appropriate numpy arrays.
+            z[i:(i + n), :] = enc['z']['loc'].reshape(n, -1).cpu().numpy()
+            d[i:(i + n)] = np.exp(enc['d_loc'].reshape(n).cpu().numpy()
+                                  + d_sig ** 2 / 2)
+            try:  # p is not always available: it depends which model was used.
+                p[i:(i + n)] = enc['p_y'].reshape(n).sigmoid().cpu().numpy()
+            except KeyError:
+                p = None  # Simple model gets None for p.
+
+            i += n
 
     return z, d, p
 
@@ -714,7 +817,7 @@ def get_count_matrix_from_encodings(z: np.ndarray,
                                     p: Union[np.ndarray, None],
                                     model: VariationalInferenceModel,
                                     dataset_obj,
-                                    cells_only: bool = True) -> sp.csc.csc_matrix:
+                                    cells_only: bool = True) -> sp.csr.csr_matrix:
     """Make point estimate of the ambient-background-subtracted UMI count matrix.
 
     Sample counts by maximizing the model posterior based on learned latent
@@ -735,7 +838,8 @@ def get_count_matrix_from_encodings(z: np.ndarray,
     Returns:
         inferred_count_matrix: Matrix of the same dimensions as the input
             matrix, but where the UMI counts have had ambient-background
-            subtracted.
+            subtracted.  Rows are barcodes, in csr_matrix format, which is
+            the orientation in which it is written to file.
 
     Note:
         This currently uses the MAP estimate of draws from a Poisson (or a
@@ -795,6 +899,10 @@ def get_count_matrix_from_encodings(z: np.ndarray,
                                              d[i:last_ind_this_chunk],
                                              phi)
 
+        # Share the counts of any pooled rare genes among those genes.
+        chunk_dense_counts = dataset_obj.unpool_genes(
+            chunk_dense_counts, barcode_inds[i:last_ind_this_chunk])
+
         # Turn the floating point count estimates into integers.
         decimal_values, _ = np.modf(chunk_dense_counts)  # Stuff after decimal.
         roundoff_counts = np.random.binomial(1, p=decimal_values)  # Bernoulli.
@@ -817,16 +925,16 @@ def get_count_matrix_from_encodings(z: np.ndarray,
 
         # Append these to their lists.
         barcodes.extend(nonzero_barcodes.astype(dtype=np.uint32))
-        genes.extend(nonzero_genes.astype(dtype=np.uint16))
+        genes.extend(nonzero_genes.astype(dtype=np.int32))
         counts.extend(nonzero_counts.astype(dtype=np.uint32))
 
     # Convert the lists to numpy arrays.
     counts = np.array(counts, dtype=np.uint32)
     barcodes = np.array(barcodes, dtype=np.uint32)
-    genes = np.array(genes, dtype=np.uint16)
+    genes = np.array(genes, dtype=np.int32)
 
-    # Put the counts into a sparse csc_matrix.
-    inferred_count_matrix = sp.csc_matrix((counts, (barcodes, genes)),
+    # Put the counts into a sparse csr_matrix.
+    inferred_count_matrix = sp.csr_matrix((counts, (barcodes, genes)),
                                           shape=dataset_obj.data['matrix'].shape)
 
     return inferred_count_matrix
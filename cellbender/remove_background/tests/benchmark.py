@@ -0,0 +1,366 @@
+"""Benchmarks of the computational bottlenecks of remove_background.
+
+Times data loading, the likelihood, the encoders, a training step, and the
+post-processing routines on simulated datasets of several sizes.  Results are
+written to a JSON file, which can be compared against the results from a
+previous commit to look for performance regressions.
+
+Example:
+    $ python -m cellbender.remove_background.tests.benchmark \
+        --genes 1000 10000 --batch_size 128 500 --output new.json \
+        --baseline old.json --threshold 0.2
+
+"""
+
+import cellbender.remove_background.model
+from cellbender.remove_background.train import run_inference
+from cellbender.remove_background.data.simulate import simulate_ambient_dataset
+from cellbender.remove_background.data.dataset import Dataset
+from cellbender.remove_background.data.dataprep import DataLoader, \
+    sparse_collate
+from cellbender.remove_background.distributions.NegativeBinomial \
+    import NegativeBinomial
+import cellbender.remove_background.data.transform as transform
+from cellbender.remove_background.tests.test import ObjectWithAttributes
+
+import numpy as np
+import torch
+import pyro
+from pyro.infer import SVI, JitTraceEnum_ELBO, JitTrace_ELBO
+from pyro.optim import ClippedAdam
+
+from typing import Callable, Dict, List, Union
+import argparse
+import itertools
+import json
+import platform
+import subprocess
+import sys
+import time
+import warnings
+
+
+def time_function(fn: Callable,
+                  repeats: int = 5,
+                  warmup: int = 1) -> Dict[str, float]:
+    """Time repeated calls to a function.
+
+    Args:
+        fn: Function, called without arguments.
+        repeats: Number of timed calls.
+        warmup: Number of untimed calls made first (e.g. for Jit compilation).
+
+    Returns:
+        Summary statistics of the wall time of one call, in seconds.
+
+    """
+
+    for _ in range(warmup):
+        fn()
+
+    times = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+
+    return {'median': float(np.median(times)),
+            'min': float(np.min(times)),
+            'mean': float(np.mean(times)),
+            'repeats': repeats}
+
+
+def make_args(model: str) -> ObjectWithAttributes:
+    """Fake some parsed command line inputs, using the tool's defaults."""
+
+    args = ObjectWithAttributes()
+    args.use_cuda = False
+    args.z_hidden_dims = [500]
+    args.d_hidden_dims = [5, 2, 2]
+    args.p_hidden_dims = [100, 10]
+    args.z_dim = 20
+    args.learning_rate = 1e-3
+    args.epochs = 0
+    args.model = [model]
+    args.use_decaying_average_baseline = False
+    args.use_IAF = False
+    args.fraction_empties = 0.5
+    args.empty_drop_sampling = 'uniform'
+    args.memory_budget = None
+    args.dense_threshold_gb = 2.
+    args.sparse_input = False
+    args.encoder_genes = None
+    args.encoder_gene_selection = 'variance'
+    args.likelihood_genes = None
+    args.decoder_rank = None
+    args.training_fraction = 0.9
+
+    return args
+
+
+def make_dataset(n_genes: int, n_barcodes: int, model: str) -> Dataset:
+    """Simulate a dataset and wrap it in a trimmed Dataset object.
+
+    One quarter of the barcodes contain cells and the rest are empty.
+
+    """
+
+    n_cells = max(1, n_barcodes // 4)
+    csr, _, _, _ = simulate_ambient_dataset(n_cells=n_cells,
+                                            n_empty=n_barcodes - n_cells,
+                                            clusters=1, n_genes=n_genes,
+                                            d_cell=2000, d_empty=100)
+
+    dataset_obj = Dataset(transformation=transform.IdentityTransform(),
+                          model_name=model)
+    dataset_obj.data = \
+        {'matrix': csr,
+         'gene_names': np.array([f'g{n}' for n in range(csr.shape[1])]),
+         'barcodes': np.array([f'bc{n}' for n in range(csr.shape[0])])}
+    dataset_obj.priors['n_cells'] = n_cells
+    dataset_obj._trim_dataset_for_analysis(num_transition_barcodes=n_cells)
+    dataset_obj._estimate_priors()
+
+    return dataset_obj
+
+
+def run_case(n_genes: int,
+             n_barcodes: int,
+             batch_size: int,
+             model_type: str,
+             repeats: int = 5) -> List[Dict]:
+    """Run all the benchmarks for one combination of sizes and model.
+
+    Args:
+        n_genes: Number of genes in the simulated dataset.
+        n_barcodes: Number of barcodes in the simulated dataset.
+        batch_size: Minibatch size used for training.
+        model_type: Model, one of ['simple', 'ambient', 'swapping', 'full'].
+        repeats: Number of timed repeats of each benchmark.
+
+    Returns:
+        List of results, one per benchmark, as dicts.
+
+    """
+
+    params = {'genes': n_genes, 'barcodes': n_barcodes,
+              'batch_size': batch_size, 'model': model_type}
+    results = []
+
+    def record(name: str, timing: Dict[str, float]):
+        results.append({'name': name, 'params': params, **timing})
+        sys.stdout.write(f"{name:<36} {params}  "
+                         f"{timing['median'] * 1e3:10.2f} ms\n")
+        sys.stdout.flush()
+
+    # Set up the dataset and an (untrained) model.
+    np.random.seed(0)
+    dataset_obj = make_dataset(n_genes, n_barcodes, model_type)
+    args = make_args(model_type)
+    inferred_model = run_inference(dataset_obj, args)
+    count_matrix = dataset_obj.get_count_matrix()
+    empty_matrix = dataset_obj.get_count_matrix_empties()
+    batch_size = min(batch_size, count_matrix.shape[0])
+
+    # Densification of a minibatch of sparse rows.
+    inds = np.random.choice(count_matrix.shape[0], size=batch_size)
+    record('sparse_collate',
+           time_function(lambda: sparse_collate([count_matrix[inds, :]]),
+                         repeats=repeats))
+
+    # One full epoch of the DataLoader, per minibatch.
+    loader = DataLoader(dataset=count_matrix,
+                        empty_drop_dataset=empty_matrix,
+                        batch_size=batch_size,
+                        fraction_empties=args.fraction_empties,
+                        shuffle=True,
+                        use_cuda=False)
+    n_batches = max(1, sum(1 for _ in loader))
+    epoch_timing = time_function(lambda: [None for _ in loader],
+                                 repeats=repeats)
+    record('dataloader_per_batch',
+           {key: (value / n_batches if key != 'repeats' else value)
+            for key, value in epoch_timing.items()})
+
+    # A dense minibatch used for the remaining benchmarks.
+    x, mask = next(iter(loader))
+    loader._reset()
+
+    # Likelihood of a minibatch.
+    mu = x.mean(dim=0, keepdim=True).expand_as(x) + 1.
+    phi = torch.tensor(0.2)
+    nb = NegativeBinomial(total_count=1. / phi, logits=torch.log(mu * phi))
+    record('negative_binomial_log_prob',
+           time_function(lambda: nb.log_prob(x).sum(), repeats=repeats))
+
+    # One step of stochastic variational inference.  (This also creates the
+    # model's global params in the param store, e.g. chi_ambient.)
+    if model_type == 'simple':
+        loss_function = JitTrace_ELBO()
+    else:
+        loss_function = JitTraceEnum_ELBO(max_plate_nesting=1,
+                                          strict_enumeration_warning=False)
+    svi = SVI(inferred_model.model, inferred_model.guide,
+              ClippedAdam({'lr': args.learning_rate}), loss=loss_function)
+    record('svi_step',
+           time_function(lambda: svi.step(x, mask), repeats=repeats,
+                         warmup=2))
+
+    # Encoder forward pass.
+    chi_ambient = cellbender.remove_background.model.get_ambient_expression()
+    if chi_ambient is not None:
+        chi_ambient = torch.Tensor(chi_ambient)
+    record('composite_encoder_forward',
+           time_function(lambda: inferred_model.encoder.forward(x, chi_ambient),
+                         repeats=repeats))
+
+    # Post-processing.
+    record('get_encodings',
+           time_function(lambda: cellbender.remove_background.model.
+                         get_encodings(inferred_model, dataset_obj,
+                                       cells_only=True),
+                         repeats=repeats))
+    z, d, p = cellbender.remove_background.model.\
+        get_encodings(inferred_model, dataset_obj, cells_only=True)
+    if p is not None:
+        p = np.ones_like(p)  # An untrained model calls few cells: use them all
+    record('get_count_matrix_from_encodings',
+           time_function(lambda: cellbender.remove_background.model.
+                         get_count_matrix_from_encodings(z.copy(), d.copy(),
+                                                         None if p is None
+                                                         else p.copy(),
+                                                         inferred_model,
+                                                         dataset_obj,
+                                                         cells_only=True),
+                         repeats=repeats))
+
+    return results
+
+
+def get_metadata() -> Dict[str, str]:
+    """Describe the code version and the machine the benchmarks ran on."""
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL,
+                                universal_newlines=True).stdout.strip()
+    except OSError:
+        commit = ''
+
+    return {'commit': commit,
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'pyro': pyro.__version__,
+            'numpy': np.__version__,
+            'machine': platform.platform(),
+            'threads': torch.get_num_threads()}
+
+
+def result_key(result: Dict) -> str:
+    """A key that identifies a benchmark with its parameters."""
+
+    return result['name'] + json.dumps(result['params'], sort_keys=True)
+
+
+def compare_to_baseline(results: List[Dict],
+                        baseline: List[Dict],
+                        threshold: float = 0.1) -> List[Dict]:
+    """Compare benchmark results with those of a previous run.
+
+    Args:
+        results: Benchmark results from this run.
+        baseline: Benchmark results from a previous run.
+        threshold: A benchmark whose median time increased by more than this
+            fraction is considered a regression.
+
+    Returns:
+        List of the results which are regressions, each with the baseline
+            time and the ratio of new to old times added.
+
+    """
+
+    baseline_times = {result_key(r): r['median'] for r in baseline}
+    regressions = []
+
+    sys.stdout.write(f"\n{'benchmark':<36} {'ratio':>8}\n")
+    for result in results:
+        old = baseline_times.get(result_key(result), None)
+        if old is None or old <= 0:
+            continue
+        ratio = result['median'] / old
+        flag = ''
+        if ratio > 1. + threshold:
+            flag = '  REGRESSION'
+            regressions.append({**result, 'baseline': old, 'ratio': ratio})
+        sys.stdout.write(f"{result['name']:<36} {ratio:8.2f}"
+                         f"  {result['params']}{flag}\n")
+
+    return regressions
+
+
+def main(argv: Union[List[str], None] = None) -> int:
+    """Run benchmarks from the command line.
+
+    Returns:
+        Exit code: 1 if any regressions were found relative to a baseline.
+
+    """
+
+    parser = argparse.ArgumentParser(description="Benchmark remove_background.")
+    parser.add_argument("--genes", nargs="+", type=int, default=[1000, 10000],
+                        help="Numbers of genes in the simulated datasets.")
+    parser.add_argument("--barcodes", nargs="+", type=int, default=[2000],
+                        help="Numbers of barcodes in the simulated datasets.")
+    parser.add_argument("--batch_size", nargs="+", type=int, default=[128, 500],
+                        help="Minibatch sizes.")
+    parser.add_argument("--model", nargs="+", type=str, default=["full"],
+                        choices=["simple", "ambient", "swapping", "full"],
+                        help="Models to benchmark.")
+    parser.add_argument("--repeats", type=int, default=5,
+                        help="Number of timed repeats of each benchmark.")
+    parser.add_argument("--output", type=str, default="benchmark.json",
+                        help="Output JSON file for the results.")
+    parser.add_argument("--baseline", type=str, default=None,
+                        help="JSON results from a previous run to compare to.")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Fractional increase in median time which counts "
+                             "as a regression.")
+    args = parser.parse_args(argv)
+
+    # This is here to suppress the numpy warning triggered by scipy.sparse.
+    warnings.simplefilter("ignore")
+    pyro.enable_validation(False)
+
+    # Run every combination of sizes and models.
+    results = []
+    for n_genes, n_barcodes, batch_size, model_type in \
+            itertools.product(args.genes, args.barcodes,
+                              args.batch_size, args.model):
+        results.extend(run_case(n_genes=n_genes,
+                                n_barcodes=n_barcodes,
+                                batch_size=batch_size,
+                                model_type=model_type,
+                                repeats=args.repeats))
+
+    with open(args.output, 'w') as f:
+        json.dump({'metadata': get_metadata(), 'results': results}, f, indent=2)
+    sys.stdout.write(f"Wrote benchmark results to {args.output}\n")
+
+    # Compare to a baseline run, if one was given.
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = compare_to_baseline(results, baseline,
+                                          threshold=args.threshold)
+        if len(regressions) > 0:
+            sys.stdout.write(f"\n{len(regressions)} benchmarks regressed by "
+                             f"more than {args.threshold:.0%}.\n")
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
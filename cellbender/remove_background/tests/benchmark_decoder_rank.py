@@ -0,0 +1,218 @@
+"""Benchmark of the trade-off between decoder output rank, speed, and ELBO.
+
+Trains the full model on a synthetic dataset with many expressed genes, once
+with a full-rank decoder output layer and once for each of several ranks of
+a factorized output layer (see --decoder_rank), and records the number of
+decoder parameters, the training time, the time of one SVI step and of a
+decoder forward and backward pass, and the final train and test ELBO.  Each
+rank is trained in a fresh process, so that memory is not carried over.
+
+The encoders and the likelihood also scale with the number of genes, so the
+share of the decoder in an SVI step is largest with --encoder_genes and
+--likelihood_genes, which are passed on to training.
+
+Example:
+    $ python -m cellbender.remove_background.tests.benchmark_decoder_rank \
+        --genes 30000 --ranks 256 64 16 --epochs 20 --output ranks.json
+
+"""
+
+from cellbender.remove_background.train import run_inference
+from cellbender.remove_background.data.dataset import Dataset
+from cellbender.remove_background.data.dataprep import DataLoader
+import cellbender.remove_background.data.transform as transform
+from cellbender.remove_background.tests.benchmark import make_args, \
+    time_function
+
+import numpy as np
+import scipy.sparse as sp
+import torch
+from pyro.infer import SVI, JitTraceEnum_ELBO
+from pyro.optim import ClippedAdam
+
+from typing import Dict, List, Union
+import argparse
+import json
+import multiprocessing
+import sys
+import time
+import warnings
+
+
+def make_dataset(n_genes: int,
+                 n_cells: int = 500,
+                 n_empty_droplets: int = 3000,
+                 n_clusters: int = 3,
+                 cell_counts: float = 5000.,
+                 empty_counts: float = 200.,
+                 seed: int = 0) -> Dataset:
+    """Make a trimmed Dataset with many expressed genes.
+
+    Cells of each cluster have log-normally distributed gene expression, and
+    empty droplets contain ambient RNA, which is the average expression of
+    the cells.  Total counts per droplet are log-normally distributed.
+
+    """
+
+    rng = np.random.RandomState(seed)
+
+    # Gene expression profiles of each cluster, and of ambient RNA.
+    profiles = rng.lognormal(0., 1.5, size=(n_clusters, n_genes))
+    profiles = profiles / profiles.sum(axis=1, keepdims=True)
+    clusters = rng.randint(n_clusters, size=n_cells)
+    ambient = profiles[clusters].mean(axis=0)
+
+    # Poisson counts for cells (plus some ambient RNA) and empty droplets.
+    cell_sizes = rng.lognormal(np.log(cell_counts), 0.3, size=(n_cells, 1))
+    empty_sizes = rng.lognormal(np.log(empty_counts), 0.3,
+                                size=(n_empty_droplets, 1))
+    cells = rng.poisson(cell_sizes * profiles[clusters]
+                        + empty_counts * ambient)
+    empties = rng.poisson(empty_sizes * ambient)
+    matrix = sp.csr_matrix(np.vstack([cells, empties]).astype(np.int32))
+
+    dataset = Dataset(transformation=transform.IdentityTransform(),
+                      model_name='full')
+    dataset.data = {'matrix': matrix,
+                    'gene_names': np.array([f'g{i}' for i in range(n_genes)]),
+                    'barcodes': np.array([f'bc{i}'
+                                          for i in range(matrix.shape[0])])}
+    dataset.priors['n_cells'] = n_cells
+    dataset._trim_dataset_for_analysis(num_transition_barcodes=n_cells)
+    dataset._estimate_priors()
+
+    return dataset
+
+
+def run_case(n_genes: int,
+             n_cells: int,
+             rank: Union[int, None],
+             epochs: int,
+             batch_size: int,
+             repeats: int,
+             encoder_genes: Union[int, None] = None,
+             likelihood_genes: Union[int, None] = None) \
+        -> Dict[str, Union[int, float, None]]:
+    """Train with one decoder output rank, and time and score the result."""
+
+    warnings.simplefilter("ignore")
+
+    dataset = make_dataset(n_genes, n_cells=n_cells)
+
+    args = make_args('full')
+    args.decoder_rank = rank
+    args.epochs = epochs
+    args.encoder_genes = encoder_genes
+    args.likelihood_genes = likelihood_genes
+
+    # Train (this includes Jit compilation in the first epoch).
+    t = time.perf_counter()
+    model = run_inference(dataset, args)
+    train_s = time.perf_counter() - t
+
+    decoder = model.decoder
+    results = {'rank': rank,
+               'genes': dataset.get_num_model_genes(),
+               'decoder_parameters': sum(p.numel() for p in
+                                         decoder.parameters()),
+               'train_s': train_s,
+               'final_train_elbo': model.loss['train']['elbo'][-1],
+               'final_test_elbo': (model.loss['test']['elbo'][-1]
+                                   if len(model.loss['test']['elbo']) > 0
+                                   else None)}
+
+    # One SVI step on a fixed minibatch.
+    loader = DataLoader(dataset=dataset.get_count_matrix(),
+                        empty_drop_dataset=dataset.get_count_matrix_empties(),
+                        batch_size=batch_size,
+                        fraction_empties=args.fraction_empties,
+                        shuffle=True,
+                        use_cuda=False)
+    x, mask = next(iter(loader))
+    svi = SVI(model.model, model.guide,
+              ClippedAdam({'lr': args.learning_rate}),
+              loss=JitTraceEnum_ELBO(max_plate_nesting=1,
+                                     strict_enumeration_warning=False))
+    results['svi_step_s'] = time_function(lambda: svi.step(x, mask),
+                                          repeats=repeats,
+                                          warmup=2)['median']
+
+    # Decoder forward and backward pass, as in training.
+    z = torch.randn(batch_size, args.z_dim)
+
+    def decode():
+        decoder.zero_grad()
+        decoder(z).sum().backward()
+
+    results['decoder_s'] = time_function(decode, repeats=repeats)['median']
+
+    return results
+
+
+def run_case_to_queue(queue: multiprocessing.Queue, kwargs: Dict):
+    """Run a case (in a separate process) and put its results in a queue."""
+
+    queue.put(run_case(**kwargs))
+
+
+def run_case_in_fresh_process(**kwargs) -> Dict[str, Union[int, float, None]]:
+    """Run a case in a fresh process, with the arguments of run_case()."""
+
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=run_case_to_queue, args=(queue, kwargs))
+    process.start()
+    process.join()  # The queue only ever holds one small dict
+    if process.exitcode != 0:
+        raise RuntimeError(f"Training failed for decoder rank {kwargs['rank']}")
+
+    return queue.get()
+
+
+def main(argv: Union[List[str], None] = None):
+    """Run the benchmark from the command line."""
+
+    parser = argparse.ArgumentParser(description="Benchmark decoder output "
+                                                 "ranks.")
+    parser.add_argument("--genes", type=int, default=30000,
+                        help="Number of genes in the simulated dataset.")
+    parser.add_argument("--cells", type=int, default=500,
+                        help="Number of cells in the simulated dataset.")
+    parser.add_argument("--ranks", nargs="+", type=int, default=[256, 64, 16],
+                        help="Ranks of the factorized decoder output layer, "
+                             "compared to a full-rank output layer.")
+    parser.add_argument("--epochs", type=int, default=20,
+                        help="Number of training epochs.")
+    parser.add_argument("--encoder_genes", type=int, default=None,
+                        help="Number of genes input to the encoders.")
+    parser.add_argument("--likelihood_genes", type=int, default=None,
+                        help="Number of genes sampled for the likelihood.")
+    parser.add_argument("--batch_size", type=int, default=128,
+                        help="Minibatch size for the timed SVI step.")
+    parser.add_argument("--repeats", type=int, default=5,
+                        help="Number of timed repeats.")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Output JSON file for the results.")
+    args = parser.parse_args(argv)
+
+    results = []
+    for rank in [None] + args.ranks:
+        results.append(run_case_in_fresh_process(
+            n_genes=args.genes,
+            n_cells=args.cells,
+            rank=rank,
+            epochs=args.epochs,
+            batch_size=args.batch_size,
+            repeats=args.repeats,
+            encoder_genes=args.encoder_genes,
+            likelihood_genes=args.likelihood_genes))
+        sys.stdout.write(json.dumps(results[-1]) + '\n')
+        sys.stdout.flush()
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
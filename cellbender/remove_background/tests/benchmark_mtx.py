@@ -0,0 +1,206 @@
+"""Benchmark of reading a CellRanger mtx directory.
+
+Writes a random CellRanger v3 style directory of about the requested size:
+matrix.mtx (genes by barcodes, integer UMI counts), features.tsv, and
+barcodes.tsv, optionally all gzipped, with a few features that are not
+'Gene Expression'.  It then times:
+    mmread_to_csr: scipy.io.mmread() followed by transpose().tocsr(), which
+        is how the matrix used to be converted to barcodes by genes;
+    read_mtx: read_mtx(), which parses with mmread() and builds the
+        csr_matrix of barcodes by genes directly from the triplets;
+    get_matrix_from_mtx: reading the whole directory, including the gzipped
+        text files and the removal of non-gene-expression features;
+and checks that all of them give the same matrix.
+
+The matrix is parsed by scipy.io.mmread() in every case, so this does not
+benchmark a parallel parser (read_mtx() no longer has one).
+
+Example:
+    $ python -m cellbender.remove_background.tests.benchmark_mtx \
+        --size_gb 1 --gzip --output_dir mtx_benchmark
+
+"""
+
+from cellbender.remove_background.data.dataset import read_mtx, \
+    open_maybe_gzipped, get_matrix_from_mtx
+
+import numpy as np
+import scipy.io as io
+import scipy.sparse as sp
+
+from typing import Dict, List, Union
+import argparse
+import gzip
+import json
+import os
+import shutil
+import sys
+import time
+
+
+def write_random_mtx(filename: str,
+                     size_gb: float,
+                     n_genes: int = 33694,
+                     n_barcodes: int = 737280,
+                     chunk_entries: int = 10**6) -> int:
+    """Write a random integer Matrix Market file of about size_gb gigabytes.
+
+    Args:
+        filename: Output file.  Gzipped if it ends in .gz.
+        size_gb: Approximate size of the (uncompressed) text, in GB.
+        n_genes: Number of rows.
+        n_barcodes: Number of columns.
+        chunk_entries: Number of entries formatted and written at a time.
+
+    Returns:
+        Number of nonzero entries written.
+
+    """
+
+    # Estimate the number of entries from the bytes per line.
+    bytes_per_line = len(f'{n_genes // 2} {n_barcodes // 2} 2\n')
+    nnz = int(size_gb * 1e9 / bytes_per_line)
+
+    rng = np.random.RandomState(0)
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'wb') as f:
+        f.write(b'%%MatrixMarket matrix coordinate integer general\n')
+        f.write(f'{n_genes} {n_barcodes} {nnz}\n'.encode())
+
+        # Entries are sorted by barcode, then gene, as in CellRanger output.
+        barcode_start = 0
+        for start in range(0, nnz, chunk_entries):
+            n = min(chunk_entries, nnz - start)
+            barcode_end = barcode_start + n_barcodes * n // nnz
+            barcode = rng.randint(barcode_start, max(barcode_start + 1,
+                                                     barcode_end), size=n)
+            gene = rng.randint(0, n_genes, size=n)
+            order = np.lexsort((gene, barcode))
+            entries = np.stack([gene[order] + 1,
+                                barcode[order] + 1,
+                                rng.geometric(0.5, size=n)], axis=1)
+            np.savetxt(f, entries, fmt='%d')
+            barcode_start = max(barcode_start + 1, barcode_end)
+
+    return nnz
+
+
+def write_tsv_files(output_dir: str,
+                    n_genes: int,
+                    n_barcodes: int,
+                    n_other_features: int = 10,
+                    gzipped: bool = False) -> np.ndarray:
+    """Write features.tsv and barcodes.tsv for a CellRanger v3 directory.
+
+    The first n_other_features features are 'Antibody Capture', and the
+    rest are 'Gene Expression'.
+
+    Returns:
+        Boolean array which is True for gene expression features.
+
+    """
+
+    suffix = '.gz' if gzipped else ''
+    opener = gzip.open if gzipped else open
+    is_gene_expression = np.arange(n_genes) >= n_other_features
+    with opener(os.path.join(output_dir, 'features.tsv' + suffix), 'wt') as f:
+        for i in range(n_genes):
+            feature_type = 'Gene Expression' if is_gene_expression[i] \
+                else 'Antibody Capture'
+            f.write(f'ENSG{i}\tg_{i}\t{feature_type}\n')
+    with opener(os.path.join(output_dir, 'barcodes.tsv' + suffix), 'wt') as f:
+        for i in range(n_barcodes):
+            f.write(f'bc_{i}-1\n')
+
+    return is_gene_expression
+
+
+def time_reader(fn, repeats: int) -> Dict[str, float]:
+    """Time repeated calls to a reader, returning the last matrix read."""
+
+    times = []
+    matrix = None
+    for _ in range(repeats):
+        t = time.perf_counter()
+        matrix = fn()
+        times.append(time.perf_counter() - t)
+    return {'median_s': float(np.median(times)),
+            'min_s': float(np.min(times))}, matrix
+
+
+def main(argv: Union[List[str], None] = None):
+    """Run the benchmark from the command line."""
+
+    parser = argparse.ArgumentParser(description="Benchmark reading a "
+                                                 "CellRanger mtx directory.")
+    parser.add_argument("--size_gb", type=float, default=1.,
+                        help="Approximate size of the matrix.mtx text in GB.")
+    parser.add_argument("--gzip", action="store_true",
+                        help="Benchmark reading a gzipped directory.")
+    parser.add_argument("--repeats", type=int, default=1,
+                        help="Number of timed repeats of each reader.")
+    parser.add_argument("--output_dir", type=str, default="mtx_benchmark",
+                        help="Directory for the simulated files and results.")
+    parser.add_argument("--keep_files", action="store_true",
+                        help="Keep the simulated files, and reuse them if "
+                             "they already exist.")
+    args = parser.parse_args(argv)
+
+    n_genes, n_barcodes = 33694, 737280
+    mtx_dir = os.path.join(args.output_dir, 'mtx')
+    os.makedirs(mtx_dir, exist_ok=True)
+    filename = os.path.join(mtx_dir,
+                            'matrix.mtx' + ('.gz' if args.gzip else ''))
+
+    # Write the files.
+    if not (args.keep_files and os.path.exists(filename)):
+        sys.stdout.write(f"Writing {mtx_dir}\n")
+        sys.stdout.flush()
+        write_random_mtx(filename, size_gb=args.size_gb,
+                         n_genes=n_genes, n_barcodes=n_barcodes)
+    is_gene_expression = write_tsv_files(mtx_dir, n_genes=n_genes,
+                                         n_barcodes=n_barcodes,
+                                         gzipped=args.gzip)
+    results = {'file': filename,
+               'file_gb': os.path.getsize(filename) / 1e9}
+
+    def report(key: str):
+        sys.stdout.write(f"{key}: {results[key]['median_s']:.2f} s\n")
+        sys.stdout.flush()
+
+    # scipy.io.mmread(), converted to a csr_matrix of barcodes by genes.
+    def read_with_mmread():
+        with open_maybe_gzipped(filename) as f:
+            return io.mmread(f).transpose().tocsr()
+
+    results['mmread_to_csr'], reference = time_reader(read_with_mmread,
+                                                      args.repeats)
+    report('mmread_to_csr')
+
+    # read_mtx(), which builds the csr_matrix directly.
+    results['read_mtx'], matrix = time_reader(lambda: read_mtx(filename,
+                                                               transpose=True),
+                                              args.repeats)
+    report('read_mtx')
+    assert (matrix.shape == reference.shape) \
+        and ((matrix != reference).nnz == 0), \
+        "read_mtx() and mmread() read different matrices."
+
+    # The whole directory.
+    results['get_matrix_from_mtx'], data = \
+        time_reader(lambda: get_matrix_from_mtx(mtx_dir), args.repeats)
+    report('get_matrix_from_mtx')
+    assert (data['matrix'] != reference[:, is_gene_expression]).nnz == 0, \
+        "get_matrix_from_mtx() and mmread() read different matrices."
+    assert data['gene_names'].size == is_gene_expression.sum()
+    assert data['barcodes'].size == n_barcodes
+
+    with open(os.path.join(args.output_dir, 'mtx_benchmark.json'), 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if not args.keep_files:
+        shutil.rmtree(mtx_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+"""End-to-end scaling benchmark of remove_background.
+
+Runs the whole run_remove_background() pipeline on simulated raw datasets of
+increasing size, recording the wall time and the peak resident memory of each
+stage (loading and trimming the data, inference, and writing output), and
+plots scaling curves.  Each dataset is run in a fresh process, so that the
+memory measurements of one run do not contaminate the next.
+
+Example:
+    $ python -m cellbender.remove_background.tests.benchmark_scaling \
+        --barcodes 10000 100000 500000 2000000 --genes 5000 35000 \
+        --epochs 5 --output_dir scaling
+
+"""
+
+import cellbender.remove_background.command_line as command_line
+from cellbender.remove_background.data.simulate import \
+    simulate_ambient_dataset_to_h5
+
+from typing import Callable, Dict, List, Union
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+import warnings
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt  # This needs to be after matplotlib.use('Agg')
+
+
+STAGES = ['load_and_trim', 'inference', 'write_output']
+
+
+class MemorySampler(threading.Thread):
+    """Background thread that keeps track of peak resident memory.
+
+    Resident memory is read from /proc/self/statm every interval seconds.
+    Where that is not available, the process-lifetime maximum resident set
+    size from getrusage() is used instead.
+
+    """
+
+    def __init__(self, interval: float = 0.01):
+        super(MemorySampler, self).__init__(daemon=True)
+        self.interval = interval
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        self.peak = 0
+        self._stop_event = threading.Event()
+
+    def current(self) -> int:
+        """Current resident memory in bytes."""
+        try:
+            with open('/proc/self/statm', 'r') as f:
+                return int(f.read().split()[1]) * self.page_size
+        except OSError:
+            # ru_maxrss is in kilobytes on Linux.
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def reset(self):
+        """Start tracking a new peak from the current memory usage."""
+        self.peak = self.current()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.peak = max(self.peak, self.current())
+            time.sleep(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def record_stage(name: str,
+                 fn: Callable,
+                 sampler: MemorySampler,
+                 stages: Dict[str, Dict[str, float]]) -> Callable:
+    """Wrap a function so that each call records its time and peak memory."""
+
+    def wrapped(*args, **kwargs):
+        sampler.reset()
+        t = time.perf_counter()
+        out = fn(*args, **kwargs)
+        stages[name] = {'seconds': time.perf_counter() - t,
+                        'peak_memory_gb': max(sampler.peak,
+                                              sampler.current()) / 1e9}
+        return out
+
+    return wrapped
+
+
+def run_pipeline(input_file: str,
+                 output_file: str,
+                 cli_args: List[str],
+                 queue: multiprocessing.Queue):
+    """Run remove_background on one file, reporting stage timings to a queue.
+
+    This runs in a child process.  The stages called by run_remove_background()
+    are wrapped in place to record their time and peak memory.
+
+    """
+
+    warnings.simplefilter("ignore")
+
+    # Parse arguments exactly as the command line tool does.
+    cli = command_line.CLI()
+    parser = argparse.ArgumentParser()
+    cli.add_subparser_args(parser.add_subparsers(dest="tool"))
+    args = parser.parse_args([cli.get_name(),
+                              '--input', input_file,
+                              '--output', output_file] + cli_args)
+    args = cli.validate_args(args)
+
+    # Wrap each stage of the pipeline.
+    stages = {}
+    sampler = MemorySampler()
+    sampler.start()
+    dataset_class = command_line.Dataset
+    command_line.Dataset = record_stage('load_and_trim', dataset_class,
+                                        sampler, stages)
+    command_line.run_inference = record_stage('inference',
+                                              command_line.run_inference,
+                                              sampler, stages)
+    dataset_class.save_to_output_file = \
+        record_stage('write_output', dataset_class.save_to_output_file,
+                     sampler, stages)
+
+    # Run the whole pipeline.
+    sampler.reset()
+    t = time.perf_counter()
+    command_line.run_remove_background(args)
+    stages['total'] = {'seconds': time.perf_counter() - t,
+                       'peak_memory_gb':
+                           resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                           * 1024 / 1e9}
+    sampler.stop()
+
+    queue.put(stages)
+
+
+def run_case(n_genes: int,
+             n_barcodes: int,
+             n_cells: int,
+             output_dir: str,
+             cli_args: List[str],
+             keep_files: bool = False) -> Dict:
+    """Simulate a raw dataset and benchmark the pipeline on it.
+
+    Args:
+        n_genes: Number of genes in the simulated dataset.
+        n_barcodes: Total number of barcodes in the simulated dataset.
+        n_cells: Number of barcodes that contain cells.
+        output_dir: Directory for the simulated input and the outputs.
+        cli_args: Additional command line arguments for remove_background.
+        keep_files: If True, keep the simulated input for the next run, and
+            reuse one from a previous run if it exists.
+
+    Returns:
+        The sizes of the dataset and the time and peak memory of each stage.
+
+    """
+
+    name = f'raw_{n_barcodes}_barcodes_{n_genes}_genes'
+    input_file = os.path.join(output_dir, name + '.h5')
+    output_file = os.path.join(output_dir, name + '_output.h5')
+
+    # Simulate the raw dataset.
+    if not (keep_files and os.path.exists(input_file)):
+        sys.stdout.write(f"Simulating {input_file}\n")
+        sys.stdout.flush()
+        simulate_ambient_dataset_to_h5(input_file,
+                                       n_cells=n_cells,
+                                       n_empty=n_barcodes - n_cells,
+                                       clusters=3,
+                                       n_genes=n_genes,
+                                       d_cell=5000,
+                                       d_empty=100)
+
+    # Run the pipeline in a fresh process.
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=run_pipeline,
+                          args=(input_file, output_file, cli_args, queue))
+    process.start()
+    process.join()  # The queue only ever holds one small dict
+    if process.exitcode != 0:
+        raise RuntimeError(f"remove_background failed on {input_file}")
+    stages = queue.get()
+
+    result = {'genes': n_genes, 'barcodes': n_barcodes, 'cells': n_cells,
+              'input_file_gb': os.path.getsize(input_file) / 1e9,
+              'stages': stages}
+    sys.stdout.write(json.dumps(result) + '\n')
+    sys.stdout.flush()
+
+    # Clean up.
+    file_base = os.path.splitext(output_file)[0]
+    for suffix in ['.h5', '_filtered.h5', '_cell_barcodes.csv', '.pdf', '.log']:
+        if os.path.exists(file_base + suffix):
+            os.remove(file_base + suffix)
+    if not keep_files:
+        os.remove(input_file)
+
+    return result
+
+
+def plot_scaling(results: List[Dict], file_name: str):
+    """Plot wall time and peak memory of each stage against dataset size."""
+
+    plt.figure(figsize=(12, 5 * len(STAGES + ['total'])))
+    gene_counts = sorted(set(r['genes'] for r in results))
+
+    for i, stage in enumerate(STAGES + ['total']):
+        for j, (key, label) in enumerate([('seconds', 'Wall time (s)'),
+                                          ('peak_memory_gb',
+                                           'Peak memory (GB)')]):
+            plt.subplot(len(STAGES) + 1, 2, 2 * i + j + 1)
+            for n_genes in gene_counts:
+                runs = sorted([r for r in results if r['genes'] == n_genes],
+                              key=lambda r: r['barcodes'])
+                plt.loglog([r['barcodes'] for r in runs],
+                           [r['stages'][stage][key] for r in runs],
+                           'o-', label=f'{n_genes} genes')
+            plt.xlabel('Barcodes in raw dataset')
+            plt.ylabel(label)
+            plt.title(stage)
+            plt.legend()
+
+    plt.tight_layout()
+    plt.savefig(file_name, bbox_inches='tight')
+
+
+def main(argv: Union[List[str], None] = None):
+    """Run the scaling benchmark from the command line."""
+
+    parser = argparse.ArgumentParser(description="Scaling benchmark of "
+                                                 "remove_background.")
+    parser.add_argument("--barcodes", nargs="+", type=int,
+                        default=[10000, 100000, 500000, 2000000],
+                        help="Total numbers of barcodes in the raw datasets.")
+    parser.add_argument("--genes", nargs="+", type=int,
+                        default=[5000, 15000, 35000],
+                        help="Numbers of genes in the raw datasets.")
+    parser.add_argument("--cells", type=int, default=5000,
+                        help="Number of cells in each dataset (at most half "
+                             "the barcodes).")
+    parser.add_argument("--epochs", type=int, default=5,
+                        help="Number of epochs to train.")
+    parser.add_argument("--output_dir", type=str, default="scaling_benchmark",
+                        help="Directory for simulated data and results.")
+    parser.add_argument("--keep_files", action="store_true",
+                        help="Keep simulated datasets, and reuse them if "
+                             "they already exist.")
+    parser.add_argument("--extra_args", nargs=argparse.REMAINDER, default=[],
+                        help="Any further arguments are passed to "
+                             "remove_background.")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    warnings.simplefilter("ignore")
+
+    cli_args = ['--epochs', str(args.epochs)] + args.extra_args
+    results = []
+    for n_genes, n_barcodes in itertools.product(args.genes, args.barcodes):
+        n_cells = min(args.cells, n_barcodes // 2)
+        results.append(run_case(n_genes=n_genes,
+                                n_barcodes=n_barcodes,
+                                n_cells=n_cells,
+                                output_dir=args.output_dir,
+                                cli_args=cli_args,
+                                keep_files=args.keep_files))
+
+        # Save after every run, since large runs take a long time.
+        with open(os.path.join(args.output_dir, 'scaling.json'), 'w') as f:
+            json.dump(results, f, indent=2)
+
+    plot_scaling(results, os.path.join(args.output_dir, 'scaling.pdf'))
+
+    # Summarize.
+    sys.stdout.write(f"\n{'genes':>8} {'barcodes':>10} "
+                     + ' '.join(f'{s + " (s, GB)":>26}' for s in STAGES) + '\n')
+    for r in results:
+        sys.stdout.write(f"{r['genes']:>8} {r['barcodes']:>10} "
+                         + ' '.join(f"{r['stages'][s]['seconds']:>16.1f}"
+                                    f"{r['stages'][s]['peak_memory_gb']:>10.2f}"
+                                    for s in STAGES) + '\n')
+
+
+if __name__ == '__main__':
+    main()
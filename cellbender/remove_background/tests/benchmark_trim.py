@@ -0,0 +1,212 @@
+"""Benchmark of Dataset._trim_dataset_for_analysis() on large raw datasets.
+
+Builds a synthetic raw count matrix with millions of barcodes, mostly nearly
+empty, and times trimming it with the current implementation and with the
+previous one (kept here as legacy_trim_dataset_for_analysis()), which sorted
+all barcodes and applied the gene blacklist with a Python list comprehension.
+The selected barcodes and genes are checked to agree.  The selection step
+alone (ranking barcodes and applying the blacklist, given the UMI counts) is
+also timed separately, since the whole of trimming includes computing UMI
+counts and priors.
+
+Example:
+    $ python -m cellbender.remove_background.tests.benchmark_trim \
+        --barcodes 1000000 10000000 --blacklist 1000
+
+"""
+
+from cellbender.remove_background.data.dataset import Dataset, \
+    get_d_priors_from_dataset, get_top_k_inds
+
+import numpy as np
+import scipy.sparse as sp
+
+from typing import Callable, Dict, List, Union
+import argparse
+import json
+import sys
+import time
+import warnings
+
+
+def make_dataset(n_barcodes: int,
+                 n_genes: int = 30000,
+                 n_cells: int = 10000,
+                 n_empty_droplets: int = 200000,
+                 genes_per_cell: int = 1500,
+                 genes_per_empty_droplet: int = 30,
+                 seed: int = 0) -> Dataset:
+    """Make a Dataset holding a synthetic raw count matrix.
+
+    Cells have genes_per_cell nonzero genes, empty droplets (with ambient
+    RNA) have about genes_per_empty_droplet, and the remaining barcodes have
+    a few counts each, as in the raw output of CellRanger.
+
+    """
+
+    rng = np.random.RandomState(seed)
+
+    # Number of nonzero genes in each barcode.
+    nnz_per_row = rng.geometric(0.5, size=n_barcodes).astype(np.int64)
+    inds = rng.permutation(n_barcodes)[:min(n_cells + n_empty_droplets,
+                                            n_barcodes)]
+    nnz_per_row[inds[n_cells:]] = rng.poisson(genes_per_empty_droplet,
+                                              size=inds[n_cells:].size)
+    nnz_per_row[inds[:n_cells]] = genes_per_cell
+    indptr = np.zeros(n_barcodes + 1, dtype=np.int64)
+    np.cumsum(nnz_per_row, out=indptr[1:])
+
+    matrix = sp.csr_matrix((rng.geometric(0.3, size=indptr[-1]).astype(np.uint16),
+                            rng.randint(0, n_genes, size=indptr[-1]).astype(np.int32),
+                            indptr), shape=(n_barcodes, n_genes))
+    matrix.sum_duplicates()
+
+    dataset = Dataset()
+    dataset.data = {'matrix': matrix,
+                    'gene_names': np.array([f'g{i}' for i in range(n_genes)]),
+                    'barcodes': np.arange(n_barcodes)}
+    dataset.model_name = 'full'
+    dataset.priors['n_cells'] = n_cells
+
+    return dataset
+
+
+def legacy_trim_dataset_for_analysis(dataset: Dataset,
+                                     low_UMI_count_cutoff: int = 30,
+                                     num_transition_barcodes: int = 7000,
+                                     gene_blacklist: List[int] = []):
+    """Previous implementation of Dataset._trim_dataset_for_analysis().
+
+    Kept as a reference for the speed and the result of the current one.
+
+    """
+
+    matrix = dataset.data['matrix']
+    umi_counts = np.array(matrix.sum(axis=1)).squeeze()
+    umi_count_order = np.argsort(umi_counts)[::-1]
+
+    num_nonzero_barcodes = np.sum(umi_counts > 0).item()
+    n_cells = min(dataset.priors['n_cells'], num_nonzero_barcodes)
+
+    gene_counts_per_barcode = np.array(matrix.sum(axis=0)).squeeze()
+    dataset.analyzed_gene_inds = np.where(gene_counts_per_barcode
+                                          > 0)[0].astype(dtype=int)
+    if len(gene_blacklist) > 0:
+        dataset.analyzed_gene_inds = np.array([g for g in
+                                               dataset.analyzed_gene_inds
+                                               if g not in gene_blacklist])
+
+    dataset.priors['cell_counts'], dataset.priors['empty_counts'] = \
+        get_d_priors_from_dataset(dataset)
+
+    cell_barcodes = umi_count_order[:n_cells]
+    empirical_low_UMI = int(dataset.priors['empty_counts'] * 0.8)
+    low_UMI_count_cutoff = max(low_UMI_count_cutoff, empirical_low_UMI)
+    num_barcodes_above_umi_cutoff = \
+        np.sum(umi_counts > low_UMI_count_cutoff).item()
+    num = min(num_transition_barcodes,
+              num_barcodes_above_umi_cutoff - cell_barcodes.size)
+    num = max(0, num)
+    transition_barcodes = umi_count_order[n_cells:(n_cells + num)]
+    dataset.analyzed_barcode_inds = np.concatenate((
+        cell_barcodes, transition_barcodes)).astype(dtype=int)
+    if num < num_transition_barcodes:
+        empty_droplet_barcodes = np.array([])
+    else:
+        empty_droplet_barcodes = umi_count_order[
+            np.arange(n_cells + num, num_barcodes_above_umi_cutoff, dtype=int)]
+    dataset.empty_barcode_inds = empty_droplet_barcodes.astype(dtype=int)
+    dataset.is_trimmed = True
+
+
+def time_trim(fn: Callable, dataset: Dataset, repeats: int) -> float:
+    """Median time of trimming a dataset, in seconds."""
+
+    times = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        fn(dataset)
+        times.append(time.perf_counter() - t)
+    return float(np.median(times))
+
+
+def run_case(n_barcodes: int,
+             n_blacklist: int,
+             repeats: int) -> Dict[str, Union[int, float]]:
+    """Time current and legacy trimming, and check that they agree."""
+
+    dataset = make_dataset(n_barcodes)
+    n_genes = dataset.data['matrix'].shape[1]
+    blacklist = list(np.random.RandomState(1).choice(n_genes, size=n_blacklist,
+                                                     replace=False))
+    umi_counts = np.array(dataset.data['matrix'].sum(axis=1)).squeeze()
+
+    results = {'barcodes': n_barcodes, 'blacklist': n_blacklist}
+    selected = {}
+    for name, fn in [('legacy', lambda d: legacy_trim_dataset_for_analysis(
+                         d, gene_blacklist=blacklist)),
+                     ('current', lambda d: d._trim_dataset_for_analysis(
+                         gene_blacklist=blacklist))]:
+        results[name + '_s'] = time_trim(fn, dataset, repeats)
+        selected[name] = (dataset.analyzed_barcode_inds.copy(),
+                          dataset.empty_barcode_inds.copy(),
+                          dataset.analyzed_gene_inds.copy())
+
+    # Barcodes with tied UMI counts can be chosen in either order, so the
+    # selections are compared by their UMI counts.
+    for i, what in enumerate(['analyzed barcodes', 'empty droplets']):
+        assert np.array_equal(np.sort(umi_counts[selected['legacy'][i]]),
+                              np.sort(umi_counts[selected['current'][i]])), \
+            f"Current and legacy trimming select different {what}."
+    assert np.array_equal(selected['legacy'][2], selected['current'][2]), \
+        "Current and legacy trimming select different genes."
+
+    results['speedup'] = results['legacy_s'] / results['current_s']
+
+    # Time the selection step alone.
+    k = dataset.analyzed_barcode_inds.size
+    gene_inds = np.arange(n_genes)
+    results['legacy_selection_s'] = time_trim(
+        lambda d: (np.argsort(umi_counts)[::-1][:k],
+                   np.array([g for g in gene_inds if g not in blacklist])),
+        dataset, repeats)
+    results['current_selection_s'] = time_trim(
+        lambda d: (get_top_k_inds(umi_counts, k),
+                   np.flatnonzero(~np.isin(gene_inds, blacklist))),
+        dataset, repeats)
+    results['selection_speedup'] = results['legacy_selection_s'] \
+        / results['current_selection_s']
+
+    return results
+
+
+def main(argv: Union[List[str], None] = None):
+    """Run the benchmark from the command line."""
+
+    parser = argparse.ArgumentParser(description="Benchmark dataset trimming.")
+    parser.add_argument("--barcodes", nargs="+", type=int,
+                        default=[1000000, 10000000],
+                        help="Numbers of barcodes in the raw datasets.")
+    parser.add_argument("--blacklist", type=int, default=1000,
+                        help="Number of blacklisted genes.")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="Number of timed repeats.")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Output JSON file for the results.")
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter("ignore")
+
+    results = []
+    for n_barcodes in args.barcodes:
+        results.append(run_case(n_barcodes, args.blacklist, args.repeats))
+        sys.stdout.write(json.dumps(results[-1]) + '\n')
+        sys.stdout.flush()
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
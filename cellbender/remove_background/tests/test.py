@@ -5,13 +5,33 @@ import warnings
 
 import cellbender
 import cellbender.remove_background.model
-from cellbender.remove_background.train import run_inference
-from cellbender.remove_background.data.simulate import simulate_ambient_dataset
+from cellbender.remove_background.train import run_inference, \
+    get_batch_size_from_memory_budget
+from cellbender.remove_background.data.simulate import simulate_ambient_dataset, \
+    simulate_ambient_dataset_to_h5
 import cellbender.remove_background.data.transform as transform
 from cellbender.remove_background.data.dataset import Dataset, \
-    write_matrix_to_h5, get_matrix_from_h5
+    write_matrix_to_h5, write_matrix_to_h5ad, get_matrix_from_h5, \
+    get_matrix_from_mtx, compact_count_matrix, get_stratified_sample_inds
+import cellbender.remove_background.data.cache as cache
+from cellbender.remove_background.data.barcodes import PackedBarcodes, \
+    pack_barcodes
+from cellbender.remove_background.data.dataprep import AliasSampler, \
+    DataLoader
+from cellbender.remove_background.vae.encoder import EncodeZ, EncodeD, \
+    EncodePAmbient, as_gene_inds, select_genes
 import numpy as np
+import scipy.io as io
+import scipy.sparse as sp
+import tables
+import torch
+from pyro import poutine
+from pyro.infer import Trace_ELBO
+import gzip
+import shutil
 import sys
+import tempfile
+from typing import Union
 
 
 class TestConsole(unittest.TestCase):
@@ -75,6 +95,751 @@ class TestConsole(unittest.TestCase):
 
             return 0
 
+    def test_simulated_dataset_streamed_to_h5(self):
+        """Run a basic test of streaming a simulated dataset to an HDF5 file.
+
+        The dataset is simulated in several small blocks, each appended to a
+        temporary file in CellRanger format, and then read back in.
+
+        """
+
+        # This is here to suppress the numpy warning triggered by scipy.sparse.
+        warnings.simplefilter("ignore")
+
+        # Simulate a dataset, writing it to a temporary file in blocks.
+        n_cells = 100
+        n_empty = 3 * n_cells
+        n_genes = 1000
+        temp_file_name = 'testfile_streamed.h5'
+        z, _ = simulate_ambient_dataset_to_h5(temp_file_name,
+                                              n_cells=n_cells,
+                                              n_empty=n_empty,
+                                              clusters=1, n_genes=n_genes,
+                                              d_cell=2000, d_empty=100,
+                                              block_size=70)
+
+        # Read the data back in.
+        reconstructed = get_matrix_from_h5(temp_file_name)
+        new_matrix = reconstructed['matrix']
+
+        # Check that the data matches the simulation.
+        assert new_matrix.shape == (n_cells + n_empty, n_genes), \
+            "Streamed dataset has the wrong shape."
+        assert np.unique(reconstructed['barcodes']).size == z.size, \
+            "Streamed dataset barcodes are not unique."
+        assert reconstructed['gene_names'].size == n_genes, \
+            "Streamed dataset has the wrong number of gene names."
+        counts = np.array(new_matrix.sum(axis=1)).squeeze()
+        assert counts[z > 0].min() > counts[z == 0].max(), \
+            "Streamed dataset cells do not have more counts than empties."
+
+        # Remove the temporary file.
+        os.remove(temp_file_name)
+
+        return 1
+
+    def test_read_gzipped_mtx_directory(self):
+        """Run a basic test of reading a gzipped CellRanger v3 mtx directory.
+
+        A simulated dataset is written as matrix.mtx.gz, features.tsv.gz, and
+        barcodes.tsv.gz in a temporary directory, and read back in.
+
+        """
+
+        # This is here to suppress the numpy warning triggered by scipy.sparse.
+        warnings.simplefilter("ignore")
+
+        # Generate a simulated dataset.
+        csr_barcode_gene_synthetic, _, _, _ = \
+            simulate_ambient_dataset(n_cells=50, n_empty=150,
+                                     clusters=1, n_genes=300,
+                                     d_cell=2000, d_empty=100,
+                                     ambient_different=False)
+        n_genes = csr_barcode_gene_synthetic.shape[1]
+
+        # Write it as a CellRanger v3 directory, with genes as rows.
+        temp_dir = tempfile.mkdtemp()
+        io.mmwrite(os.path.join(temp_dir, 'matrix.mtx'),
+                   csr_barcode_gene_synthetic.transpose())
+        with open(os.path.join(temp_dir, 'matrix.mtx'), 'rb') as f_in, \
+                gzip.open(os.path.join(temp_dir, 'matrix.mtx.gz'),
+                          'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(os.path.join(temp_dir, 'matrix.mtx'))
+        with gzip.open(os.path.join(temp_dir, 'features.tsv.gz'), 'wt') as f:
+            for i in range(n_genes):
+                feature_type = 'Antibody Capture' if i == 0 \
+                    else 'Gene Expression'
+                f.write(f'ENSG{i}\tg_{i}\t{feature_type}\n')
+        with gzip.open(os.path.join(temp_dir, 'barcodes.tsv.gz'), 'wt') as f:
+            for i in range(csr_barcode_gene_synthetic.shape[0]):
+                f.write(f'bc_{i}-1\n')
+
+        # Read the data back in.
+        reconstructed = get_matrix_from_mtx(temp_dir)
+        new_matrix = reconstructed['matrix']
+
+        # Check that the data matches, without the antibody feature.
+        assert (new_matrix != csr_barcode_gene_synthetic[:, 1:]).nnz == 0, \
+            "Data read from mtx directory is not accurate."
+        assert reconstructed['gene_names'][0] == 'g_1', \
+            "Non-gene-expression features were not removed."
+        assert reconstructed['barcodes'].size == new_matrix.shape[0], \
+            "Wrong number of barcodes read from mtx directory."
+
+        # Remove the temporary directory.
+        shutil.rmtree(temp_dir)
+
+        return 1
+
+    def test_write_matrix_to_h5ad(self):
+        """Run a basic test of writing a small matrix as .h5ad for AnnData.
+
+        The file is written without anndata, and read back in with
+        anndata.read_h5ad().
+
+        """
+
+        # AnnData is only needed to test the output.
+        import anndata
+
+        # This is here to suppress the numpy warning triggered by scipy.sparse.
+        warnings.simplefilter("ignore")
+
+        # Make a small count matrix, and write a subset of its rows.
+        rng = np.random.RandomState(0)
+        n_barcodes, n_genes = 50, 30
+        matrix = sp.random(n_barcodes, n_genes, density=0.2, format='csr',
+                           random_state=rng, dtype=np.float64)
+        matrix.data = np.ceil(10 * matrix.data)
+        row_inds = np.sort(rng.choice(n_barcodes, size=20, replace=False))
+        barcodes = np.array([f'bc_{i}-1' for i in row_inds])
+        gene_names = np.array([f'g_{i}' for i in range(n_genes)])
+        ambient = rng.dirichlet(np.ones(n_genes)).astype(np.float32)
+        p = rng.rand(row_inds.size).astype(np.float32)
+        z = rng.randn(row_inds.size, 5).astype(np.float32)
+
+        temp_dir = tempfile.mkdtemp()
+        output_file = os.path.join(temp_dir, 'output.h5ad')
+        assert write_matrix_to_h5ad(output_file=output_file,
+                                    gene_names=gene_names,
+                                    barcodes=barcodes,
+                                    inferred_count_matrix=matrix,
+                                    row_inds=row_inds,
+                                    ambient_expression=ambient,
+                                    z=z, p=p), \
+            "Writing the .h5ad file failed."
+
+        # Read the data back in with AnnData.
+        adata = anndata.read_h5ad(output_file)
+
+        # Check that the data matches.
+        assert adata.shape == (row_inds.size, n_genes), \
+            "AnnData from .h5ad file has the wrong shape."
+        assert sp.issparse(adata.X) and \
+            (sp.csr_matrix(adata.X) != matrix[row_inds]).nnz == 0, \
+            "Count matrix read from .h5ad file is not accurate."
+        assert (np.asarray(adata.obs_names) == barcodes).all(), \
+            "Barcodes read from .h5ad file are not accurate."
+        assert (np.asarray(adata.var_names) == gene_names).all(), \
+            "Gene names read from .h5ad file are not accurate."
+        assert np.allclose(adata.obs['latent_cell_probability'], p)
+        assert np.allclose(adata.var['ambient_expression'], ambient)
+        assert np.allclose(adata.obsm['latent_gene_encoding'], z)
+
+        # Remove the temporary directory.
+        shutil.rmtree(temp_dir)
+
+        return 1
+
+    def test_output_compression_round_trip(self):
+        """Write and read back output with each supported compression library.
+
+        Every library PyTables supports (and was built with) can be given as
+        --output_compression, as well as 'none'.
+
+        """
+
+        # This is here to suppress the numpy warning triggered by scipy.sparse.
+        warnings.simplefilter("ignore")
+
+        # Make a small count matrix, with ambient expression.
+        rng = np.random.RandomState(0)
+        n_barcodes, n_genes = 200, 50
+        matrix = sp.random(n_barcodes, n_genes, density=0.2, format='csr',
+                           random_state=rng, dtype=np.float64)
+        matrix.data = np.ceil(10 * matrix.data)
+        barcodes = np.array([f'bc_{i}-1' for i in range(n_barcodes)])
+        gene_names = np.array([f'g_{i}' for i in range(n_genes)])
+        ambient = rng.dirichlet(np.ones(n_genes)).astype(np.float32)
+
+        # Compression libraries available in this PyTables build.
+        compressors = []
+        for compression in tables.filters.all_complibs:
+            library, _, compressor = compression.partition(':')
+            if tables.which_lib_version(library) is None:
+                continue
+            if (library == 'blosc') and compressor \
+                    and (compressor not in tables.blosc_compressor_list()):
+                continue
+            if (library == 'blosc2') and compressor \
+                    and (compressor not in tables.blosc2_compressor_list()):
+                continue
+            compressors.append(compression)
+        assert 'zlib' in compressors, "zlib compression is not available."
+
+        temp_dir = tempfile.mkdtemp()
+        for compression in compressors + ['none']:
+
+            # Write the output file.
+            output_file = os.path.join(temp_dir,
+                                       f"{compression.replace(':', '_')}.h5")
+            assert write_matrix_to_h5(output_file=output_file,
+                                      gene_names=gene_names,
+                                      barcodes=barcodes,
+                                      inferred_count_matrix=matrix,
+                                      ambient_expression=ambient,
+                                      compression=compression), \
+                f"Writing output with {compression} compression failed."
+
+            # The arrays are compressed with the library asked for.
+            with tables.open_file(output_file, 'r') as f:
+                data = f.get_node('/background_removed/data')
+                if compression == 'none':
+                    assert data.filters.complevel == 0, \
+                        "Output was compressed when asked not to be."
+                else:
+                    assert (data.filters.complib == compression) \
+                        and (data.filters.complevel > 0), \
+                        f"Output was not compressed with {compression}."
+
+            # Read the data back in, and check that it matches.
+            reconstructed = get_matrix_from_h5(output_file)
+            assert (reconstructed['matrix'] != matrix).nnz == 0, \
+                f"Count matrix written with {compression} compression is " \
+                f"not accurate."
+            assert (reconstructed['barcodes'].astype(str) == barcodes).all(), \
+                f"Barcodes written with {compression} compression are not " \
+                f"accurate."
+            assert (reconstructed['gene_names'].astype(str)
+                    == gene_names).all(), \
+                f"Gene names written with {compression} compression are " \
+                f"not accurate."
+            with tables.open_file(output_file, 'r') as f:
+                assert np.array_equal(
+                    f.get_node('/background_removed/ambient_expression').read(),
+                    ambient), \
+                    f"Ambient expression written with {compression} " \
+                    f"compression is not accurate."
+
+        # Remove the temporary directory.
+        shutil.rmtree(temp_dir)
+
+        return 1
+
+    def test_stratified_sample_inds(self):
+        """Check a sample of indices stratified by log counts.
+
+        The sample has the requested size and no repeats, includes every
+        stratum of log counts (even one with only a few very high counts),
+        and takes from each stratum in proportion to its size.
+
+        """
+
+        rng = np.random.RandomState(0)
+        counts = np.concatenate([rng.lognormal(3., 1., size=100000),
+                                 [1e6, 2e6, 3e6]]).astype(int)
+        n_strata = 50
+        k = 1000
+
+        inds = get_stratified_sample_inds(counts, k, n_strata=n_strata)
+        assert inds.size == k, "Sample has the wrong size."
+        assert np.unique(inds).size == k, "Sample has repeated indices."
+        assert (inds.min() >= 0) and (inds.max() < counts.size)
+
+        # The same strata as get_stratified_sample_inds() uses.
+        log_counts = np.log1p(counts.astype(np.float64))
+        edges = np.linspace(log_counts.min(), log_counts.max(), n_strata + 1)
+        strata = np.digitize(log_counts, edges[1:-1])
+        sizes = np.bincount(strata, minlength=n_strata)
+        n_sampled = np.bincount(strata[inds], minlength=n_strata)
+        assert (n_sampled[sizes > 0] > 0).all(), \
+            "Not every stratum of log counts is represented."
+        # (Allowing for rounding, and the sample kept for each stratum.)
+        quotas = sizes * k / counts.size
+        assert (np.abs(n_sampled - quotas) <= 0.05 * quotas + 2).all(), \
+            "Strata are not sampled in proportion to their size."
+
+        # With fewer samples than strata, or more than there are counts.
+        assert np.unique(get_stratified_sample_inds(counts, 5)).size == 5
+        assert (get_stratified_sample_inds(counts, 2 * counts.size)
+                == np.arange(counts.size)).all()
+
+        return 1
+
+    def test_pack_barcodes(self):
+        """Check that barcodes packed two bits per base decode exactly.
+
+        Barcodes of several lengths, with and without suffixes, round-trip
+        through packing, and barcodes which cannot be packed give None.
+
+        """
+
+        rng = np.random.RandomState(0)
+
+        def random_barcodes(n, length, suffixes):
+            bases = np.array(list('ACGT'))[rng.randint(4, size=(n, length))]
+            return np.array([''.join(b) + suffixes[i % len(suffixes)]
+                             for i, b in enumerate(bases)])
+
+        for length in [1, 8, 16, 24]:
+            for suffixes in [[''], ['-1'], ['-1', '-2', '-12']]:
+                barcodes = random_barcodes(1000, length, suffixes)
+                packed = pack_barcodes(barcodes)
+                assert isinstance(packed, PackedBarcodes), \
+                    f"Barcodes of length {length} were not packed."
+                assert (packed.decode() == barcodes.astype('S')).all(), \
+                    f"Packed barcodes of length {length} with suffixes " \
+                    f"{suffixes} do not decode to the originals."
+
+                # Indexing decodes one barcode, or selects PackedBarcodes.
+                assert packed[3] == barcodes[3].encode()
+                assert (np.asarray(packed[10:20])
+                        == barcodes[10:20].astype('S')).all()
+                assert (packed[[5, 2]].decode()
+                        == barcodes[[5, 2]].astype('S')).all()
+
+        # Bytes barcodes are packed too, and packed barcodes stay packed.
+        barcodes = random_barcodes(10, 16, ['-1']).astype('S')
+        assert (pack_barcodes(barcodes).decode() == barcodes).all()
+        packed = pack_barcodes(barcodes)
+        assert pack_barcodes(packed) is packed
+
+        # Barcodes which cannot be packed.
+        for barcodes in [np.array(['AAACCTGA-1', 'AAACNTGA-1']),  # Not ACGT
+                         np.array(['NAACCTGA-1', 'AAACCTGA-1']),
+                         np.array(['AAACCTGA-1', 'AAACCTG-1']),  # Lengths
+                         random_barcodes(10, 25, ['-1']),  # Too long
+                         np.array(['bc_0', 'bc_1']),
+                         np.array([], dtype='S18')]:
+            assert pack_barcodes(barcodes) is None, \
+                f"Barcodes {barcodes} should not be packed."
+
+        return 1
+
+    def test_packed_barcodes_output(self):
+        """Check that output with packed barcodes is identical to without."""
+
+        # This is here to suppress the numpy warning triggered by scipy.sparse.
+        warnings.simplefilter("ignore")
+
+        temp_dir = tempfile.mkdtemp()
+        input_file = os.path.join(temp_dir, 'input.h5')
+        simulate_ambient_dataset_to_h5(input_file, n_cells=100, n_empty=300,
+                                       clusters=1, n_genes=1000,
+                                       d_cell=2000, d_empty=100)
+        args = make_inference_args(n_cells=100)
+
+        # Run the same inference and write the outputs, with and without
+        # packing the barcodes.
+        output_dirs = []
+        for use_packed_barcodes in [False, True]:
+            np.random.seed(0)
+            dataset_obj = Dataset(transformation=transform.IdentityTransform(),
+                                  input_file=input_file,
+                                  expected_cell_count=100,
+                                  num_transition_barcodes=100,
+                                  model_name="full",
+                                  use_packed_barcodes=use_packed_barcodes)
+            assert isinstance(dataset_obj.data['barcodes'], PackedBarcodes) \
+                == use_packed_barcodes
+            inferred_model = run_inference(dataset_obj, args)
+            output_dir = os.path.join(temp_dir, f'packed_{use_packed_barcodes}')
+            os.makedirs(output_dir)
+            dataset_obj.save_to_output_file(os.path.join(output_dir,
+                                                         'output.h5'),
+                                            inferred_model)
+            output_dirs.append(output_dir)
+
+        # Every output file is byte-identical.
+        file_names = sorted(os.listdir(output_dirs[0]))
+        assert file_names == sorted(os.listdir(output_dirs[1]))
+        for file_name in file_names:
+            with open(os.path.join(output_dirs[0], file_name), 'rb') as f:
+                unpacked = f.read()
+            with open(os.path.join(output_dirs[1], file_name), 'rb') as f:
+                packed = f.read()
+            assert unpacked == packed, \
+                f"{file_name} differs when barcodes are packed."
+
+        # Remove the temporary directory.
+        shutil.rmtree(temp_dir)
+
+        return 1
+
+    def test_cache_save_and_load(self):
+        """Run a basic test of saving parsed data to the cache and loading it.
+
+        Cached count matrices are memory-mapped, and cache entries depend on
+        the version of the cache format and on the options used for parsing.
+
+        """
+
+        # This is here to suppress the numpy warning triggered by scipy.sparse.
+        warnings.simplefilter("ignore")
+
+        # Generate a simulated dataset, in a stand-in input file.
+        csr_barcode_gene_synthetic, _, _, _ = \
+            simulate_ambient_dataset(n_cells=50, n_empty=150,
+                                     clusters=1, n_genes=300,
+                                     d_cell=2000, d_empty=100,
+                                     ambient_different=False)
+        data = {'matrix': compact_count_matrix(csr_barcode_gene_synthetic),
+                'barcodes': np.array([f'bc_{i}' for i in range(
+                    csr_barcode_gene_synthetic.shape[0])]),
+                'gene_names': np.array([f'g_{i}' for i in range(
+                    csr_barcode_gene_synthetic.shape[1])])}
+        temp_dir = tempfile.mkdtemp()
+        cache_dir = os.path.join(temp_dir, 'cache')
+        input_file = os.path.join(temp_dir, 'input.h5')
+        with open(input_file, 'w') as f:
+            f.write('input')
+        options = {'feature_type': 'Gene Expression'}
+
+        # Save the data to the cache, and load it back in.
+        assert cache.load_from_cache(cache_dir, input_file,
+                                     parse_options=options) is None
+        assert cache.save_to_cache(cache_dir, input_file, data,
+                                   parse_options=options), \
+            "Could not save to the cache."
+        loaded = cache.load_from_cache(cache_dir, input_file,
+                                       parse_options=options)
+
+        # Check that the data matches, including dtypes.
+        assert (loaded['matrix'] != data['matrix']).nnz == 0, \
+            "Data loaded from the cache is not accurate."
+        assert loaded['matrix'].dtype == data['matrix'].dtype
+        assert (loaded['barcodes'] == data['barcodes']).all()
+        assert (loaded['gene_names'] == data['gene_names']).all()
+
+        # The matrix is memory-mapped copy-on-write.  (scipy keeps a view of
+        # the memory-mapped array, so look for the memmap among its bases.)
+        base = loaded['matrix'].data
+        while (base is not None) and not isinstance(base, np.memmap):
+            base = getattr(base, 'base', None)
+        assert base is not None, "Cached count matrix is not memory-mapped."
+        loaded['matrix'].data[:] = 0
+        reloaded = cache.load_from_cache(cache_dir, input_file,
+                                         parse_options=options)
+        assert (reloaded['matrix'] != data['matrix']).nnz == 0, \
+            "Changing loaded data changed the cache."
+
+        # Other parse options, or another cache format, miss the cache.
+        assert cache.load_from_cache(cache_dir, input_file,
+                                     parse_options={}) is None
+        version = cache.CACHE_FORMAT_VERSION
+        try:
+            cache.CACHE_FORMAT_VERSION = version + 1
+            assert cache.load_from_cache(cache_dir, input_file,
+                                         parse_options=options) is None, \
+                "Cache entry of an old format was loaded."
+        finally:
+            cache.CACHE_FORMAT_VERSION = version
+
+        # So does a changed input file.
+        os.utime(input_file, ns=(0, 0))
+        assert cache.load_from_cache(cache_dir, input_file,
+                                     parse_options=options) is None, \
+            "Cache entry of a changed input file was loaded."
+
+        # Remove the temporary directory.
+        del loaded, reloaded
+        shutil.rmtree(temp_dir)
+
+        return 1
+
+    def test_cache_eviction(self):
+        """Run a basic test of evicting least recently used cache entries."""
+
+        # Make cache entries of the same size, used at different times.
+        cache_dir = tempfile.mkdtemp()
+        entries = []
+        for i in range(4):
+            entry = os.path.join(cache_dir, f'entry_{i}')
+            os.makedirs(entry)
+            np.save(os.path.join(entry, 'data.npy'), np.zeros(1000))
+            os.utime(entry, (1000 * (i + 1), 1000 * (i + 1)))
+            entries.append(entry)
+        size = os.path.getsize(os.path.join(entries[0], 'data.npy'))
+
+        # Evict down to two entries, keeping the oldest one.
+        evicted = cache.evict_from_cache(cache_dir,
+                                         max_size_gb=2 * size / 1e9,
+                                         keep=[entries[0]])
+        assert evicted == entries[1:3], \
+            "The least recently used entries were not evicted."
+        assert sorted(os.listdir(cache_dir)) == ['entry_0', 'entry_3']
+
+        # Nothing is evicted from a cache under its maximum size.
+        assert cache.evict_from_cache(cache_dir,
+                                      max_size_gb=2 * size / 1e9) == []
+
+        # Remove the temporary directory.
+        shutil.rmtree(cache_dir)
+
+        return 1
+
+    def test_encoders_dense_and_sparse_input(self):
+        """Check that encoders give the same results for dense and sparse input.
+
+        Each encoder is run on the same minibatch as a dense tensor and as a
+        sparse CSR tensor, using all genes or a subset of genes, under each
+        input transform.  The minibatch includes a barcode with no counts,
+        and one with no counts in the subset of genes.
+
+        """
+
+        torch.manual_seed(0)
+        n_genes = 50
+        x = torch.poisson(torch.rand(8, n_genes) * 3.)
+        x[0, :] = 0.  # A barcode with no counts
+        gene_inds = np.arange(0, n_genes, 3)
+        x[1, :] = 0.
+        x[1, 1] = 5.  # A barcode with no counts in gene_inds
+        chi_ambient = torch.rand(n_genes)
+        chi_ambient = chi_ambient / chi_ambient.sum()
+
+        for inds in [None, gene_inds]:
+            for input_transform in [None, 'log', 'normalize']:
+                encoders = [EncodeZ(input_dim=n_genes, hidden_dims=[20],
+                                    output_dim=4,
+                                    input_transform=input_transform,
+                                    gene_inds=inds),
+                            EncodeD(input_dim=n_genes, hidden_dims=[10, 2],
+                                    output_dim=1,
+                                    input_transform=input_transform,
+                                    gene_inds=inds),
+                            EncodePAmbient(input_dim=n_genes,
+                                           hidden_dims=[20, 10],
+                                           output_dim=1,
+                                           input_transform=input_transform,
+                                           gene_inds=inds)]
+
+                for encoder in encoders:
+                    outputs, grads = [], []
+                    for x_input in [x, x.to_sparse_csr()]:
+                        encoder.zero_grad()
+                        out = encoder(x_input, chi_ambient)
+                        if isinstance(out, dict):
+                            out = torch.cat([out['loc'], out['scale']])
+                        out.sum().backward()
+                        outputs.append(out.detach())
+                        grads.append(encoder.linears[0].weight.grad.clone())
+
+                    name = f"{type(encoder).__name__} with " \
+                           f"{input_transform} transform and " \
+                           f"{'all' if inds is None else 'some'} genes"
+                    assert torch.isfinite(outputs[0]).all(), \
+                        f"{name} gives non-finite output."
+                    assert torch.allclose(outputs[0], outputs[1],
+                                          rtol=1e-5, atol=1e-6), \
+                        f"{name} differs for dense and sparse input."
+                    assert torch.allclose(grads[0], grads[1],
+                                          rtol=1e-5, atol=1e-6), \
+                        f"{name} has different gradients for dense " \
+                        f"and sparse input."
+
+        # Selecting genes keeps the same values in both layouts.
+        inds = as_gene_inds(gene_inds)
+        assert torch.equal(select_genes(x.to_sparse_csr(), inds).to_dense(),
+                           select_genes(x, inds)), \
+            "Genes selected from sparse input are not accurate."
+
+        return 1
+
+    def test_alias_sampler_frequencies(self):
+        """Check that an AliasSampler draws indices in proportion to weights."""
+
+        np.random.seed(0)
+        weights = np.random.lognormal(0., 1., size=30)
+        weights[3] = 0.  # Never drawn
+        weights[7] = 1e-3 * weights.sum()  # Rarely drawn
+
+        sampler = AliasSampler(weights)
+        n_draws = 2000000
+        frequencies = np.bincount(sampler.sample(n_draws),
+                                  minlength=weights.size) / n_draws
+
+        assert frequencies[3] == 0, "An index with zero weight was drawn."
+        assert np.abs(frequencies - weights / weights.sum()).max() < 1e-3, \
+            "AliasSampler frequencies do not match the weights."
+
+        return 1
+
+    def test_dataloader_padding_mask(self):
+        """Check the padding and mask of the last minibatch of an epoch.
+
+        The number of cells is not a multiple of the minibatch size, so the
+        last minibatch is padded.  The mask must exclude the padding rows, so
+        that the loss is the same as for the unpadded minibatch.
+
+        """
+
+        # This is here to suppress the numpy warning triggered by scipy.sparse.
+        warnings.simplefilter("ignore")
+
+        # Train the simple model, whose ELBO is deterministic for a fixed
+        # sample from the guide.
+        n_cells = 100
+        args = make_inference_args(n_cells)
+        args.model = ["simple"]
+        args.epochs = 1
+        dataset_obj = make_inference_dataset(n_cells, model_name="simple")
+        inferred_model = run_inference(dataset_obj, args)
+
+        # Load 50 cells, mixed with empties, in minibatches of 24 cells.
+        count_matrix = dataset_obj.get_count_matrix()
+        loader = DataLoader(count_matrix[:50], count_matrix[50:],
+                            batch_size=32, fraction_empties=0.25,
+                            shuffle=False, use_cuda=False)
+        minibatches = list(loader)
+
+        # Every minibatch has the same number of rows.
+        assert len(minibatches) == 3, "Wrong number of minibatches."
+        for x, mask in minibatches:
+            assert x.shape == (32, count_matrix.shape[1]), \
+                "Minibatches are not all the same size."
+        assert [int(mask.sum()) for _, mask in minibatches] == [32, 32, 2], \
+            "Mask does not count the rows of each minibatch."
+
+        # The last minibatch holds the last 2 cells, padded with copies of
+        # them which are masked out.
+        x, mask = minibatches[-1]
+        n_rows = int(mask.sum())
+        assert mask[:n_rows].all() and not mask[n_rows:].any(), \
+            "Mask does not exclude the padding rows."
+        assert (x[:n_rows].numpy() == count_matrix[48:50].toarray()).all(), \
+            "Last minibatch does not hold the last cells."
+        padding = np.arange(x.shape[0] - n_rows) % n_rows
+        assert torch.equal(x[n_rows:], x[padding]), \
+            "Padding rows are not copies of the minibatch rows."
+
+        # Fix the sample from the guide for the padded minibatch, and use
+        # the same values for the rows of the unpadded minibatch.
+        padded_trace = poutine.trace(inferred_model.guide).get_trace(x, mask)
+        unpadded_trace = poutine.trace(inferred_model.guide).get_trace(
+            x[:n_rows])
+        for name, node in unpadded_trace.nodes.items():
+            if node['type'] == 'sample':
+                value = padded_trace.nodes[name]['value']
+                node['value'] = value[:n_rows] if value.dim() > 0 else value
+
+        # The loss is the same with or without the padding.
+        elbo = Trace_ELBO()
+        padded_loss = elbo.loss(inferred_model.model,
+                                poutine.replay(inferred_model.guide,
+                                               trace=padded_trace),
+                                x, mask)
+        unpadded_loss = elbo.loss(inferred_model.model,
+                                  poutine.replay(inferred_model.guide,
+                                                 trace=unpadded_trace),
+                                  x[:n_rows])
+        assert np.isclose(padded_loss, unpadded_loss, rtol=1e-5), \
+            f"Loss with padding {padded_loss} differs from the loss " \
+            f"without padding {unpadded_loss}."
+
+        return 1
+
+    def test_dataloader_dense_and_sparse(self):
+        """Check that resident dense data gives the same minibatches as sparse.
+
+        For the same random seed, the DataLoader gives identical minibatches
+        whether they are selected from the dense tensor kept on the device,
+        densified from the sparse matrices, or left sparse.
+
+        """
+
+        # This is here to suppress the numpy warning triggered by scipy.sparse.
+        warnings.simplefilter("ignore")
+
+        # A dataset whose size is not a multiple of the minibatch size.
+        csr_barcode_gene_synthetic, _, _, _ = \
+            simulate_ambient_dataset(n_cells=50, n_empty=150,
+                                     clusters=1, n_genes=300,
+                                     d_cell=2000, d_empty=100,
+                                     ambient_different=False)
+        cells = csr_barcode_gene_synthetic[:70]
+        empties = csr_barcode_gene_synthetic[70:]
+        empty_weights = np.array(empties.sum(axis=1)).squeeze()
+
+        for weights in [None, empty_weights]:
+
+            # Two epochs of minibatches from each kind of DataLoader.
+            minibatches = {}
+            for kind in ['sparse_densified', 'dense', 'sparse']:
+                np.random.seed(0)
+                loader = DataLoader(cells, empties, batch_size=32,
+                                    fraction_empties=0.25, shuffle=True,
+                                    use_cuda=False, empty_weights=weights,
+                                    dense=(kind == 'dense'),
+                                    sparse=(kind == 'sparse'))
+                minibatches[kind] = [(x.to_dense() if kind == 'sparse' else x,
+                                      mask)
+                                     for _ in range(2) for x, mask in loader]
+
+            # The minibatches are identical.
+            for kind in ['dense', 'sparse']:
+                assert len(minibatches[kind]) \
+                    == len(minibatches['sparse_densified']), \
+                    f"The {kind} DataLoader gives a different number of " \
+                    f"minibatches."
+                for (x, mask), (x_ref, mask_ref) in \
+                        zip(minibatches[kind], minibatches['sparse_densified']):
+                    assert torch.equal(x, x_ref) and torch.equal(mask, mask_ref), \
+                        f"The {kind} DataLoader gives different minibatches."
+
+        return 1
+
+    def test_batch_size_from_memory_budget(self):
+        """Check how the minibatch size chosen for a memory budget scales.
+
+        It should grow with the budget, and shrink as the number of genes,
+        or the memory taken up by resident data, grows.  Encoders on fewer
+        genes, or a likelihood on fewer genes, leave room for more barcodes.
+
+        """
+
+        args = make_inference_args(n_cells=100)
+
+        def batch_size(budget_gb, n_genes, resident_gb=0.):
+            return get_batch_size_from_memory_budget(memory_budget_gb=budget_gb,
+                                                     n_genes=n_genes,
+                                                     args=args,
+                                                     max_batch_size=10**6,
+                                                     resident_gb=resident_gb)
+
+        sizes = [batch_size(budget, 10000) for budget in [1., 2., 4., 8.]]
+        assert all(np.diff(sizes) > 0), \
+            "Minibatch size does not grow with the memory budget."
+
+        sizes = [batch_size(4., n_genes) for n_genes in [2000, 10000, 30000]]
+        assert all(np.diff(sizes) < 0), \
+            "Minibatch size does not shrink as the number of genes grows."
+
+        assert batch_size(4., 10000, resident_gb=2.) < batch_size(4., 10000), \
+            "Resident data does not count against the memory budget."
+
+        full = batch_size(4., 30000)
+        args.encoder_genes = 2000
+        assert batch_size(4., 30000) > full, \
+            "Encoders on fewer genes do not allow a larger minibatch."
+        args.encoder_genes = None
+        args.likelihood_genes = 2000
+        assert batch_size(4., 30000) > full, \
+            "A likelihood on fewer genes does not allow a larger minibatch."
+
+        return 1
+
     def test_inference(self):
         """Run a basic tests doing inference on a synthetic dataset.
 
@@ -86,42 +851,9 @@ class TestConsole(unittest.TestCase):
 
             n_cells = 100
 
-            # Generate a simulated dataset with ambient RNA.
-            csr_barcode_gene_synthetic, _, _, _ = \
-                simulate_ambient_dataset(n_cells=n_cells, n_empty=3 * n_cells,
-                                         clusters=1, n_genes=1000,
-                                         d_cell=2000, d_empty=100,
-                                         ambient_different=False)
-
-            # Fake some parsed command line inputs.
-            args = ObjectWithAttributes()
-            args.use_cuda = False
-            args.z_hidden_dims = [100]
-            args.d_hidden_dims = [10, 2]
-            args.p_hidden_dims = [100, 10]
-            args.z_dim = 10
-            args.learning_rate = 0.001
-            args.epochs = 3
-            args.model = ["full"]
-            args.use_decaying_average_baseline = False
-            args.fraction_empties = 0.2
-            args.training_fraction = 0.8
-
-            args.expected_cell_count = n_cells
-
-            # Wrap simulated count matrix in a Dataset object.
-            dataset_obj = Dataset(transformation=transform.IdentityTransform())
-            dataset_obj.data = \
-                {'matrix': csr_barcode_gene_synthetic,
-                 'gene_names':
-                     np.array([f'g{n}' for n in
-                               range(csr_barcode_gene_synthetic.shape[1])]),
-                 'barcodes':
-                     np.array([f'bc{n}' for n in
-                               range(csr_barcode_gene_synthetic.shape[0])])}
-            dataset_obj.priors['n_cells'] = n_cells
-            dataset_obj._trim_dataset_for_analysis()
-            dataset_obj._estimate_priors()
+            # Fake some parsed command line inputs, and simulate a dataset.
+            args = make_inference_args(n_cells)
+            dataset_obj = make_inference_dataset(n_cells)
 
             # Run inference on this simulated dataset.
             inferred_model = run_inference(dataset_obj, args)
@@ -155,11 +887,215 @@ class TestConsole(unittest.TestCase):
             return 0
 
 
+    def test_likelihood_gene_sampling_is_unbiased(self):
+        """Check that the weighted likelihood of sampled genes is unbiased.
+
+        Over many draws of genes for a fixed minibatch, the weighted sum of
+        the log likelihood of the sampled genes should average to the log
+        likelihood of all genes.
+
+        """
+
+        # The sampler only uses the numbers of genes of the model.
+        model = ObjectWithAttributes()
+        model.n_genes = 500
+        model.likelihood_genes = 50
+
+        # Fixed counts (mostly zero) and their log likelihood under fixed mu.
+        torch.manual_seed(0)
+        mu = torch.rand(20, model.n_genes) * torch.rand(model.n_genes) * 5.
+        x = torch.poisson(mu * (torch.rand(20, model.n_genes) < 0.2).float())
+        log_prob = torch.distributions.Poisson(mu + 1e-3).log_prob(x)
+
+        estimates = []
+        for _ in range(10000):
+            gene_inds, gene_weights = cellbender.remove_background.model.\
+                VariationalInferenceModel._sample_likelihood_genes(model, x)
+            assert gene_inds.shape == (model.likelihood_genes,)
+            estimates.append((log_prob[:, gene_inds] * gene_weights).sum(dim=-1))
+        estimates = torch.stack(estimates)
+
+        exact = log_prob.sum(dim=-1)
+        error = (estimates.mean(dim=0) - exact).abs()
+        standard_error = estimates.std(dim=0) / np.sqrt(estimates.shape[0])
+        assert (error < 5 * standard_error).all() \
+            and (error < 0.01 * exact.abs()).all(), \
+            "Likelihood estimated from sampled genes is biased."
+
+        return 1
+
+    def test_inference_with_likelihood_genes(self):
+        """Run inference with the likelihood evaluated on sampled genes."""
+
+        n_cells = 100
+        args = make_inference_args(n_cells)
+        args.likelihood_genes = 30
+        dataset_obj = make_inference_dataset(n_cells)
+        assert args.likelihood_genes < dataset_obj.get_num_model_genes()
+
+        # Run inference on this simulated dataset.
+        inferred_model = run_inference(dataset_obj, args)
+        assert inferred_model.likelihood_genes == args.likelihood_genes
+        assert np.isfinite(inferred_model.loss['train']['elbo']).all(), \
+            "Training with sampled likelihood genes gave a non-finite ELBO."
+
+        # Make the background-subtracted dataset.
+        z, d, p = cellbender.remove_background.model.get_encodings(inferred_model,
+                                                                   dataset_obj)
+        inferred_count_matrix = cellbender.remove_background.model.\
+            get_count_matrix_from_encodings(z, d, p,
+                                            inferred_model,
+                                            dataset_obj)
+        assert inferred_count_matrix.shape == dataset_obj.data['matrix'].shape
+
+        return 1
+
+    def test_inference_simple_model(self):
+        """Run inference with the simple model, and write the output files.
+
+        The simple model has no ambient RNA expression, which must not stop
+        the output from being written.
+
+        """
+
+        # This is here to suppress the numpy warning triggered by scipy.sparse.
+        warnings.simplefilter("ignore")
+
+        n_cells = 100
+        args = make_inference_args(n_cells)
+        args.model = ["simple"]
+        dataset_obj = make_inference_dataset(n_cells, model_name="simple")
+
+        # Run inference and write the outputs to a temporary directory.
+        inferred_model = run_inference(dataset_obj, args)
+        temp_dir = tempfile.mkdtemp()
+        output_file = os.path.join(temp_dir, 'output.h5')
+        dataset_obj.save_to_output_file(output_file, inferred_model)
+
+        # Check that the output matches the input count matrix.
+        reconstructed = get_matrix_from_h5(output_file)
+        assert (reconstructed['matrix']
+                != dataset_obj.data['matrix']).nnz == 0, \
+            "Simple model output is not the input count matrix."
+
+        # Remove the temporary directory.
+        shutil.rmtree(temp_dir)
+
+        return 1
+
+    def test_inference_with_rare_gene_pooling(self):
+        """Run inference with rare genes pooled into bins.
+
+        The model sees fewer genes than were analyzed, and its outputs are
+        shared back out among all the analyzed genes.
+
+        """
+
+        # This is here to suppress the numpy warning triggered by scipy.sparse.
+        warnings.simplefilter("ignore")
+
+        n_cells = 100
+        args = make_inference_args(n_cells)
+        dataset_obj = make_inference_dataset(n_cells, rare_gene_threshold=50)
+        n_analyzed_genes = dataset_obj.analyzed_gene_inds.size
+        assert dataset_obj.get_num_model_genes() < n_analyzed_genes, \
+            "No rare genes were pooled."
+
+        # Run inference on the pooled dataset.
+        inferred_model = run_inference(dataset_obj, args)
+        z, d, p = cellbender.remove_background.model.get_encodings(inferred_model,
+                                                                   dataset_obj)
+
+        # Unpooled decoder outputs have one column per analyzed gene.
+        chi = inferred_model.decoder(torch.Tensor(z)).detach().numpy()
+        assert chi.shape[1] == dataset_obj.get_num_model_genes()
+        unpooled = dataset_obj.unpool_genes(chi, dataset_obj.analyzed_barcode_inds)
+        assert unpooled.shape == (z.shape[0], n_analyzed_genes), \
+            "Unpooled output has the wrong shape."
+        assert np.allclose(unpooled.sum(axis=1), chi.sum(axis=1)), \
+            "Unpooling does not conserve the output."
+
+        # So does the ambient expression.
+        ambient = cellbender.remove_background.model.get_ambient_expression()
+        assert dataset_obj.unpool_genes(ambient[np.newaxis, :]).shape \
+            == (1, n_analyzed_genes), \
+            "Unpooled ambient expression has the wrong shape."
+
+        # The inferred counts are only in the analyzed genes.
+        inferred_count_matrix = cellbender.remove_background.model.\
+            get_count_matrix_from_encodings(z, d, p,
+                                            inferred_model,
+                                            dataset_obj)
+        assert inferred_count_matrix.shape == dataset_obj.data['matrix'].shape
+        assert np.isin(np.unique(inferred_count_matrix.indices),
+                       dataset_obj.analyzed_gene_inds).all(), \
+            "Counts were inferred for genes that were not analyzed."
+
+        return 1
+
+
 class ObjectWithAttributes(object):
     """Exists only to populate the args data structure with attributes."""
     pass
 
 
+def make_inference_args(n_cells: int) -> ObjectWithAttributes:
+    """Fake the parsed command line inputs used for inference."""
+
+    args = ObjectWithAttributes()
+    args.use_cuda = False
+    args.z_hidden_dims = [100]
+    args.d_hidden_dims = [10, 2]
+    args.p_hidden_dims = [100, 10]
+    args.z_dim = 10
+    args.learning_rate = 0.001
+    args.epochs = 3
+    args.model = ["full"]
+    args.use_decaying_average_baseline = False
+    args.fraction_empties = 0.2
+    args.empty_drop_sampling = 'uniform'
+    args.memory_budget = None
+    args.dense_threshold_gb = 2.
+    args.sparse_input = False
+    args.encoder_genes = None
+    args.encoder_gene_selection = 'variance'
+    args.likelihood_genes = None
+    args.decoder_rank = None
+    args.training_fraction = 0.8
+    args.use_IAF = False
+    args.expected_cell_count = n_cells
+
+    return args
+
+
+def make_inference_dataset(n_cells: int,
+                           model_name: str = "full",
+                           rare_gene_threshold: Union[int, None] = None) -> Dataset:
+    """Wrap a simulated dataset with ambient RNA in a trimmed Dataset object."""
+
+    csr_barcode_gene_synthetic, _, _, _ = \
+        simulate_ambient_dataset(n_cells=n_cells, n_empty=3 * n_cells,
+                                 clusters=1, n_genes=1000,
+                                 d_cell=2000, d_empty=100,
+                                 ambient_different=False)
+
+    dataset_obj = Dataset(transformation=transform.IdentityTransform(),
+                          model_name=model_name)
+    dataset_obj.data = \
+        {'matrix': csr_barcode_gene_synthetic,
+         'gene_names':
+             np.array([f'g{n}' for n in
+                       range(csr_barcode_gene_synthetic.shape[1])]),
+         'barcodes':
+             np.array([f'bc{n}' for n in
+                       range(csr_barcode_gene_synthetic.shape[0])])}
+    dataset_obj.priors['n_cells'] = n_cells
+    dataset_obj._trim_dataset_for_analysis(rare_gene_threshold=rare_gene_threshold)
+    dataset_obj._estimate_priors()
+
+    return dataset_obj
+
+
 # if __name__ == '__main__':
 #     sys.stdout.write("running tests.\n")
 #     sys.stdout.flush()
@@ -182,6 +1118,24 @@ def main():
     passed_tests = 0
 
     passed_tests += tester.test_data_simulation_and_write_and_read()
+    passed_tests += tester.test_simulated_dataset_streamed_to_h5()
+    passed_tests += tester.test_read_gzipped_mtx_directory()
+    passed_tests += tester.test_write_matrix_to_h5ad()
+    passed_tests += tester.test_output_compression_round_trip()
+    passed_tests += tester.test_stratified_sample_inds()
+    passed_tests += tester.test_pack_barcodes()
+    passed_tests += tester.test_packed_barcodes_output()
+    passed_tests += tester.test_cache_save_and_load()
+    passed_tests += tester.test_cache_eviction()
+    passed_tests += tester.test_encoders_dense_and_sparse_input()
+    passed_tests += tester.test_alias_sampler_frequencies()
+    passed_tests += tester.test_dataloader_padding_mask()
+    passed_tests += tester.test_dataloader_dense_and_sparse()
+    passed_tests += tester.test_batch_size_from_memory_budget()
     passed_tests += tester.test_inference()
+    passed_tests += tester.test_likelihood_gene_sampling_is_unbiased()
+    passed_tests += tester.test_inference_with_likelihood_genes()
+    passed_tests += tester.test_inference_simple_model()
+    passed_tests += tester.test_inference_with_rare_gene_pooling()
 
-    sys.stdout.write(f'Passed {passed_tests} of 2 tests.\n\n')
+    sys.stdout.write(f'Passed {passed_tests} of 20 tests.\n\n')
@@ -10,10 +10,12 @@ from cellbender.remove_background.model import VariationalInferenceModel
 from cellbender.remove_background.vae.decoder import Decoder
 from cellbender.remove_background.vae.encoder \
     import EncodeZ, EncodeD, EncodePAmbient, CompositeEncoder
-from cellbender.remove_background.data.dataset import Dataset
+from cellbender.remove_background.data.dataset import Dataset, \
+    select_encoder_genes
 from cellbender.remove_background.data.dataprep import \
     prep_sparse_data_for_training as prep_data_for_training
-from cellbender.remove_background.data.dataprep import DataLoader
+from cellbender.remove_background.data.dataprep import DataLoader, \
+    get_resident_gb
 
 from typing import Tuple, List
 import logging
@@ -38,11 +40,11 @@ def train_epoch(svi: SVI,
     normalizer_train = 0.
 
     # Train an epoch by going through each mini-batch.
-    for x_cell_batch in train_loader:
+    for x_cell_batch, mask in train_loader:
 
         # Perform gradient descent step and accumulate loss.
-        epoch_loss += svi.step(x_cell_batch)
-        normalizer_train += x_cell_batch.size(0)
+        epoch_loss += svi.step(x_cell_batch, mask)
+        normalizer_train += mask.sum().item()  # Padding rows do not count
 
     # Return epoch loss.
     total_epoch_loss_train = epoch_loss / normalizer_train
@@ -69,11 +71,11 @@ def evaluate_epoch(svi: pyro.infer.SVI,
     normalizer_test = 1e-10  # no division by zero in the case of no test data
 
     # Compute the loss over the entire tests set.
-    for x_cell_batch in test_loader:
+    for x_cell_batch, mask in test_loader:
 
         # Accumulate loss.
-        test_loss += svi.evaluate_loss(x_cell_batch)
-        normalizer_test += x_cell_batch.size(0)
+        test_loss += svi.evaluate_loss(x_cell_batch, mask)
+        normalizer_test += mask.sum().item()  # Padding rows do not count
 
     # Return epoch loss.
     total_epoch_loss_test = test_loss / normalizer_test
@@ -142,6 +144,115 @@ def run_training(model: VariationalInferenceModel,
     return train_elbo, test_elbo
 
 
+# Peak memory of one step of inference, per barcode per gene, in bytes.  This
+# covers the dense minibatch and the gene-sized tensors of the encoders, the
+# decoder, and the likelihood (enumerated over y), with their gradients.
+# Measured at 19 - 28 bytes for the full model on CPU, plus the input, for a
+# total of 36 bytes.  Measuring with --likelihood_genes and --encoder_genes
+# puts about half of it in the likelihood and a quarter in the encoder inputs,
+# which scale with those numbers of genes rather than with all genes.
+BYTES_PER_BARCODE_PER_GENE = 9
+BYTES_PER_BARCODE_PER_ENCODER_GENE = 9
+BYTES_PER_BARCODE_PER_LIKELIHOOD_GENE = 18
+
+# Each parameter has a gradient and two ClippedAdam moments.
+BYTES_PER_PARAMETER = 4 * 4
+
+# Most of a memory budget that a resident dense count matrix may take up.
+MAX_RESIDENT_FRACTION_OF_BUDGET = 0.5
+
+
+def estimate_training_memory(batch_size: int,
+                             n_genes: int,
+                             args) -> Tuple[float, float]:
+    """Estimate the memory needed for inference with a given minibatch size.
+
+    Args:
+        batch_size: Number of barcodes in each minibatch.
+        n_genes: Number of genes analyzed.
+        args: Input command line parsed arguments, for the layer sizes and
+            the numbers of genes used by the encoders and the likelihood.
+
+    Returns:
+        fixed_bytes: Memory for the parameters and optimizer state.
+        batch_bytes: Memory for one minibatch.
+
+    """
+
+    # Numbers of genes input to the encoders, and in the likelihood.
+    encoder_genes = n_genes if args.encoder_genes is None \
+        else min(n_genes, args.encoder_genes)
+    likelihood_genes = n_genes if args.likelihood_genes is None \
+        else min(n_genes, args.likelihood_genes)
+
+    # Layers with a gene-sized side: the first layers of the encoders (that
+    # of p also sees the difference from the ambient profile), and the
+    # output layer of the decoder.
+    gene_parameters = encoder_genes * (args.z_hidden_dims[0]
+                                       + args.d_hidden_dims[0])
+    if args.model[0] != "simple":
+        gene_parameters += 2 * encoder_genes * args.p_hidden_dims[0]
+    decoder_width = args.z_hidden_dims[-1]
+    if args.decoder_rank is not None:
+        decoder_width = min(decoder_width, args.decoder_rank)
+    gene_parameters += n_genes * decoder_width
+    fixed_bytes = BYTES_PER_PARAMETER * gene_parameters
+
+    # Activations of the (small) hidden layers, with their gradients.
+    hidden_units = sum(args.z_hidden_dims) * 2 + sum(args.d_hidden_dims) \
+        + sum(args.p_hidden_dims) + args.z_dim
+    batch_bytes = batch_size * (BYTES_PER_BARCODE_PER_GENE * n_genes
+                                + BYTES_PER_BARCODE_PER_ENCODER_GENE
+                                * encoder_genes
+                                + BYTES_PER_BARCODE_PER_LIKELIHOOD_GENE
+                                * likelihood_genes
+                                + 4 * 2 * hidden_units)
+
+    return fixed_bytes, batch_bytes
+
+
+def get_batch_size_from_memory_budget(memory_budget_gb: float,
+                                      n_genes: int,
+                                      args,
+                                      max_batch_size: int,
+                                      resident_gb: float = 0.) -> int:
+    """Choose the largest minibatch size whose predicted memory fits a budget.
+
+    Args:
+        memory_budget_gb: Memory available for inference, in GB.
+        n_genes: Number of genes analyzed.
+        args: Input command line parsed arguments, for the layer sizes.
+        max_batch_size: Upper limit, e.g. given by the size of the dataset.
+        resident_gb: Memory taken up by count data kept on the device for
+            the whole of training (see get_resident_gb()).
+
+    Returns:
+        batch_size: Number of barcodes in each minibatch.
+
+    """
+
+    fixed_bytes, bytes_per_barcode = estimate_training_memory(1, n_genes, args)
+    fixed_bytes += resident_gb * 1e9
+    budget_bytes = memory_budget_gb * 1e9
+
+    assert budget_bytes > fixed_bytes + bytes_per_barcode, \
+        f"memory_budget of {memory_budget_gb} GB is too small: at least " \
+        f"{(fixed_bytes + bytes_per_barcode) / 1e9:.2f} GB is needed for " \
+        f"{n_genes} genes (including {resident_gb:.2f} GB of resident data)."
+
+    # Predicted memory is linear in the minibatch size.
+    batch_size = int((budget_bytes - fixed_bytes) // bytes_per_barcode)
+    batch_size = max(1, min(batch_size, max_batch_size))
+
+    predicted_bytes = sum(estimate_training_memory(batch_size, n_genes, args)) \
+        + resident_gb * 1e9
+    logging.info(f"Using minibatch size {batch_size}, with predicted memory "
+                 f"use of {predicted_bytes / 1e9:.2f} GB for inference "
+                 f"(budget {memory_budget_gb} GB).")
+
+    return batch_size
+
+
 def run_inference(dataset_obj: Dataset,
                   args) -> VariationalInferenceModel:
     """Run a full inference procedure, training a latent variable model.
@@ -167,17 +278,32 @@ def run_inference(dataset_obj: Dataset,
 
     # Set up the variational autoencoder:
 
+    # Choose the genes input to the encoders (the decoder uses all genes).
+    encoder_gene_inds = None
+    if (args.encoder_genes is not None) \
+            and (args.encoder_genes < count_matrix.shape[1]):
+        encoder_gene_inds = select_encoder_genes(
+            count_matrix,
+            n_genes=args.encoder_genes,
+            method=args.encoder_gene_selection,
+            chi_ambient=dataset_obj.priors.get('chi_ambient', None))
+        logging.info(f"Encoders use {encoder_gene_inds.size} of "
+                     f"{count_matrix.shape[1]} genes, chosen by "
+                     f"{args.encoder_gene_selection}.")
+
     # Encoder.
     encoder_z = EncodeZ(input_dim=count_matrix.shape[1],
                         hidden_dims=args.z_hidden_dims,
                         output_dim=args.z_dim,
-                        input_transform='normalize')
+                        input_transform='normalize',
+                        gene_inds=encoder_gene_inds)
 
     encoder_d = EncodeD(input_dim=count_matrix.shape[1],
                         hidden_dims=args.d_hidden_dims,
                         output_dim=1,
                         log_count_crossover=
-                        dataset_obj.priors['log_counts_crossover'])
+                        dataset_obj.priors['log_counts_crossover'],
+                        gene_inds=encoder_gene_inds)
 
     if args.model[0] == "simple":
 
@@ -192,7 +318,8 @@ def run_inference(dataset_obj: Dataset,
                                    output_dim=1,
                                    input_transform='normalize',
                                    log_count_crossover=
-                                   dataset_obj.priors['log_counts_crossover'])
+                                   dataset_obj.priors['log_counts_crossover'],
+                                   gene_inds=encoder_gene_inds)
         encoder = CompositeEncoder({'z': encoder_z,
                                     'd_loc': encoder_d,
                                     'p_y': encoder_p})
@@ -200,7 +327,8 @@ def run_inference(dataset_obj: Dataset,
     # Decoder.
     decoder = Decoder(input_dim=args.z_dim,
                       hidden_dims=args.z_hidden_dims[::-1],
-                      output_dim=count_matrix.shape[1])
+                      output_dim=count_matrix.shape[1],
+                      output_rank=args.decoder_rank)
 
     # Set up the pyro model for variational inference.
     model = VariationalInferenceModel(model_type=args.model[0],
@@ -210,21 +338,44 @@ def run_inference(dataset_obj: Dataset,
                                       use_decaying_avg_baseline=
                                       args.use_decaying_average_baseline,
                                       use_IAF=args.use_IAF,
+                                      likelihood_genes=args.likelihood_genes,
                                       use_cuda=args.use_cuda)
 
+    # Data kept on the device as a dense tensor counts against any memory
+    # budget, and may only take up part of it.
+    empty_drop_dataset = dataset_obj.get_count_matrix_empties()
+    dense_threshold_gb = args.dense_threshold_gb
+    if args.memory_budget is not None:
+        dense_threshold_gb = min(dense_threshold_gb,
+                                 MAX_RESIDENT_FRACTION_OF_BUDGET
+                                 * args.memory_budget)
+    resident_gb = get_resident_gb(count_matrix, empty_drop_dataset,
+                                  dense_threshold_gb=dense_threshold_gb,
+                                  sparse_batches=args.sparse_input)
+
     # Load the dataset into DataLoaders.
     frac = args.training_fraction
-    batch_size = int(min(500,
-                         frac * dataset_obj.analyzed_barcode_inds.size / 2))
+    max_batch_size = int(frac * dataset_obj.analyzed_barcode_inds.size / 2)
+    if args.memory_budget is None:
+        batch_size = int(min(500, max_batch_size))
+    else:
+        batch_size = get_batch_size_from_memory_budget(
+            memory_budget_gb=args.memory_budget,
+            n_genes=count_matrix.shape[1],
+            args=args,
+            max_batch_size=max_batch_size,
+            resident_gb=resident_gb)
     train_loader, test_loader = \
         prep_data_for_training(dataset=count_matrix,
-                               empty_drop_dataset=
-                               dataset_obj.get_count_matrix_empties(),
+                               empty_drop_dataset=empty_drop_dataset,
                                batch_size=batch_size,
                                training_fraction=frac,
                                fraction_empties=args.fraction_empties,
                                shuffle=True,
-                               use_cuda=args.use_cuda)
+                               use_cuda=args.use_cuda,
+                               empty_sampling=args.empty_drop_sampling,
+                               dense_threshold_gb=dense_threshold_gb,
+                               sparse_batches=args.sparse_input)
 
     # Run the guide once for Jit. (can hang on StopIteration if no test data!)
     # model.guide(test_loader.__iter__().__next__())  # This seems unnecessary
@@ -1,6 +1,6 @@
 import torch
 import torch.nn as nn
-from typing import List
+from typing import List, Union
 
 
 class Decoder(nn.Module):
@@ -21,10 +21,16 @@ class Decoder(nn.Module):
         hidden_dims: Size of each of the hidden layers.
         output_dim: Number of genes.  The size of the output of this decoder.
         log_output: Whether or not the output is in log space.
+        output_rank: If specified, the output layer is factorized through
+            this many units, which has far fewer parameters than a full
+            hidden_dims[-1] x output_dim layer when there are many genes.
 
     Attributes:
         linears: torch.nn.ModuleList of fully-connected layers before the
             output layer.
+        rank_linear: torch.nn.Linear projection of the last hidden layer to
+            output_rank units (with no bias or activation), or None if the
+            output layer is not factorized.
         outlinear: torch.nn.Linear fully-connected output layer.
         log_output: Whether or not the output is in log space.
 
@@ -37,7 +43,8 @@ class Decoder(nn.Module):
     """
 
     def __init__(self, input_dim: int, hidden_dims: List[int], output_dim: int,
-                 log_output: bool = False):
+                 log_output: bool = False,
+                 output_rank: Union[int, None] = None):
         super(Decoder, self).__init__()
         self.input_dim = input_dim
         self.log_output = log_output
@@ -46,7 +53,17 @@ class Decoder(nn.Module):
         self.linears = nn.ModuleList([nn.Linear(input_dim, hidden_dims[0])])
         for i in range(1, len(hidden_dims)):  # Second hidden layer onward
             self.linears.append(nn.Linear(hidden_dims[i-1], hidden_dims[i]))
-        self.outlinear = nn.Linear(hidden_dims[-1], output_dim)
+
+        # The output layer, factorized as a product of two linear maps if
+        # that is smaller than a full layer.
+        if (output_rank is not None) \
+                and (output_rank < min(hidden_dims[-1], output_dim)):
+            self.rank_linear = nn.Linear(hidden_dims[-1], output_rank,
+                                         bias=False)
+            self.outlinear = nn.Linear(output_rank, output_dim)
+        else:
+            self.rank_linear = None
+            self.outlinear = nn.Linear(hidden_dims[-1], output_dim)
 
         # Set up the non-linear activations.
         self.softplus = nn.Softplus()
@@ -63,6 +80,10 @@ class Decoder(nn.Module):
         for i in range(1, len(self.linears)):  # Second hidden layer onward
             hidden = self.softplus(self.linears[i](hidden))
 
+        # Project onto the low-rank factor of the output layer, if any.
+        if self.rank_linear is not None:
+            hidden = self.rank_linear(hidden)
+
         # Compute the output, which is on a simplex.
         gene_exp = self.softmax(self.outlinear(hidden))
 
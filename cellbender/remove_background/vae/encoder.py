@@ -1,9 +1,14 @@
+import numpy as np
 import torch
 import torch.nn as nn
 from typing import Dict, List, Union
 import warnings
 
 
+# Smallest row sum used to normalize input, so that all-zero rows stay zero.
+MIN_ROW_SUM = 1e-10
+
+
 class CompositeEncoder(dict):
     """A composite of several encoders to be run together on the same input.
 
@@ -53,6 +58,8 @@ class EncodeZ(nn.Module):
         input_transform: Name of transformation to be applied to the input
             gene expression counts.  Must be one of
             ['log', 'normalize', 'log_center'].
+        gene_inds: Indices of the genes that the encoder uses, or None to use
+            all genes.
 
     Attributes:
         transform: Name of transformation to be applied to the input gene
@@ -74,13 +81,16 @@ class EncodeZ(nn.Module):
     """
 
     def __init__(self, input_dim: int, hidden_dims: List[int], output_dim: int,
-                 input_transform: str = None):
+                 input_transform: str = None,
+                 gene_inds: Union[np.ndarray, None] = None):
         super(EncodeZ, self).__init__()
         self.input_dim = input_dim
         self.transform = input_transform
+        self.register_buffer('gene_inds', as_gene_inds(gene_inds))
+        n_inputs = get_n_inputs(input_dim, self.gene_inds)
 
         # Set up the linear transformations used in fully-connected layers.
-        self.linears = nn.ModuleList([nn.Linear(input_dim, hidden_dims[0])])
+        self.linears = nn.ModuleList([nn.Linear(n_inputs, hidden_dims[0])])
         for i in range(1, len(hidden_dims)):  # Second hidden layer onward
             self.linears.append(nn.Linear(hidden_dims[i-1], hidden_dims[i]))
         self.loc_out = nn.Linear(hidden_dims[-1], output_dim)
@@ -94,11 +104,12 @@ class EncodeZ(nn.Module):
         # representation.
 
         # Transform input.
-        x = x.reshape(-1, self.input_dim)
+        x = reshape_input(x, self.input_dim)
+        x = select_genes(x, self.gene_inds)
         x = transform_input(x, self.transform)
 
         # Compute the hidden layers.
-        hidden = self.softplus(self.linears[0](x))
+        hidden = self.softplus(apply_linear(self.linears[0], x))
         for i in range(1, len(self.linears)):  # Second hidden layer onward
             hidden = self.softplus(self.linears[i](hidden))
 
@@ -127,6 +138,8 @@ class EncodeD(nn.Module):
             ['log', 'normalize', 'log_center'].
         log_count_crossover: The log of the number of counts where the
             transition from cells to empty droplets is expected to occur.
+        gene_inds: Indices of the genes that the encoder uses, or None to use
+            all genes.  Total counts are always over all genes.
 
     Attributes:
         transform: Name of transformation to be applied to the input gene
@@ -151,14 +164,17 @@ class EncodeD(nn.Module):
     """
 
     def __init__(self, input_dim: int, hidden_dims: List[int], output_dim: int,
-                 input_transform: str = None, log_count_crossover: float = 7.):
+                 input_transform: str = None, log_count_crossover: float = 7.,
+                 gene_inds: Union[np.ndarray, None] = None):
         super(EncodeD, self).__init__()
         self.input_dim = input_dim
         self.transform = input_transform
         self.param = log_count_crossover
+        self.register_buffer('gene_inds', as_gene_inds(gene_inds))
+        n_inputs = get_n_inputs(input_dim, self.gene_inds)
 
         # Set up the linear transformations used in fully-connected layers.
-        self.linears = nn.ModuleList([nn.Linear(input_dim, hidden_dims[0])])
+        self.linears = nn.ModuleList([nn.Linear(n_inputs, hidden_dims[0])])
         for i in range(1, len(hidden_dims)):  # Second hidden layer onward
             self.linears.append(nn.Linear(hidden_dims[i-1], hidden_dims[i]))
         self.output = nn.Linear(hidden_dims[-1], output_dim)
@@ -171,12 +187,13 @@ class EncodeD(nn.Module):
         # probabilities.
 
         # Transform input and calculate log total UMI counts per barcode.
-        x = x.reshape(-1, self.input_dim)
-        log_sum = x.sum(dim=-1, keepdim=True).log1p()
+        x = reshape_input(x, self.input_dim)
+        log_sum = get_row_sums(x).log1p()
+        x = select_genes(x, self.gene_inds)
         x = transform_input(x, self.transform)
 
         # Compute the hidden layers and the output.
-        hidden = self.softplus(self.linears[0](x))
+        hidden = self.softplus(apply_linear(self.linears[0], x))
         for i in range(1, len(self.linears)):  # Second hidden layer onward
             hidden = self.softplus(self.linears[i](hidden))
 
@@ -205,6 +222,8 @@ class EncodePAmbient(nn.Module):
             ['log', 'normalize', 'log_center'].
         log_count_crossover: The log of the number of counts where the
             transition from cells to empty droplets is expected to occur.
+        gene_inds: Indices of the genes that the encoder uses, or None to use
+            all genes.  Total counts are always over all genes.
 
     Attributes:
         transform: Name of transformation to be applied to the input gene
@@ -228,15 +247,18 @@ class EncodePAmbient(nn.Module):
     """
 
     def __init__(self, input_dim: int, hidden_dims: List[int], output_dim: int,
-                 input_transform: str = None, log_count_crossover: float = 7.):
+                 input_transform: str = None, log_count_crossover: float = 7.,
+                 gene_inds: Union[np.ndarray, None] = None):
         super(EncodePAmbient, self).__init__()
         self.input_dim = input_dim
         self.transform = input_transform
         self.param = log_count_crossover
+        self.register_buffer('gene_inds', as_gene_inds(gene_inds))
+        self.n_inputs = get_n_inputs(input_dim, self.gene_inds)
 
         # Set up the linear transformations used in fully-connected layers.
         # Adjust initialization conditions to start with a reasonable output.
-        self.linears = nn.ModuleList([nn.Linear(1 + 2*input_dim,
+        self.linears = nn.ModuleList([nn.Linear(1 + 2*self.n_inputs,
                                                 hidden_dims[0])])
         with torch.no_grad():
             self.linears[-1].weight[0][0] = 1.  # Weight for log sum
@@ -263,16 +285,31 @@ class EncodePAmbient(nn.Module):
         # an augmented input.
 
         # Transform input and calculate log total UMI counts per barcode.
-        x = x.reshape(-1, self.input_dim)
-        log_sum = x.sum(dim=-1, keepdim=True).log1p()
+        x = reshape_input(x, self.input_dim)
+        log_sum = get_row_sums(x).log1p()
+        x = select_genes(x, self.gene_inds)
         x = transform_input(x, self.transform)
 
-        # Form a new input by concatenation.
+        # The ambient profile of the encoder's genes, as a simplex.
+        if self.gene_inds is not None:
+            chi_ambient = chi_ambient[self.gene_inds]
+            chi_ambient = chi_ambient / chi_ambient.sum()
+
+        # The first layer acts on the concatenation [log_sum, x, x - chi].
+        # Its weights are split as [w_sum, w_x, w_diff], so that
+        # w_x x + w_diff (x - chi) = (w_x + w_diff) x - w_diff chi,
+        # which needs one product with x (dense or sparse) rather than two.
+        weight = self.linears[0].weight
+        w_sum = weight[:, :1]
+        w_x = weight[:, 1:(1 + self.n_inputs)]
+        w_diff = weight[:, (1 + self.n_inputs):]
+        first = (log_sum @ w_sum.t()
+                 + multiply_by_weight(x, w_x + w_diff)
+                 - chi_ambient @ w_diff.t()
+                 + self.linears[0].bias)
+
         # Compute the hidden layers and the output.
-        hidden = self.softplus(self.linears[0](torch.cat((log_sum,
-                                                          x,
-                                                          x - chi_ambient),
-                                                         dim=-1)))
+        hidden = self.softplus(first)
         for i in range(1, len(self.linears)):  # Second hidden layer onward
             hidden = self.softplus(self.linears[i](hidden))
 
@@ -353,43 +390,161 @@ class EncodeP(nn.Module):
         # log of the total UMI counts to form an augmented input.
 
         # Transform input and calculate log total UMI counts per barcode.
-        x = x.reshape(-1, self.input_dim)
-        log_counts = x.sum(dim=-1, keepdim=True).log1p()
+        x = reshape_input(x, self.input_dim)
+        log_counts = get_row_sums(x).log1p()
         x = transform_input(x, self.transform)
 
-        # Form a new input by concatenation.
+        # The first layer acts on the concatenation [log_counts, x], computed
+        # with the weights split, so that x can be dense or sparse.
+        weight = self.linears[0].weight
+        first = (log_counts @ weight[:, :1].t()
+                 + multiply_by_weight(x, weight[:, 1:])
+                 + self.linears[0].bias)
+
         # Compute the hidden layers and the output.
-        hidden = self.softplus(self.linears[0](torch.cat((log_counts,
-                                                          x), dim=-1)))
+        hidden = self.softplus(first)
         for i in range(1, len(self.linears)):  # Second hidden layer onward
             hidden = self.softplus(self.linears[i](hidden))
 
         return self.output(hidden).squeeze()
 
 
+def as_gene_inds(gene_inds: Union[np.ndarray, None]) -> Union[torch.Tensor, None]:
+    """Sorted gene indices as a torch.LongTensor (or None for all genes)."""
+
+    if gene_inds is None:
+        return None
+    return torch.as_tensor(np.sort(np.asarray(gene_inds)), dtype=torch.long)
+
+
+def get_n_inputs(input_dim: int, gene_inds: Union[torch.Tensor, None]) -> int:
+    """Number of genes input to an encoder."""
+
+    return input_dim if gene_inds is None else gene_inds.numel()
+
+
+def select_genes(x: torch.Tensor,
+                 gene_inds: Union[torch.Tensor, None]) -> torch.Tensor:
+    """Select the columns (genes) gene_inds of dense or sparse CSR input.
+
+    Args:
+        x: Input with barcodes as rows and all genes as columns.
+        gene_inds: Sorted indices of the genes to keep, or None to keep all.
+
+    Returns:
+        x restricted to gene_inds, with the same layout as x.
+
+    """
+
+    if gene_inds is None:
+        return x
+
+    if is_sparse(x):
+
+        # Map gene indices to their position in gene_inds (-1 if absent), and
+        # keep the stored values of selected genes, row by row.
+        lookup = torch.full((x.size(1),), -1, dtype=torch.long, device=x.device)
+        lookup[gene_inds] = torch.arange(gene_inds.numel(), device=x.device)
+        cols = lookup[x.col_indices()]
+        keep = cols >= 0
+        counts = torch.bincount(get_sparse_row_inds(x)[keep], minlength=x.size(0))
+        crow = torch.cat([counts.new_zeros(1), counts.cumsum(0)])
+        return torch.sparse_csr_tensor(crow, cols[keep], x.values()[keep],
+                                       size=(x.size(0), gene_inds.numel()))
+
+    return x.index_select(-1, gene_inds)
+
+
+def is_sparse(x: torch.Tensor) -> bool:
+    """Whether x is a sparse CSR minibatch, rather than a dense one."""
+
+    return x.layout == torch.sparse_csr
+
+
+def reshape_input(x: torch.Tensor, input_dim: int) -> torch.Tensor:
+    """Reshape a dense input to (barcodes, genes).  Sparse input already is."""
+
+    if is_sparse(x):
+        return x
+    return x.reshape(-1, input_dim)
+
+
+def get_row_sums(x: torch.Tensor) -> torch.Tensor:
+    """Sum of each row of a dense or sparse CSR input, as a column."""
+
+    if is_sparse(x):
+        rows = get_sparse_row_inds(x)
+        sums = torch.zeros(x.size(0), dtype=x.values().dtype, device=x.device)
+        return sums.index_add(0, rows, x.values()).unsqueeze(-1)
+    return x.sum(dim=-1, keepdim=True)
+
+
+def get_sparse_row_inds(x: torch.Tensor) -> torch.Tensor:
+    """Row index of each stored value of a sparse CSR tensor."""
+
+    crow = x.crow_indices()
+    return torch.repeat_interleave(torch.arange(x.size(0), device=x.device),
+                                   crow[1:] - crow[:-1])
+
+
+def multiply_by_weight(x: torch.Tensor, weight: torch.Tensor) -> torch.Tensor:
+    """Compute x @ weight.t() for dense or sparse CSR x.
+
+    For sparse x, only the stored (nonzero) values are multiplied.
+
+    """
+
+    if is_sparse(x):
+        return torch.sparse.mm(x, weight.t())
+    return x @ weight.t()
+
+
+def apply_linear(linear: nn.Linear, x: torch.Tensor) -> torch.Tensor:
+    """Apply a fully-connected layer to dense or sparse CSR input."""
+
+    if is_sparse(x):
+        return multiply_by_weight(x, linear.weight) + linear.bias
+    return linear(x)
+
+
 def transform_input(x: torch.Tensor, transform: str) -> Union[torch.Tensor,
                                                               None]:
     """Transform input to encoder, in place.
 
     Args:
-        x: Input torch.Tensor
+        x: Input torch.Tensor, dense or sparse CSR.
         transform: Specifies which transformation to perform.  Must be one of
             ['log', 'normalize', 'log_center'].
 
     Returns:
         Transformed input as a torch.Tensor of the same type and shape as x.
 
+    Note:
+        Both transformations map zero to zero, so for sparse input they act
+        on the stored values only.  Barcodes with no counts (e.g. in the
+        genes chosen for an encoder) stay zero when normalized.
+
     """
 
     if transform is None:
         return x
 
+    elif is_sparse(x) and (transform in ['log', 'normalize']):
+        values = x.values()
+        if transform == 'log':
+            values = values.log1p()
+        else:
+            row_sums = get_row_sums(x).squeeze(-1).clamp(min=MIN_ROW_SUM)
+            values = values / row_sums[get_sparse_row_inds(x)]
+        return torch.sparse_csr_tensor(x.crow_indices(), x.col_indices(),
+                                       values, size=x.size())
+
     elif transform == 'log':
         x = x.log1p()
         return x
 
     elif transform == 'normalize':
-        x = x / x.sum(dim=-1, keepdim=True)
+        x = x / x.sum(dim=-1, keepdim=True).clamp(min=MIN_ROW_SUM)
         return x
 
     else: